@@ -25,18 +25,190 @@
 #-----------------------------------------------------------------------------
 
 import os
+import bisect
 import re
-import xml.dom.minidom
+import sys
+import xml.parsers.expat
 import datetime
 import pytz
-import json
 from collections import namedtuple
 from tzlocal import get_localzone
 
+import JsonCodec
+
+#-----------------------------------------------------------------------------
+
+# Merge policies
+MERGE_NONE = 0 # keep the own value
+MERGE_FILL = 1 # take the other value, if the own one is empty
+MERGE_LONGER = 2 # prefer the longer value (e. g. the complete number)
+MERGE_UNION = 3 # unite sets
+MERGE_COORDINATE = 4 # fill or refine the lat/lon pair as a whole
+
+class Field(namedtuple('Field',
+        'name default pager xml json merge envelope',
+        defaults = (None, None, None, None, MERGE_FILL, None))):
+    """Alarm field description.
+
+    pager is the index of the DME token (see Alarm.splitPager) or a tuple
+    (index, start, stop) for a part of it. xml is the element path below
+    <daten>, json the Alamos key and envelope the (stable) field ID in
+    forwarded envelopes. xml and json may be tuples (key, name of an Alarm
+    conversion method); a conversion returning None leaves the field
+    unchanged. A callable default is called to create the initial value.
+    """
+
+    __slots__ = ()
+
+
+# Date, time and coordinates of pager alarms are not part of the tokens, the
+# <em> elements of XML alarms are handled by the XmlParser.
+schema = (
+    Field('number', envelope = 1, pager = 0,
+        xml = 'einsatz/einsatznummer', json = 'COBRA_name',
+        merge = MERGE_LONGER),
+    Field('datetime', envelope = 2,
+        xml = ('einsatz/timestamp', 'xmlTimeStamp'),
+        json = ('timestamp', 'alamosTimeStamp'), merge = MERGE_NONE),
+    Field('art', envelope = 3, pager = (1, 0, 1),
+        xml = 'einsatz/einsatzart', json = 'COBRA_keyword_ident_1'),
+    Field('stichwort', envelope = 4, pager = (1, 1, 2),
+        xml = 'einsatz/einsatzstichwort', json = 'COBRA_keyword_1'),
+    Field('diagnose', envelope = 5, pager = (1, 2, None),
+        xml = 'einsatz/diagnose', json = 'COBRA_keyword_additional_1'),
+    Field('eskalation', envelope = 6,
+        xml = ('einsatz/eskalation', 'xmlEskalation')),
+    Field('besonderheit', envelope = 7, pager = 2,
+        xml = 'einsatz/besonderheit', json = 'COBRA_ADDITIONAL_comment'),
+    Field('sondersignal', envelope = 8, xml = 'einsatz/sondersignal',
+        json = ('COBRA_ADDITIONAL_special_rights',
+            'alamosSonderSignal')),
+    Field('meldender', envelope = 9, xml = 'einsatz/meldender',
+        json = 'COBRA_reporter_name'),
+    Field('rufnummer', envelope = 10, xml = 'einsatz/rufnummer',
+        json = 'COBRA_reporter_phone'),
+    Field('plz', envelope = 11, xml = 'einsatzort/plz',
+        json = 'postalCode'),
+    Field('ort', envelope = 12, pager = 3, xml = 'einsatzort/ort',
+        json = 'city'),
+    Field('ortsteil', envelope = 13, pager = 4, xml = 'einsatzort/ortsteil',
+        json = 'city_abbr'),
+    Field('strasse', envelope = 14, pager = 5, xml = 'einsatzort/strasse',
+        json = 'street'),
+    Field('hausnummer', envelope = 15, pager = 6,
+        xml = 'einsatzort/hausnummer', json = 'house'),
+    Field('ortshinweis', envelope = 16, pager = 8,
+        json = 'COBRA_LOCATION_floor'),
+    Field('objektname', envelope = 17, xml = 'einsatzort/objekt/o_name',
+        json = 'building'),
+    Field('objektnummer', envelope = 18, pager = 7,
+        xml = ('einsatzort/objekt/o_nummer', 'xmlObjektNummer')),
+    Field('lat', 0.0, envelope = 19,
+        xml = ('einsatzort/koordinaten', 'xmlLatitude'),
+        json = ('lat', 'alamosCoordinate'), merge = MERGE_COORDINATE),
+    Field('lon', 0.0, envelope = 20,
+        xml = ('einsatzort/koordinaten', 'xmlLongitude'),
+        json = ('lng', 'alamosCoordinate'), merge = MERGE_COORDINATE),
+    Field('einsatzmittel', set, envelope = 24,
+        json = ('einsatzmittel', 'alamosEinsatzMittel'),
+        merge = MERGE_UNION),
+)
+
+#-----------------------------------------------------------------------------
+
+class AlarmContext:
+    """Parser and rendering settings, resolved once from a configuration:
+    options, time zones, paths and the home town.
+
+    Owners of many alarms create a context once and pass it to the alarms.
+    A new context has to be created, if the configuration changes.
+    """
+
+    __slots__ = ('useHostClock', 'pagerZone', 'emailZone', 'websocketZone',
+            'localZone', 'dbPath', 'homeTown')
+
+    def __init__(self, config):
+        self.useHostClock = config.getboolean('pager', 'use_host_clock',
+                fallback = False)
+        self.pagerZone = pytz.timezone(config.get('pager', 'time_zone',
+                fallback = 'Europe/Berlin'))
+        self.emailZone = pytz.timezone(config.get('email', 'time_zone',
+                fallback = 'Europe/Berlin'))
+        self.websocketZone = pytz.timezone(config.get('websocket',
+            'time_zone', fallback = 'Europe/Berlin'))
+        self.localZone = get_localzone()
+        self.dbPath = config.get('db', 'path', fallback = None)
+        self.homeTown = config.get('display', 'home_town', fallback = '')
+
+#-----------------------------------------------------------------------------
+
+class AlarmPayload:
+    """Raw payloads of an alarm, kept apart from the parsed fields."""
+
+    __slots__ = ('pager', 'xml', 'json')
+
+    def __init__(self):
+        self.pager = None # str
+        self.xml = None # bytes (str, if loaded from a file)
+        self.json = None # bytes (encoded alarm dictionary)
+
+#-----------------------------------------------------------------------------
+
+class AlarmChanges:
+    """What a merge changed, so that the display stages can skip the
+    parts an additional source did not touch.
+    """
+
+    __slots__ = ('fields', 'einsatzmittel', 'coordinates', 'sources')
+
+    def __init__(self):
+        self.fields = {} # name -> (old value, new value)
+        self.einsatzmittel = set() # added resources
+        self.coordinates = None # ((old lat, old lon), (new lat, new lon))
+        self.sources = set() # added sources
+
+    def __bool__(self):
+        return any((self.fields, self.einsatzmittel, self.coordinates,
+            self.sources))
+
+    def touches(self, names):
+        """True, if one of the given fields changed."""
+        if self.einsatzmittel and 'einsatzmittel' in names:
+            return True
+        if self.coordinates and ('lat' in names or 'lon' in names):
+            return True
+        return not self.fields.keys().isdisjoint(names)
+
+    def __repr__(self):
+        ret = ', '.join(sorted(self.fields))
+        if self.einsatzmittel:
+            ret += ', +{0} einsatzmittel'.format(len(self.einsatzmittel))
+        if self.coordinates:
+            ret += ', coordinates'
+        if self.sources:
+            ret += ', +' + '+'.join(sorted(self.sources))
+        return ret.lstrip(', ') or 'nothing'
+
+#-----------------------------------------------------------------------------
+
+def payloadProperty(name):
+    def getter(alarm):
+        return getattr(alarm.raw, name) if alarm.raw else None
+
+    def setter(alarm, value):
+        if not alarm.raw:
+            alarm.raw = AlarmPayload()
+        setattr(alarm.raw, name, value)
+    return property(getter, setter)
+
 #-----------------------------------------------------------------------------
 
 class Alarm:
 
+    # parsed fields (see schema) and metadata; no instance dictionary
+    __slots__ = tuple(field.name for field in schema) + ('receiveTimeStamp',
+            'trace', 'context', 'source', 'sources', 'fallbackStr', 'raw')
+
     images = {
         'B': 'feuer',
         'C': 'abc',
@@ -44,22 +216,19 @@ class Alarm:
         'R': 'hilfe',
     }
 
+    # DME time stamp: TT-MM-YY HH:MM:SS, followed by whitespace. Searched
+    # from the first '-', as the leading digits would slow the scan down.
+    timeStampRe = re.compile('-\d+-\d+ \d+:\d+:\d+(?=\s)')
+    # #K01;N5174110E0608130;
     coordRe = re.compile('#K01;N(\d+)E(\d+);')
-    alarmRe = re.compile( \
-            '.*(\d\d-\d+-\d+ \d+:\d+:\d+)\s+' \
-            '(.*?)\s*?\*' \
-            '(.*?)\*' \
-            '(..)\s+' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*?)\*' \
-            '(.*)')
+    # '*' in front of Einsatzart/Stichwort
+    artRe = re.compile('\*(?=[^\n][^\n]\s)')
+    nonSpaceRe = re.compile('\S')
     dateRe = re.compile('\d\d\d\d-\d\d-\d\d-\d\d-\d\d-\d\d')
 
+    # <koordinaten>POINT (6.16825119 51.80245845)</koordinaten>
+    pointRe = re.compile('\((.*)\s+(.*)\)')
+
     # <o_nummer>[My ignored object name] KLV 06/666</o_nummer>
     objectNumberRe = re.compile('\s*(\[.*\])\s*(.*)')
 
@@ -76,36 +245,23 @@ class Alarm:
         '([0-9]+)' # 5) 1
         '\s*'))
 
-    def __init__(self, config, receiveTimeStamp = None):
-        self.number = None
-        self.datetime = None
-        self.art = None
-        self.stichwort = None
-        self.diagnose = None
-        self.eskalation = None
-        self.besonderheit = None
-        self.sondersignal = None
-        self.meldender = None
-        self.rufnummer = None
-        self.plz = None
-        self.ort = None
-        self.ortsteil = None
-        self.strasse = None
-        self.hausnummer = None
-        self.ortshinweis = None
-        self.objektname = None
-        self.objektnummer = None
-        self.lat = 0.0
-        self.lon = 0.0
-        self.einsatzmittel = set()
+    def __init__(self, config, receiveTimeStamp = None, trace = None,
+            context = None):
+        for name, default in fieldDefaults:
+            setattr(self, name, default() if callable(default) else default)
         self.receiveTimeStamp = receiveTimeStamp
-        self.xml = None
-        self.config = config
+        self.trace = trace # LatencyTrace
+        if trace and receiveTimeStamp is None:
+            self.receiveTimeStamp = trace.wallTime
+        self.context = context or AlarmContext(config) # AlarmContext
         self.source = None
         self.sources = set()
-        self.pager = None
-        self.json = None
         self.fallbackStr = None
+        self.raw = None # AlarmPayload
+
+    pager = payloadProperty('pager')
+    xml = payloadProperty('xml')
+    json = payloadProperty('json')
 
     def fromPager(self, pagerStr, logger = None, dateTime = None):
         # '16-12-17 18:55:10 DME-Text
@@ -117,220 +273,279 @@ class Alarm:
         self.source = 'pager'
         self.sources.add(self.source)
 
-        useHostClock = self.config.getboolean('pager', 'use_host_clock',
-                fallback = False)
+        useHostClock = self.context.useHostClock
         if dateTime:
             self.datetime = dateTime
         elif useHostClock:
             now = datetime.datetime.now()
-            local_tz = get_localzone()
-            self.datetime = local_tz.localize(now)
+            self.datetime = self.context.localZone.localize(now)
 
-        ma = self.coordRe.search(pagerStr)
-        if ma:
-            coord = ma.group(1)
-            coord = coord[:2] + '.' + coord[2:]
-            self.lat = float(coord)
-            coord = ma.group(2)
-            coord = coord[:2] + '.' + coord[2:]
-            self.lon = float(coord)
-            span = ma.span()
-            pagerStr = pagerStr[: span[0]] + pagerStr[span[1]:]
-
-        ma = self.alarmRe.match(pagerStr)
-        if not ma:
+        coord = self.findCoordinates(pagerStr)
+        if coord:
+            self.lat, self.lon, start, end = coord
+            pagerStr = pagerStr[:start] + pagerStr[end:]
+
+        tokens = self.splitPager(pagerStr)
+        if not tokens:
             if logger:
                 logger.warn('Alarmtext nicht erkannt!')
             self.fallbackStr = pagerStr
             return
 
-        #  1) Datum/Uhrzeit TT-MM-YY HH:MM:SS
-        #  2) Einheit, Funktion (RIC)
-        #  .) Koordinaten (zuerst entfernt)
-        #  3) Einsatznummer
-        #  4) Einsatzart und Stichwort
-        #  5) Diagnose und Eskalationsstufe
-        #  6) Hinweis (Freitext)
-        #  7) Stadt
-        #  8) Ortsteil
-        #  9) Straße
-        # 10) Hausnummer
-        # 11) Objektplan
-        # 12) Ortshinweis
+        timeStamp, fields = tokens
+
+        # Datum/Uhrzeit, Einheit/Funktion (RIC) and Koordinaten are handled
+        # above, the remaining fields are mapped by the schema.
 
         if not dateTime and not useHostClock:
-            dt_naive = datetime.datetime.strptime(ma.group(1),
+            dt_naive = datetime.datetime.strptime(timeStamp,
                     '%d-%m-%y %H:%M:%S')
-            zoneStr = self.config.get('pager', 'time_zone',
-                    fallback = 'Europe/Berlin')
-            tz = pytz.timezone(zoneStr)
-            self.datetime = tz.localize(dt_naive)
-
-        #einheit = ma.group(2).strip() # unused
-        self.number = ma.group(3).strip()
-        self.art = ma.group(4)[0]
-        self.stichwort = ma.group(4)[1]
-        self.diagnose = ma.group(5).strip() # Diagnose und Eskalationsstufe
-        self.besonderheit = ma.group(6).strip() # Hinweis (Freitext)
-        self.ort = ma.group(7).strip()
-        self.ortsteil = ma.group(8).strip()
-        self.strasse = ma.group(9).strip()
-        self.hausnummer = ma.group(10).strip()
-        self.objektnummer = ma.group(11).strip()
-        self.ortshinweis = ma.group(12).strip()
+            self.datetime = self.context.pagerZone.localize(dt_naive)
+
+        for name, index, start, stop in pagerFields:
+            setattr(self, name, fields[index][start:stop].strip())
+
+    @classmethod
+    def findCoordinates(cls, pagerStr):
+        """Locates the first '#K01;N<lat>E<lon>;' block.
+
+        Returns (lat, lon, start, end) or None.
+        """
+        ma = cls.coordRe.search(pagerStr)
+        if not ma:
+            return None
+        lat, lon = ma.groups()
+        return (float(lat[:2] + '.' + lat[2:]),
+                float(lon[:2] + '.' + lon[2:]), ma.start(), ma.end())
+
+    @classmethod
+    def splitPager(cls, pagerStr):
+        """Splits a DME text (without coordinates) in linear time.
+
+        Yields the same tokens as the former regular expression: The last
+        time stamp in the first line that is followed by a complete alarm is
+        used. Unit (RIC), number and Einsatzart/Stichwort are separated by '*'.
+        The unit may be continued up to the first '*' of the next line, number
+        and Einsatzart/Stichwort have to be in one line, the Diagnose and the
+        fields behind it may start in the next line. Surplus '*' before the
+        Einsatzart are kept in the number, surplus '*' behind the Objektplan
+        in the Ortshinweis. Returns (timeStamp, fields) or None.
+        """
+        lineEnd = cls.findLineEnd(pagerStr, 0)
+        stamps = []
+        for ma in cls.timeStampRe.finditer(pagerStr, 0, lineEnd + 1):
+            start = ma.start() - 2
+            if start >= 0 and pagerStr[start:ma.start()].isdecimal():
+                stamps.append((pagerStr[start:ma.end()], ma.end()))
+        if not stamps:
+            return None
+
+        # only whitespace behind the last time stamp: the unit (RIC) starts
+        # in one of the following lines
+        timeStamp, stampEnd = stamps[-1]
+        ma = cls.nonSpaceRe.search(pagerStr, stampEnd)
+        if not ma or ma.start() > lineEnd:
+            if ma:
+                tokens = cls.splitUnit(pagerStr, timeStamp, ma.start(),
+                    cls.findLineEnd(pagerStr, ma.start()))
+                if tokens:
+                    return tokens
+            stamps.pop()
+            if not stamps:
+                return None
+
+        # otherwise the last time stamp is used, unless the alarm has to be
+        # complete within the first line
+        timeStamp, stampEnd = stamps[-1]
+        if cls.findNextUnit(pagerStr, lineEnd):
+            return cls.splitUnit(pagerStr, timeStamp, stampEnd, lineEnd)
+        arts = cls.findPagerArts(pagerStr, 0, lineEnd)
+        if not arts:
+            return None
+        lastUnit = pagerStr.rfind('*', 0, arts[-1])
+        for timeStamp, stampEnd in reversed(stamps):
+            if stampEnd <= lastUnit:
+                break
+        else:
+            return None
+        unit = pagerStr.find('*', stampEnd, lineEnd)
+        return cls.pagerTokens(pagerStr, timeStamp, unit,
+            arts[bisect.bisect_right(arts, unit)])
+
+    @classmethod
+    def splitUnit(cls, pagerStr, timeStamp, start, lineEnd):
+        """Splits behind a time stamp, with the unit (RIC) starting in
+        pagerStr[start:lineEnd].
+        """
+        unit = pagerStr.find('*', start, lineEnd)
+        if unit >= 0:
+            arts = cls.findPagerArts(pagerStr, unit + 1, lineEnd)
+            if arts:
+                return cls.pagerTokens(pagerStr, timeStamp, unit, arts[0])
+        nextUnit = cls.findNextUnit(pagerStr, lineEnd)
+        if nextUnit:
+            return cls.pagerTokens(pagerStr, timeStamp, *nextUnit)
+        return None
+
+    @classmethod
+    def findNextUnit(cls, pagerStr, lineEnd):
+        """Returns the positions of the '*' behind a unit continued up to
+        the next line and of the '*' in front of the Einsatzart, or None.
+        """
+        ma = cls.nonSpaceRe.search(pagerStr, lineEnd)
+        if not ma or ma.group() != '*':
+            return None
+        unit = ma.start()
+        arts = cls.findPagerArts(pagerStr, unit + 1,
+            cls.findLineEnd(pagerStr, unit))
+        if not arts:
+            return None
+        return unit, arts[0]
+
+    @staticmethod
+    def findLineEnd(pagerStr, start):
+        end = pagerStr.find('\n', start)
+        return end if end >= 0 else len(pagerStr)
+
+    @classmethod
+    def findPagerArts(cls, pagerStr, start, lineEnd):
+        """Returns the positions of the '*' in pagerStr[start:lineEnd] that
+        are followed by Einsatzart/Stichwort, whitespace and the remaining
+        fields.
+        """
+        # the seventh '*' from the end of the line
+        limit = lineEnd
+        for i in range(7):
+            limit = pagerStr.rfind('*', start, limit)
+            if limit < 0:
+                break
+        last = pagerStr.rfind('*', start, lineEnd)
+        arts = []
+        tail = None
+        for ma in cls.artRe.finditer(pagerStr, start, lineEnd + 1):
+            star = ma.start()
+            if star + 3 < limit:
+                arts.append(star)
+            elif last < star + 3 and not pagerStr[star + 3:lineEnd].strip():
+                # the other fields follow in the next line
+                if tail is None:
+                    tail = cls.splitPagerTail(pagerStr, lineEnd)
+                if tail:
+                    arts.append(star)
+        return arts
+
+    @staticmethod
+    def splitPagerTail(pagerStr, start):
+        """Splits Diagnose ... Ortshinweis after leading whitespace."""
+        tail = pagerStr[start:].lstrip()
+        end = tail.find('\n')
+        if end >= 0:
+            tail = tail[:end]
+        fields = tail.split('*')
+        if len(fields) < 8:
+            return []
+        return fields[:7] + ['*'.join(fields[7:])]
+
+    @classmethod
+    def pagerTokens(cls, pagerStr, timeStamp, unit, art):
+        """Returns (timeStamp, fields) for the given positions of the '*'
+        behind the unit and in front of the Einsatzart.
+        """
+        fields = cls.splitPagerTail(pagerStr, art + 3)
+        return timeStamp, [pagerStr[unit + 1:art],
+            pagerStr[art + 1:art + 3] + ' ' + fields[0]] + fields[1:]
 
     def fromXml(self, xmlString, logger = None):
         self.xml = xmlString
         self.source = 'xml'
         self.sources.add(self.source)
 
-        doc = xml.dom.minidom.parseString(xmlString)
-        elemDaten = doc.firstChild
-        assert elemDaten.localName == 'daten'
+        XmlParser(self, logger).parse(xmlString)
 
-        for child in elemDaten.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'einsatz':
-                self.parseEinsatz(child, logger)
-            elif child.localName == 'einsatzort':
-                self.parseEinsatzOrt(child, logger)
-            elif child.localName == 'einsatzmittel':
-                self.parseEinsatzMittel(child, logger)
-
-    def parseEinsatz(self, elem, logger):
-        for child in elem.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'timestamp':
-                c = content(child)
-                dt_naive = datetime.datetime.strptime(c, '%Y%m%d%H%M%S')
-                dt_utc = pytz.utc.localize(dt_naive)
-                zoneStr = self.config.get('email', 'time_zone',
-                        fallback = 'Europe/Berlin')
-                tz = pytz.timezone(zoneStr)
-                self.datetime = dt_utc.astimezone(tz)
-            elif child.localName == 'einsatznummer':
-                self.number = content(child)
-            elif child.localName == 'einsatzart':
-                self.art = content(child)
-            elif child.localName == 'einsatzstichwort':
-                self.stichwort = content(child)
-            elif child.localName == 'diagnose':
-                self.diagnose = content(child)
-            elif child.localName == 'eskalation':
-                self.eskalation = content(child)
-                if self.eskalation == '-':
-                    self.eskalation = ''
-            elif child.localName == 'besonderheit':
-                self.besonderheit = content(child)
-            elif child.localName == 'sondersignal':
-                self.sondersignal = content(child)
-            elif child.localName == 'meldender':
-                self.meldender = content(child)
-            elif child.localName == 'rufnummer':
-                self.rufnummer = content(child)
-
-    def parseEinsatzOrt(self, elem, logger):
-        for child in elem.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'plz':
-                self.plz = content(child)
-            elif child.localName == 'ort':
-                self.ort = content(child)
-            elif child.localName == 'ortsteil':
-                self.ortsteil = content(child)
-            elif child.localName == 'strasse':
-                self.strasse = content(child)
-            elif child.localName == 'hausnummer':
-                self.hausnummer = content(child)
-            elif child.localName == 'objekt':
-                self.parseObjekt(child, logger)
-            elif child.localName == 'koordinaten':
-                c = content(child)
-                if not c:
-                    continue
-                #POINT (6.16825119 51.80245845)
-                m = re.search('\((.*)\s+(.*)\)', c)
-                if m:
-                    try:
-                        self.lon = float(m.group(1))
-                        self.lat = float(m.group(2))
-                    except:
-                        if logger:
-                            logger.error( \
-                                    u'Unbekanntes Koordinaten-Format "%s"', c)
-                else:
-                    if logger:
-                        logger.error(u'Unbekanntes Koordinaten-Format: "%s"',
-                                c)
+    def xmlTimeStamp(self, value, logger):
+        dt_naive = datetime.datetime.strptime(value, '%Y%m%d%H%M%S')
+        dt_utc = pytz.utc.localize(dt_naive)
+        return dt_utc.astimezone(self.context.emailZone)
 
-    def parseObjekt(self, elem, logger):
-        for child in elem.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'o_name':
-                self.objektname = content(child)
-            elif child.localName == 'o_nummer':
-                o_num = content(child)
-                m = self.objectNumberRe.fullmatch(o_num)
-                if m:
-                    self.objektnummer = m.group(2)
-                else:
-                    self.objektnummer = o_num
-
-    def parseEinsatzMittel(self, elem, logger):
-        for child in elem.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'em':
-                em = EinsatzMittel.fromXml(child)
-                self.einsatzmittel.add(em)
+    def xmlEskalation(self, value, logger):
+        if value == '-':
+            return ''
+        return value
+
+    def xmlObjektNummer(self, value, logger):
+        m = self.objectNumberRe.fullmatch(value)
+        if m:
+            return m.group(2)
+        return value
+
+    def xmlPoint(self, value, logger):
+        """Returns (lon, lat) or None."""
+        if not value:
+            return None
+        #POINT (6.16825119 51.80245845)
+        m = self.pointRe.search(value)
+        if m:
+            try:
+                return float(m.group(1)), float(m.group(2))
+            except:
+                if logger:
+                    logger.error( \
+                            u'Unbekanntes Koordinaten-Format "%s"', value)
+        else:
+            if logger:
+                logger.error(u'Unbekanntes Koordinaten-Format: "%s"',
+                        value)
+        return None
+
+    def xmlLatitude(self, value, logger):
+        point = self.xmlPoint(value, logger)
+        return point[1] if point else None
 
-    def fromAlamos(self, data, logger):
+    def xmlLongitude(self, value, logger):
+        point = self.xmlPoint(value, None) # reported with the latitude
+        return point[0] if point else None
+
+    def fromAlamos(self, data, logger, raw = None):
         self.source = 'json'
         self.sources.add(self.source)
-        self.json = json.dumps(data)
+        self.json = raw if raw is not None else JsonCodec.dumps(data)
+
+        for name, key, convert in jsonFields:
+            if convert:
+                value = convert(self, data.get(key), logger)
+                if value is not None:
+                    setattr(self, name, value)
+            else:
+                setattr(self, name, data.get(key, ''))
+        self.eskalation = '' # FIXME
+        self.objektnummer = '' # FIXME
 
-        self.number = data.get("COBRA_name", "")
-        #address = data.get("address") FIXME Alarmiertes Einsatzmittel
-        einsatzmittel = data.get("einsatzmittel")
-        em_list = list(filter(None, einsatzmittel.split('\n')))
+    def alamosEinsatzMittel(self, value, logger):
+        einsatzmittel = set()
+        em_list = list(filter(None, value.split('\n')))
         for em in em_list:
             m = self.einsatzMittelRe.fullmatch(em)
             if m:
                 # FW KLV01 DLK23 1
-                mittel = EinsatzMittel(m.group(1), m.group(2), m.group(3),
-                        m.group(4), m.group(5), em)
+                mittel = EinsatzMittel.shared(m.group(1), m.group(2),
+                        m.group(3), m.group(4), m.group(5), em)
             else:
-                mittel = EinsatzMittel('', '', '', '', '', em)
-            self.einsatzmittel.add(mittel)
-        self.art = data.get("COBRA_keyword_ident_1", "")
-        ts = int(data.get("timestamp").strip()) / 1000.0
+                mittel = EinsatzMittel.shared('', '', '', '', '', em)
+            einsatzmittel.add(mittel)
+        return einsatzmittel
+
+    def alamosTimeStamp(self, value, logger):
+        ts = int(value.strip()) / 1000.0
         dt_naive = datetime.datetime.fromtimestamp(ts)
-        zoneStr = self.config.get('websocket', 'time_zone',
-                fallback = 'Europe/Berlin')
-        tz = pytz.timezone(zoneStr)
-        self.datetime = tz.localize(dt_naive)
-        self.stichwort = data.get("COBRA_keyword_1", "")
-        self.diagnose = data.get("COBRA_keyword_additional_1", "")
-        self.eskalation = '' # FIXME
-        self.besonderheit = data.get("COBRA_ADDITIONAL_comment", "")
-        self.sondersignal = \
-            data.get("COBRA_ADDITIONAL_special_rights") == 'Ja'
-        self.meldender = data.get("COBRA_reporter_name", "")
-        self.rufnummer = data.get("COBRA_reporter_phone", "")
-        self.plz = data.get("postalCode", "")
-        self.ort = data.get("city", "")
-        self.ortsteil = data.get("city_abbr", "")
-        self.strasse = data.get("street", "")
-        self.hausnummer = data.get("house", "")
-        self.objektname = data.get("building", "")
-        self.objektnummer = '' # FIXME
-        self.ortshinweis = data.get("COBRA_LOCATION_floor", "")
-        self.lon = float(data.get("lng", "0.0"))
-        self.lat = float(data.get("lat", "0.0"))
+        return self.context.websocketZone.localize(dt_naive)
+
+    def alamosSonderSignal(self, value, logger):
+        return value == 'Ja'
+
+    def alamosCoordinate(self, value, logger):
+        if value is None:
+            return None
+        return float(value)
 
     def out(self, logger):
         logger.info(u'Sondersignal: %s', repr(self.sondersignal))
@@ -339,7 +554,7 @@ class Alarm:
             logger.info(em)
 
     def save(self):
-        path = self.config.get('db', 'path', fallback = None)
+        path = self.context.dbPath
         if not path:
             return
 
@@ -356,9 +571,9 @@ class Alarm:
             binary = 'b'
         elif self.source == 'json':
             ext = '.json'
-            contents = self.json # str
-            encoding = 'utf-8'
-            binary = ''
+            contents = self.json # bytes
+            encoding = None
+            binary = 'b'
 
         if not contents:
             return
@@ -370,11 +585,10 @@ class Alarm:
         f.close()
 
     def dateString(self):
-        local_tz = get_localzone()
-        dt = self.datetime.astimezone(local_tz)
+        dt = self.datetime.astimezone(self.context.localZone)
         return dt.strftime('%Y-%m-%d-%H-%M-%S')
 
-    def load(self, path, logger = None):
+    def load(self, path, logger = None, keepPayload = True):
         f = open(path, 'r', encoding = 'utf-8')
         contents = f.read()
         f.close()
@@ -383,8 +597,7 @@ class Alarm:
         if ma:
             dt_naive = datetime.datetime.strptime(ma.group(),
                     '%Y-%m-%d-%H-%M-%S')
-            local_tz = get_localzone()
-            dateTime = local_tz.localize(dt_naive)
+            dateTime = self.context.localZone.localize(dt_naive)
         else:
             dateTime = None
 
@@ -395,85 +608,136 @@ class Alarm:
             self.fromXml(contents, logger)
 
         if path.endswith('.json'):
-            data = json.loads(contents)
-            self.fromAlamos(data, logger)
+            data = JsonCodec.loads(contents)
+            raw = contents.encode('utf-8')
+            if isinstance(data.get('alarm'), dict):
+                # websocket frame saved by a former version
+                data = data['alarm']
+                raw = None
+            self.fromAlamos(data, logger, raw = raw)
+
+        if not keepPayload:
+            self.raw = None
+
+    def mark(self, stage):
+        if self.trace:
+            self.trace.mark(stage)
+
+    def payload(self):
+        """Returns the received payload as bytes (empty, if there is none,
+        e. g. for alarms created locally).
+        """
+        raw = None
+        if self.source == 'pager':
+            raw = self.pager
+        elif self.source == 'xml':
+            raw = self.xml
+        elif self.source == 'json':
+            raw = self.json
+        if isinstance(raw, str): # pager string or XML loaded from file
+            return raw.encode('utf-8')
+        return raw or b''
 
     def matches(self, other):
-        return self.number and other.number and \
-            self.number[-5:] == other.number[-5:]
+        return self.matchesNumber(other.number)
+
+    def matchesNumber(self, number):
+        return self.number and number and \
+            self.number[-5:] == number[-5:]
 
     def merge(self, other, logger = None):
+        """Merges another source of the same alarm into this one.
+
+        Returns an AlarmChanges object describing what was changed.
+        """
         if logger:
             logger.info('Merging alarms...')
 
-        if other.number:
-            if not self.number or len(self.number) < len(other.number):
-                if logger:
-                    logger.info('preferring number %s over %s.',
-                        other.number, self.number)
-                self.number = other.number
-
-        # self.datetime
-        # self.lat
-        # self.lon
-
-        stringVars = [
-            'art',
-            'stichwort',
-            'diagnose',
-            'eskalation',
-            'besonderheit',
-            'sondersignal',
-            'meldender',
-            'rufnummer',
-            'plz',
-            'ort',
-            'ortsteil',
-            'strasse',
-            'hausnummer',
-            'ortshinweis',
-            'objektname',
-            'objektnummer'
-            ]
-
-        # Non-merged fields:
-        # self.number = None
-        # self.datetime = None
-        # self.receiveTimeStamp = receiveTimeStamp
-        # self.xml = None
-        # self.config = config
-        # self.source = None
-        # self.pager = None
-        # self.json = None
-        # self.fallbackStr = None
-        # self.lat = 0.0
-        # self.lon = 0.0
-
-        selfVars = vars(self)
-        otherVars = vars(other)
-        for key in stringVars:
-            if key not in otherVars.keys() or not otherVars[key]:
+        changes = AlarmChanges()
+
+        for name, policy in mergeFields:
+            value = getattr(other, name)
+            if not value:
                 continue
+            current = getattr(self, name)
 
-            if not selfVars[key]:
+            if policy == MERGE_LONGER:
+                if not current or len(current) < len(value):
+                    if logger:
+                        logger.info('preferring %s %s over %s.', name,
+                            value, current)
+                    setattr(self, name, value)
+                    changes.fields[name] = (current, value)
+                continue
+
+            if policy == MERGE_UNION:
+                added = value - current
+                if added:
+                    setattr(self, name, current.union(added))
+                    if name == 'einsatzmittel':
+                        changes.einsatzmittel = added
+                    else:
+                        changes.fields[name] = (current, getattr(self, name))
+                continue
+
+            if not current:
                 if logger:
-                    logger.info('Setting %s to %s.', key, otherVars[key])
-                selfVars[key] = otherVars[key]
+                    logger.info('Setting %s to %s.', name, value)
+                setattr(self, name, value)
+                changes.fields[name] = (current, value)
                 continue
 
-            if selfVars[key] != otherVars[key]:
+            if current != value:
                 if logger:
-                    logger.info('%s is differing: %s / %s.', key,
-                            repr(selfVars[key]), repr(otherVars[key]))
+                    logger.info('%s is differing: %s / %s.', name,
+                            repr(current), repr(value))
 
-        # merge sources
-        self.sources = self.sources.union(other.sources)
+        self.mergeCoordinates(other, changes, logger)
 
-        # merge resources
-        self.einsatzmittel = self.einsatzmittel.union(other.einsatzmittel)
+        # merge sources
+        changes.sources = other.sources - self.sources
+        if changes.sources:
+            self.sources = self.sources.union(changes.sources)
 
         if logger:
-            logger.info('Merge complete.')
+            logger.info('Merge complete: %s.', changes)
+
+        return changes
+
+    @staticmethod
+    def coordinatePrecision(value):
+        """Number of decimal places of a coordinate."""
+        return len(repr(value).partition('.')[2].rstrip('0'))
+
+    def mergeCoordinates(self, other, changes, logger = None):
+        """Takes the coordinates of the other alarm, if this one has none, or
+        if they refine the own ones (more decimal places, same position).
+        Incomplete pairs are never taken over.
+        """
+        if not other.lat or not other.lon:
+            return
+        current = (self.lat, self.lon)
+        value = (other.lat, other.lon)
+        if current == value:
+            return
+
+        if self.lat and self.lon:
+            precision = min(self.coordinatePrecision(c) for c in current)
+            tolerance = 10.0 ** -precision
+            if min(self.coordinatePrecision(c) for c in value) <= precision \
+                    or abs(value[0] - current[0]) > tolerance \
+                    or abs(value[1] - current[1]) > tolerance:
+                if logger:
+                    logger.info('coordinates are differing: %s / %s.',
+                            current, value)
+                return
+            if logger:
+                logger.info('Refining coordinates %s to %s.', current, value)
+        elif logger:
+            logger.info('Setting coordinates to %s.', value)
+
+        self.lat, self.lon = value
+        changes.coordinates = (current, value)
 
     def title(self):
         if self.art and self.stichwort and self.diagnose:
@@ -500,8 +764,7 @@ class Alarm:
                 ret += ', '
             ret += self.ortsteil
         if self.ort:
-            homeTown = self.config.get('display', 'home_town', fallback = '')
-            if self.ort != homeTown:
+            if self.ort != self.context.homeTown:
                 if ret:
                     ret += ', '
                 ret += self.ort
@@ -590,6 +853,11 @@ class Alarm:
         except:
             return False
 
+    # fields read by spoken()
+    spokenFields = ('art', 'stichwort', 'diagnose', 'eskalation', 'ort',
+            'ortsteil', 'strasse', 'hausnummer', 'objektname', 'besonderheit',
+            'sondersignal')
+
     def spoken(self):
         text = 'Einsatz! '
 
@@ -640,30 +908,22 @@ class Alarm:
 class EinsatzMittel(namedtuple('EinsatzMittel',
         'org ort zusatz typ kennung gesprochen')):
 
+    __slots__ = ()
+
+    pool = {} # shared instances
+    poolSize = 4096
+
     @classmethod
-    def fromXml(cls, elem):
-        org = ''
-        ort = ''
-        zusatz = ''
-        typ = ''
-        kennung = ''
-        gesprochen = ''
-        for child in elem.childNodes:
-            if child.nodeType != child.ELEMENT_NODE:
-                continue
-            if child.localName == 'em_organisation':
-                org = content(child)
-            elif child.localName == 'em_ort':
-                ort = content(child)
-            elif child.localName == 'em_ort_zusatz':
-                zusatz = content(child)
-            elif child.localName == 'em_typ':
-                typ = content(child)
-            elif child.localName == 'em_ordnungskennung':
-                kennung = content(child)
-            elif child.localName == 'em_opta_gesprochen':
-                gesprochen = content(child)
-        return cls(org, ort, zusatz, typ, kennung, gesprochen)
+    def shared(cls, *fields):
+        """Returns a pooled instance with interned strings, so that
+        identical resources of different alarms are one object.
+        """
+        em = cls.pool.get(fields)
+        if em is None:
+            em = cls(*(sys.intern(f) for f in fields))
+            if len(cls.pool) < cls.poolSize:
+                cls.pool[em] = em
+        return em
 
     def __repr__(self):
         ret = ''
@@ -712,11 +972,109 @@ class EinsatzMittel(namedtuple('EinsatzMittel',
 
 #-----------------------------------------------------------------------------
 
-def content(elem):
-    value = ''
-    for text in elem.childNodes:
-        assert text.nodeType == text.TEXT_NODE
-        value += text.data
-    return value.strip()
+def compileSource(spec):
+    """Returns (key, conversion method or None)."""
+    if isinstance(spec, tuple):
+        return spec[0], getattr(Alarm, spec[1])
+    return spec, None
+
+
+# Tables for the parsers, compiled from the schema
+fieldDefaults = tuple((f.name, f.default) for f in schema)
+pagerFields = tuple((f.name,) + ((f.pager, None, None)
+    if isinstance(f.pager, int) else f.pager)
+    for f in schema if f.pager is not None)
+jsonFields = tuple((f.name,) + compileSource(f.json)
+    for f in schema if f.json)
+xmlFields = {}
+for f in schema:
+    if f.xml:
+        path, convert = compileSource(f.xml)
+        xmlFields.setdefault(path, []).append((f.name, convert))
+mergeFields = tuple((f.name, f.merge) for f in schema
+    if f.merge not in (MERGE_NONE, MERGE_COORDINATE))
+
+#-----------------------------------------------------------------------------
+
+class XmlParser:
+    """Fills an alarm from an XML document while it is parsed with expat.
+
+    Text of the elements listed in the dispatch tables (compiled from the
+    schema) is assigned to alarm fields; no DOM is built.
+    """
+
+    fields = xmlFields # path below <daten> -> [(field, conversion)]
+
+    emPath = 'einsatzmittel/em'
+
+    # child of <em> -> EinsatzMittel field
+    emFields = {
+        'em_organisation': 'org',
+        'em_ort': 'ort',
+        'em_ort_zusatz': 'zusatz',
+        'em_typ': 'typ',
+        'em_ordnungskennung': 'kennung',
+        'em_opta_gesprochen': 'gesprochen',
+    }
+
+    def __init__(self, alarm, logger = None):
+        self.alarm = alarm
+        self.logger = logger
+        self.path = [] # element names below <daten>
+        self.text = None # text parts of a dispatched element
+        self.em = None # fields of the current <em>
+
+    def parse(self, data):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characterData
+        parser.Parse(data, True)
+
+    def startElement(self, name, attrs):
+        depth = len(self.path)
+        self.path.append(name)
+        self.text = None
+        if not depth:
+            if name != 'daten':
+                raise ValueError('Unexpected root element <%s>.' % name)
+            return
+        key = '/'.join(self.path[1:])
+        if key == self.emPath:
+            self.em = dict.fromkeys(EinsatzMittel._fields, '')
+        elif self.em is not None:
+            if depth == 3 and name in self.emFields:
+                self.text = []
+        elif key in self.fields:
+            self.text = []
+
+    def characterData(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def endElement(self, name):
+        key = '/'.join(self.path[1:])
+        self.path.pop()
+        text = self.text
+        self.text = None
+        if key == self.emPath:
+            self.alarm.einsatzmittel.add(EinsatzMittel.shared(
+                *(self.em[name] for name in EinsatzMittel._fields)))
+            self.em = None
+            return
+        if text is None:
+            return
+        value = ''.join(text).strip()
+        if self.em is not None:
+            self.em[self.emFields[name]] = value
+            return
+        for name, convert in self.fields[key]:
+            if convert:
+                converted = convert(self.alarm, value, self.logger)
+                if converted is not None:
+                    setattr(self.alarm, name, converted)
+            else:
+                setattr(self.alarm, name, value)
 
 #-----------------------------------------------------------------------------
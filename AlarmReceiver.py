@@ -23,17 +23,20 @@
 #
 #-----------------------------------------------------------------------------
 
-import serial
+import re
 import time
+import asyncio
+import serial
 
 from PyQt5 import QtCore
 
+from DeviceMonitor import createDeviceMonitor
+
 #-----------------------------------------------------------------------------
 
 class AlarmReceiver(QtCore.QObject):
 
-    receivedAlarm = QtCore.pyqtSignal(str)
-    finished = QtCore.pyqtSignal()
+    receivedAlarm = QtCore.pyqtSignal(str, str) # pager string, device
     errorMessage = QtCore.pyqtSignal(str)
 
     asciiExceptions = {
@@ -46,80 +49,230 @@ class AlarmReceiver(QtCore.QObject):
         '~': 'ß' # 27-11-10 04:53:29 Dorfstra~e
     }
 
-    def __init__(self, config, logger):
+    decodeTable = str.maketrans(asciiExceptions)
+
+    # Character tables selectable per device with the decode option
+    decodeProfiles = {
+        'din66003': asciiExceptions, # German reference version of ISO 646
+        'none': {},
+    }
+
+    # Reconnect backoff [s], used in addition to device events
+    reconnectMin = 0.25
+    reconnectMax = 8.0
+
+    def __init__(self, config, logger, monitor = None):
         super(AlarmReceiver, self).__init__()
         self.logger = logger
-        self.port = config.get("pager", "device", fallback = "/dev/ttyUSB0")
-        self.connected = True
+        self.monitor = monitor
+        self.ports = []
+        self.wakeup = None
+
+        defaultProfile = config.get("pager", "decode", fallback = "din66003")
+
+        device = config.get("pager", "device", fallback = "/dev/ttyUSB0")
+        if device:
+            self.addPort(device, defaultProfile)
+
+        if not config.has_section('pager'):
+            return
+
+        deviceRe = re.compile('device([0-9]+)')
 
-    def setConnected(self, newState):
-        if self.connected and not newState:
-            self.errorMessage.emit('Keine Verbindung zum DME!')
-        if not self.connected and newState:
-            self.errorMessage.emit('')
-        self.connected = newState
+        for key, device in config.items('pager'):
+            ma = deviceRe.fullmatch(key)
+            if not ma or not device:
+                continue
+            profile = config.get("pager", "decode%s" % (ma.group(1)),
+                    fallback = defaultProfile)
+            self.addPort(device, profile)
 
-    def receive(self):
+    def addPort(self, device, profile):
+        if profile not in self.decodeProfiles:
+            self.logger.error('Unknown decode profile %s for %s.',
+                    repr(profile), device)
+            profile = 'din66003'
+        self.logger.info('Adding pager device %s (decode %s).',
+                device, profile)
+        table = str.maketrans(self.decodeProfiles[profile])
+        self.ports.append(PagerPort(device, table, self.reconnectMin))
 
-        if not self.port:
-            self.finished.emit()
+    def setConnected(self, port, newState):
+        if port.connected == newState:
             return
+        port.connected = newState
+        self.errorMessage.emit(self.connectionMessage())
 
-        self.logger.info('Receiver thread started.')
+    def connectionMessage(self):
+        lost = [port.device for port in self.ports if not port.connected]
+        if not lost:
+            return ''
+        if len(self.ports) == 1:
+            return 'Keine Verbindung zum DME!'
+        return 'Keine Verbindung zum DME (%s)!' % (', '.join(lost))
+
+    async def run(self):
+
+        if not self.ports:
+            return
 
-        reconnectTimeout = 30
+        self.logger.info('Pager receiver started.')
+
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+
+        monitor = self.monitor
+        if not monitor:
+            monitor = createDeviceMonitor(self.logger)
+        if monitor:
+            for port in self.ports:
+                monitor.watch(port.device)
+            if monitor.fileno() is not None:
+                loop.add_reader(monitor.fileno(),
+                        lambda: self.devicesChanged(monitor.changes()))
+        nextPoll = 0.0
 
         while True:
+            now = time.monotonic()
+            timeout = None
+
+            for port in self.ports:
+                if port.serial:
+                    continue
+                if now >= port.nextAttempt:
+                    self.connect(port, loop, now)
+                if not port.serial:
+                    wait = max(port.nextAttempt - now, 0.0)
+                    if timeout is None or wait < timeout:
+                        timeout = wait
+
+            if monitor and monitor.interval:
+                wait = max(nextPoll - now, 0.0)
+                if timeout is None or wait < timeout:
+                    timeout = wait
+
+            # woken up by device events or read errors
+            self.wakeup.clear()
             try:
-                ser = serial.serial_for_url(
-                        'alt://%s?class=PosixPollSerial' % (self.port),
-                        baudrate = 9600,
-                        parity = serial.PARITY_NONE,
-                        stopbits = serial.STOPBITS_ONE,
-                        bytesize = serial.EIGHTBITS,
-                        timeout = 10.0)
-            except:
-                self.setConnected(False)
-                time.sleep(reconnectTimeout)
-                continue
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            if monitor and monitor.interval and time.monotonic() >= nextPoll:
+                nextPoll = time.monotonic() + monitor.interval
+                self.devicesChanged(monitor.changes())
+
+    def readPort(self, port, loop):
+        try:
+            frames = port.read()
+        except (serial.SerialException, OSError) as e:
+            self.logger.error('Serial port %s disconnected:', port.device)
+            self.logger.error(e)
+            loop.remove_reader(port.fd)
+            port.close()
+            self.setConnected(port, False)
+            port.backoff = self.reconnectMin
+            port.nextAttempt = time.monotonic() + port.backoff
+            self.wakeup.set()
+            return
+        for pagerStr in frames:
+            self.receivedAlarm.emit(pagerStr, port.device)
+
+    def connect(self, port, loop, now):
+        try:
+            port.open()
+        except (serial.SerialException, OSError):
+            self.setConnected(port, False)
+            port.nextAttempt = now + port.backoff
+            port.backoff = min(port.backoff * 2, self.reconnectMax)
+            return
+        loop.add_reader(port.fd, self.readPort, port, loop)
+        port.backoff = self.reconnectMin
+        self.logger.info('Connected to %s', port.device)
+        self.setConnected(port, True)
 
-            self.logger.info('Connected to %s', ser.portstr)
-            self.setConnected(True)
-
-            data = b''
-            bytesReceived = 0
-
-            while True:
-                try:
-                    c = ser.read()
-                except serial.serialutil.SerialException as e:
-                    self.logger.error('Serial port disconnected:')
-                    self.logger.error(e)
-                    break
-                bytesReceived += 1
-                if c == b'\x00':
-                    pagerStr = data.decode('latin1')
-                    pagerStr = self.decode(pagerStr)
-                    self.receivedAlarm.emit(pagerStr)
-                    data = b''
-                else:
-                    data += c
-
-            ser.close()
-            self.setConnected(False)
-            time.sleep(reconnectTimeout)
-
-        self.logger.info('Receiver thread finished.')
-        self.finished.emit()
+    def devicesChanged(self, paths):
+        # retry immediately, instead of waiting for the backoff to expire
+        for port in self.ports:
+            if not port.serial and port.device in paths:
+                self.logger.info('Device %s appeared.', port.device)
+                port.nextAttempt = 0.0
+                port.backoff = self.reconnectMin
+                self.wakeup.set()
 
     @classmethod
     def decode(cls, data):
-        ret = ''
-        for c in data:
-            if c in cls.asciiExceptions:
-                ret += cls.asciiExceptions[c]
-            else:
-                ret += c
-        return ret
+        return data.translate(cls.decodeTable)
+
+#-----------------------------------------------------------------------------
+
+class PagerPort:
+    """Serial device of a pager receiver with its own framing state."""
+
+    def __init__(self, device, decodeTable, backoff):
+        self.device = device
+        self.decodeTable = decodeTable
+        self.serial = None
+        self.fd = None
+        self.reader = None
+        self.connected = True
+        self.nextAttempt = 0.0
+        self.backoff = backoff
+
+    def open(self):
+        self.serial = serial.Serial(self.device,
+                baudrate = 9600,
+                parity = serial.PARITY_NONE,
+                stopbits = serial.STOPBITS_ONE,
+                bytesize = serial.EIGHTBITS,
+                timeout = 0)
+        self.fd = self.serial.fileno()
+        self.reader = FrameReader()
+
+    def close(self):
+        try:
+            self.serial.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.serial = None
+        self.fd = None
+        self.reader = None
+
+    def read(self):
+        data = self.serial.read(self.serial.in_waiting or 1)
+        frames = self.reader.feed(data)
+        return [f.decode('latin1').translate(self.decodeTable) for f in frames]
+
+#-----------------------------------------------------------------------------
+
+class FrameReader:
+    """Splits a byte stream into frames separated by a terminator.
+
+    Received chunks are collected in a reusable buffer. Complete frames are
+    returned as soon as their terminator arrives, the incomplete rest stays in
+    the buffer for the next call.
+    """
+
+    def __init__(self, terminator = b'\x00'):
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.scanned = 0 # buffer offset known to contain no terminator
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        pos = self.scanned
+        while True:
+            end = self.buffer.find(self.terminator, pos)
+            if end < 0:
+                break
+            frames.append(bytes(self.buffer[start:end]))
+            start = end + len(self.terminator)
+            pos = start
+        if start:
+            del self.buffer[:start]
+        self.scanned = max(len(self.buffer) - len(self.terminator) + 1, 0)
+        return frames
 
 #-----------------------------------------------------------------------------
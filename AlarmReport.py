@@ -176,6 +176,7 @@ class AlarmReport:
 
         psPath = os.path.join(tempDir, texBase + '.ps')
         self.logger.info(u'PS file %s was created.', psPath)
+        alarm.mark('report')
 
         printOut = self.config.getboolean("report", "print", fallback = False)
         if printOut:
@@ -203,6 +204,8 @@ class AlarmReport:
             lpr.wait()
             if lpr.returncode != 0:
                 self.logger.error('lpr failed.')
+            else:
+                alarm.mark('print')
 
             self.logger.info("Print ready.")
 
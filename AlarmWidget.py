@@ -47,6 +47,7 @@ class AlarmWidget(QWidget):
 
         self.alarm = None
         self.alarmDateTime = None
+        self.paintTrace = None # trace to mark the next paint event in
 
         self.imageDir = self.config.get("display", "image_dir",
                 fallback = "images")
@@ -230,9 +231,48 @@ class AlarmWidget(QWidget):
 
         QApplication.processEvents()
 
-    def processAlarm(self, alarm):
+    # fields read by the sections of processAlarm()
+    titleFields = ('art', 'stichwort', 'diagnose', 'eskalation')
+    locationFields = ('strasse', 'hausnummer', 'ortsteil', 'ort',
+            'objektname', 'ortshinweis')
+    attentionFields = ('besonderheit',)
+    callerFields = ('meldender', 'rufnummer')
+
+    def processAlarm(self, alarm, trace = None, changes = None):
+        """Shows the alarm. If changes from a merge are given, only the
+        parts showing changed fields are updated.
+        """
         self.alarm = alarm
-
+        self.paintTrace = trace
+        if trace:
+            self.update() # make sure a paint event follows
+
+        if changes is None or changes.touches(self.titleFields):
+            self.updateTitle()
+        if changes is None or changes.touches(self.locationFields):
+            self.updateLocation()
+        if changes is None or changes.touches(self.attentionFields):
+            self.updateAttention()
+        if changes is None or changes.touches(self.callerFields):
+            self.updateCaller()
+
+        if changes is None:
+            self.fallbackLabel.setText(self.alarm.fallbackStr)
+            if self.fallbackLabel.text():
+                self.fallbackLabel.show()
+            else:
+                self.fallbackLabel.hide()
+
+        if changes is None or changes.coordinates:
+            self.leftMap.invalidate()
+            self.rightMap.invalidate()
+        if changes is None or changes.touches(('lat', 'lon', 'objektnummer')):
+            self.leftMap.setObjectPlan(self.alarm.objektnummer)
+
+        if changes is None or changes.sources:
+            self.updateSources()
+
+    def updateTitle(self):
         title = self.alarm.title()
         if self.alarm.eskalation and len(self.alarm.eskalation) < 5:
             title += ' / ' + self.alarm.eskalation
@@ -246,6 +286,7 @@ class AlarmWidget(QWidget):
             pixmap = QPixmap()
         self.symbolLabel.setPixmap(pixmap)
 
+    def updateLocation(self):
         self.locationLabel.setText(self.alarm.location())
         self.locationHintLabel.setText(self.alarm.ortshinweis)
         if self.locationHintLabel.text():
@@ -259,6 +300,7 @@ class AlarmWidget(QWidget):
             pixmap = QPixmap()
         self.locationSymbolLabel.setPixmap(pixmap)
 
+    def updateAttention(self):
         self.attentionLabel.setText(self.alarm.attention())
         if self.attentionLabel.text():
             pixmap = QPixmap(os.path.join(self.imageDir,
@@ -272,6 +314,7 @@ class AlarmWidget(QWidget):
             self.attentionSymbolLabel.hide()
             self.attentionLabel.hide()
 
+    def updateCaller(self):
         self.callerLabel.setText(self.alarm.callerInfo())
         if self.callerLabel.text():
             pixmap = QPixmap(os.path.join(self.imageDir,
@@ -285,35 +328,31 @@ class AlarmWidget(QWidget):
             self.callerSymbolLabel.hide()
             self.callerLabel.hide()
 
-        self.fallbackLabel.setText(self.alarm.fallbackStr)
-        if self.fallbackLabel.text():
-            self.fallbackLabel.show()
-        else:
-            self.fallbackLabel.hide()
-
-        self.leftMap.invalidate()
-        self.leftMap.setObjectPlan(self.alarm.objektnummer)
-
-        self.rightMap.invalidate()
-
-        if 'xml' in alarm.sources:
+    def updateSources(self):
+        if 'xml' in self.alarm.sources:
             pixmap = QPixmap(os.path.join(self.imageDir, 'xml.svg'))
         else:
             pixmap = QPixmap()
         self.xmlLabel.setPixmap(pixmap)
 
-        if 'pager' in alarm.sources:
+        if 'pager' in self.alarm.sources:
             pixmap = QPixmap(os.path.join(self.imageDir, 'pager.svg'))
         else:
             pixmap = QPixmap()
         self.pagerLabel.setPixmap(pixmap)
 
-        if 'json' in alarm.sources:
+        if 'json' in self.alarm.sources:
             pixmap = QPixmap(os.path.join(self.imageDir, 'json.svg'))
         else:
             pixmap = QPixmap()
         self.jsonLabel.setPixmap(pixmap)
 
+    def paintEvent(self, event):
+        super(AlarmWidget, self).paintEvent(event)
+        if self.paintTrace:
+            self.paintTrace.mark('paint')
+            self.paintTrace = None
+
     def elapsedTimeout(self):
         pixmap = self.timerLabel.pixmap()
         if pixmap and not pixmap.isNull():
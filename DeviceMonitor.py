@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Device node monitors
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+#-----------------------------------------------------------------------------
+
+class InotifyMonitor:
+    """Reports device nodes appearing in (or changing permissions in) the
+    watched directories, e. g. when udev creates /dev/ttyUSB0.
+
+    The monitor provides a file descriptor to be used with selectors.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    eventHeader = struct.Struct('iIII') # wd, mask, cookie, len
+
+    interval = None # event driven, no polling
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                use_errno = True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = set()
+        self.watches = {} # wd -> directory
+        self.pending = set() # directories that do not exist yet
+
+    def watch(self, path):
+        self.paths.add(path)
+        self.addWatch(os.path.dirname(path))
+
+    def addWatch(self, directory):
+        if directory in self.watches.values():
+            return
+        mask = self.IN_CREATE | self.IN_ATTRIB | self.IN_MOVED_TO
+        wd = self.libc.inotify_add_watch(self.fd,
+                os.fsencode(directory), mask)
+        if wd >= 0:
+            self.watches[wd] = directory
+            self.pending.discard(directory)
+            return
+        # e. g. /dev/serial/by-id is created by udev with the first device
+        self.pending.add(directory)
+        parent = os.path.dirname(directory)
+        if parent != directory:
+            self.addWatch(parent)
+
+    def fileno(self):
+        return self.fd
+
+    def changes(self):
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            offset = 0
+            while offset + self.eventHeader.size <= len(data):
+                wd, mask, cookie, length = \
+                        self.eventHeader.unpack_from(data, offset)
+                offset += self.eventHeader.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self.watches.get(wd)
+                if directory:
+                    names.add(os.path.join(directory, os.fsdecode(name)))
+
+        # a missing parent directory may just have been created
+        rescan = bool(self.pending)
+        for directory in list(self.pending):
+            self.addWatch(directory)
+
+        return set(path for path in self.paths
+                if (rescan or path in names) and os.path.exists(path))
+
+    def close(self):
+        os.close(self.fd)
+
+#-----------------------------------------------------------------------------
+
+class PollingMonitor:
+    """Stand-in for systems without inotify (and for tests): reports watched
+    paths that appeared since the last call.
+    """
+
+    def __init__(self, interval = 1.0):
+        self.interval = interval
+        self.present = {}
+
+    def watch(self, path):
+        self.present[path] = os.path.exists(path)
+
+    def fileno(self):
+        return None
+
+    def changes(self):
+        appeared = set()
+        for path, present in self.present.items():
+            exists = os.path.exists(path)
+            if exists and not present:
+                appeared.add(path)
+            self.present[path] = exists
+        return appeared
+
+    def close(self):
+        pass
+
+#-----------------------------------------------------------------------------
+
+def createDeviceMonitor(logger):
+    try:
+        return InotifyMonitor()
+    except (OSError, AttributeError) as e:
+        logger.warning('Device events not available (%s).', e)
+        return None
+
+#-----------------------------------------------------------------------------
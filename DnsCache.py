@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# DNS cache
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import time
+import socket
+import asyncio
+
+#-----------------------------------------------------------------------------
+
+class DnsCache:
+    """Resolves host names in the background and caches their addresses.
+
+    Entries are refreshed after the TTL. If a lookup fails, the last known
+    address is kept and the lookup is retried after a shorter interval.
+    """
+
+    def __init__(self, logger, ttl = 300.0, retry = 10.0, timeout = 5.0):
+        self.logger = logger
+        self.ttl = ttl # [s]
+        self.retry = retry # [s]
+        self.timeout = timeout # [s]
+        self.addresses = {} # host -> address
+        self.refresh = {} # host -> time of the next lookup
+
+    def add(self, host):
+        self.refresh.setdefault(host, 0.0)
+
+    def lookup(self, host):
+        """Returns the cached address or None. Never blocks."""
+        return self.addresses.get(host)
+
+    async def resolve(self, host):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(loop.getaddrinfo(host, None,
+                family = socket.AF_INET, type = socket.SOCK_STREAM),
+                self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.refresh[host] = time.monotonic() + self.retry
+            address = self.addresses.get(host)
+            if address:
+                self.logger.warning('Failed to resolve %s (%s); '
+                        'keeping %s.', host, e or 'timeout', address)
+            else:
+                self.logger.warning('Failed to resolve %s: %s', host,
+                        e or 'timeout')
+            return address
+
+        address = infos[0][4][0]
+        if self.addresses.get(host) != address:
+            self.logger.info('Resolved %s to %s.', host, address)
+        self.addresses[host] = address
+        self.refresh[host] = time.monotonic() + self.ttl
+        return address
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            due = [host for host, at in self.refresh.items() if at <= now]
+            if due:
+                await asyncio.gather(*(self.resolve(host) for host in due))
+                continue
+            nextRefresh = min(self.refresh.values(), default = now + self.ttl)
+            await asyncio.sleep(nextRefresh - now)
+
+#-----------------------------------------------------------------------------
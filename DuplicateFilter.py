@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Duplicate Filter
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+import time
+import hashlib
+from collections import OrderedDict
+
+#-----------------------------------------------------------------------------
+
+class DuplicateFilter:
+    """Remembers content hashes for a time window to detect repeated
+    payloads. The number of remembered hashes is bounded.
+    """
+
+    def __init__(self, window, maxEntries = 1024):
+        self.window = window # [s]
+        self.maxEntries = maxEntries
+        self.seen = OrderedDict() # digest -> time of first occurrence
+        self.suppressed = 0
+
+    def isDuplicate(self, data, now = None):
+        if self.window <= 0:
+            return False
+
+        if now is None:
+            now = time.monotonic()
+
+        while self.seen:
+            digest, seenAt = next(iter(self.seen.items()))
+            if now - seenAt < self.window:
+                break
+            self.seen.popitem(last = False)
+
+        digest = hashlib.blake2b(data, digest_size = 16).digest()
+        if digest in self.seen:
+            self.suppressed += 1
+            return True
+
+        self.seen[digest] = now
+        if len(self.seen) > self.maxEntries:
+            self.seen.popitem(last = False)
+        return False
+
+#-----------------------------------------------------------------------------
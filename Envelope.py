@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Binary alarm envelope
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import struct
+import datetime
+
+from Alarm import EinsatzMittel, schema
+
+#-----------------------------------------------------------------------------
+#
+# An envelope carries a parsed alarm, so that receiving displays do not have
+# to parse the original payload again:
+#
+#   magic (4 bytes), version (1 byte), body length (4 bytes), body
+#
+# The body is a sequence of fields, each consisting of a field ID (1 byte),
+# a type tag (1 byte) and the value. Fields with unknown IDs are skipped.
+#
+# Artifacts computed by a master display (route, speech) use the same framing
+# with a different magic. Forwarders send empty keepalive frames on idle
+# connections, which receivers drop.
+#
+#-----------------------------------------------------------------------------
+
+MAGIC = b'\x1bALM'
+ARTIFACT_MAGIC = b'\x1bART'
+KEEPALIVE_MAGIC = b'\x1bNOP'
+VERSION = 1
+
+header = struct.Struct('!4sBI')
+
+KEEPALIVE = header.pack(KEEPALIVE_MAGIC, VERSION, 0)
+
+# Type tags
+NONE = 0
+STR = 1
+BOOL = 2
+FLOAT = 3
+BYTES = 4
+STRLIST = 5
+
+# Field IDs and alarm attributes: the envelope IDs of the alarm schema and
+# the following. IDs must never be re-used.
+fields = {
+    21: 'receiveTimeStamp',
+    22: 'source',
+    23: 'sources',
+    25: 'payload',
+    26: 'fallbackStr',
+}
+fields.update((field.envelope, field.name) for field in schema
+        if field.envelope)
+fields = dict(sorted(fields.items()))
+
+# Artifact field IDs
+artifactFields = {
+    1: 'number',
+    2: 'name', # 'route' or 'speech'
+    3: 'route', # coordinates as packed doubles (lon, lat, lon, lat, ...)
+    4: 'distance',
+    5: 'duration',
+    6: 'text',
+    7: 'audio',
+    8: 'suffix', # of the audio file
+}
+
+#-----------------------------------------------------------------------------
+
+class EnvelopeError(Exception):
+    pass
+
+#-----------------------------------------------------------------------------
+
+def packValue(out, value):
+    if value is None:
+        out.append(NONE)
+    elif isinstance(value, bool):
+        out.append(BOOL)
+        out.append(1 if value else 0)
+    elif isinstance(value, (int, float)):
+        out.append(FLOAT)
+        out += struct.pack('!d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(STR)
+        out += struct.pack('!I', len(data))
+        out += data
+    elif isinstance(value, bytes):
+        out.append(BYTES)
+        out += struct.pack('!I', len(value))
+        out += value
+    else: # sequence of strings
+        out.append(STRLIST)
+        out += struct.pack('!H', len(value))
+        for item in value:
+            data = item.encode('utf-8')
+            out += struct.pack('!I', len(data))
+            out += data
+
+def unpackValue(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    if tag == BOOL:
+        return bool(data[offset]), offset + 1
+    if tag == FLOAT:
+        return struct.unpack_from('!d', data, offset)[0], offset + 8
+    if tag == STR or tag == BYTES:
+        length = struct.unpack_from('!I', data, offset)[0]
+        offset += 4
+        value = bytes(data[offset:offset + length])
+        if len(value) != length:
+            raise EnvelopeError('Truncated field')
+        if tag == STR:
+            value = value.decode('utf-8')
+        return value, offset + length
+    if tag == STRLIST:
+        count = struct.unpack_from('!H', data, offset)[0]
+        offset += 2
+        items = []
+        for i in range(count):
+            length = struct.unpack_from('!I', data, offset)[0]
+            offset += 4
+            items.append(bytes(data[offset:offset + length]).decode('utf-8'))
+            offset += length
+        return items, offset
+    raise EnvelopeError('Unknown type tag %u' % (tag))
+
+#-----------------------------------------------------------------------------
+
+def encode(alarm):
+    body = bytearray()
+    for fieldId, name in fields.items():
+        if name == 'datetime':
+            value = alarm.datetime.isoformat() if alarm.datetime else None
+        elif name == 'sources':
+            value = sorted(alarm.sources)
+        elif name == 'einsatzmittel':
+            value = [item for em in alarm.einsatzmittel for item in em]
+        elif name == 'payload':
+            value = alarm.payload()
+        else:
+            value = getattr(alarm, name)
+        body.append(fieldId)
+        packValue(body, value)
+    return header.pack(MAGIC, VERSION, len(body)) + body
+
+def checkHeader(data, expectedMagic):
+    if len(data) < header.size:
+        raise EnvelopeError('Truncated header')
+    magic, version, length = header.unpack_from(data)
+    if magic != expectedMagic:
+        raise EnvelopeError('Invalid magic')
+    if version != VERSION:
+        raise EnvelopeError('Unsupported version %u' % (version))
+    end = header.size + length
+    if len(data) < end:
+        raise EnvelopeError('Truncated body')
+    return end
+
+def unpackFields(data, end, fieldNames):
+    offset = header.size
+    try:
+        while offset < end:
+            fieldId = data[offset]
+            value, offset = unpackValue(data, offset + 1)
+            name = fieldNames.get(fieldId)
+            if name:
+                yield name, value
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise EnvelopeError('Invalid body: %s' % (e))
+
+def isArtifact(data):
+    return data.startswith(ARTIFACT_MAGIC)
+
+def decode(data, alarm):
+    """Fills the alarm with the fields of an envelope."""
+
+    end = checkHeader(data, MAGIC)
+    payload = None
+    for name, value in unpackFields(data, end, fields):
+        if name == 'datetime':
+            if value:
+                alarm.datetime = datetime.datetime.fromisoformat(value)
+        elif name == 'sources':
+            alarm.sources = set(value)
+        elif name == 'einsatzmittel':
+            count = len(EinsatzMittel._fields)
+            alarm.einsatzmittel = set(
+                    EinsatzMittel.shared(*value[i:i + count])
+                    for i in range(0, len(value), count))
+        elif name == 'payload':
+            payload = value
+        else:
+            setattr(alarm, name, value)
+
+    # original payload, e. g. for saving and forwarding
+    if payload is None:
+        return
+    if alarm.source == 'pager':
+        alarm.pager = payload.decode('utf-8')
+    elif alarm.source == 'xml':
+        alarm.xml = payload
+    elif alarm.source == 'json':
+        alarm.json = payload
+
+#-----------------------------------------------------------------------------
+
+def encodeArtifact(number, name, **values):
+    body = bytearray()
+    values.update(number = number, name = name)
+    for fieldId, key in artifactFields.items():
+        if key not in values:
+            continue
+        value = values[key]
+        if key == 'route':
+            value = struct.pack('!%ud' % (2 * len(value)),
+                    *(c for point in value for c in point))
+        body.append(fieldId)
+        packValue(body, value)
+    return header.pack(ARTIFACT_MAGIC, VERSION, len(body)) + body
+
+def decodeArtifact(data):
+    """Returns the artifact fields as a dictionary."""
+
+    end = checkHeader(data, ARTIFACT_MAGIC)
+    artifact = {}
+    for key, value in unpackFields(data, end, artifactFields):
+        if key == 'route':
+            coords = struct.unpack('!%ud' % (len(value) // 8), value)
+            value = [list(coords[i:i + 2]) for i in range(0, len(coords), 2)]
+        artifact[key] = value
+    return artifact
+
+#-----------------------------------------------------------------------------
+
+class EnvelopeStream:
+    """Cuts complete envelopes out of a byte stream. Same interface as
+    XmlStream.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.failed = None
+
+    def feed(self, data):
+        self.data += data
+        envelopes = []
+        while not self.failed and len(self.data) >= header.size:
+            magic, version, length = header.unpack_from(self.data)
+            if magic not in (MAGIC, ARTIFACT_MAGIC, KEEPALIVE_MAGIC):
+                self.failed = 'invalid magic'
+                break
+            end = header.size + length
+            if len(self.data) < end:
+                break
+            if magic != KEEPALIVE_MAGIC:
+                envelopes.append(bytes(self.data[:end]))
+            del self.data[:end]
+        return envelopes
+
+#-----------------------------------------------------------------------------
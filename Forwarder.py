@@ -24,71 +24,465 @@
 #
 #-----------------------------------------------------------------------------
 
+import os
 import re
+import time
+import fcntl
+import struct
+import socket
+import asyncio
+import termios
+import threading
+import collections
 
-from PyQt5 import QtNetwork
+from Spool import Spool
+from DnsCache import DnsCache
+import Envelope
 
 #-----------------------------------------------------------------------------
 
 class Forwarder:
+    """Forwards alarms to other displays.
+
+    The forwarder runs on the event loop of the ingestion core. forward() may
+    be called from the GUI thread and returns immediately. Alarms forwarded
+    before the forwarder runs are spooled and sent once it runs.
+    """
 
     def __init__(self, config, logger):
-        self.hosts = []
+        self.targets = []
         self.config = config
         self.logger = logger
+        self.loop = None
+        self.lock = threading.Lock() # protects self.loop
+        self.udpTransport = None
+        self.format = 'raw'
+        self.dns = DnsCache(logger,
+                ttl = config.getfloat('forward', 'dns_ttl', fallback = 300.0))
 
         if not config.has_section('forward'):
             return
 
+        # Alarms are spooled until delivered, but not longer than max_age
+        spoolDir = config.get('forward', 'spool', fallback = None)
+        maxAge = config.getfloat('forward', 'max_age', fallback = 600.0)
+
+        self.format = config.get('forward', 'format', fallback = 'raw')
+        if self.format not in ('raw', 'envelope'):
+            self.logger.error('Unknown forward format %s.',
+                    repr(self.format))
+            self.format = 'raw'
+        if self.format != 'envelope' and \
+                config.get('cluster', 'role', fallback = '') == 'master':
+            # artifacts can only be sent in envelopes
+            self.logger.warning('Forwarding envelopes on master display.')
+            self.format = 'envelope'
+
         hostRe = re.compile('host([0-9]+)')
+        optionRe = re.compile(
+                '(port|timeout)([0-9]+)|spool|max_age|dns_ttl|format')
 
         for key, host in self.config.items('forward'):
             ma = hostRe.fullmatch(key)
             if not ma:
-                self.logger.warning('Ignoring %s.', key)
+                if not optionRe.fullmatch(key):
+                    self.logger.warning('Ignoring %s.', key)
+                continue
+
+            if not host:
                 continue
 
             num = int(ma.group(1))
             port = self.config.getint("forward", "port%u" % (num),
                     fallback = 11211)
+            timeout = self.config.getfloat("forward", "timeout%u" % (num),
+                    fallback = 5.0)
 
             self.logger.info('Adding forward %s as %s:%u', key, host, port)
+            directory = None
+            if spoolDir:
+                directory = os.path.join(spoolDir, '%s_%u' % (host, port))
+            spool = Spool(directory, logger)
+            self.dns.add(host)
+            self.targets.append(ForwardTarget(host, port, timeout, maxAge,
+                spool, self.dns, logger,
+                persistent = self.format == 'envelope'))
 
-            hostInfo = QtNetwork.QHostInfo.fromName(host)
-            if not hostInfo.addresses():
-                self.logger.warning('    Failed to find address.')
-                continue
+    async def run(self):
+        if not self.targets:
+            return
 
-            addr = hostInfo.addresses()[0]
-            self.hosts.append((host, addr, port))
+        loop = asyncio.get_running_loop()
+        self.udpTransport, protocol = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, family = socket.AF_INET)
+        with self.lock:
+            self.loop = loop
 
-            self.logger.info('   Added address %s.', addr.toString())
+        try:
+            await asyncio.gather(self.dns.run(),
+                    *(target.run(self.udpTransport) \
+                        for target in self.targets))
+        finally:
+            with self.lock:
+                self.loop = None
+                for target in self.targets:
+                    target.udpTransport = None
+            self.udpTransport.close()
+            for target in self.targets:
+                target.spool.close()
 
     def forward(self, alarm):
-        data = None
-        if alarm.source == 'pager':
-            data = alarm.pager.encode('utf-8')
-            socket = QtNetwork.QUdpSocket()
-
-            for host, addr, port in self.hosts:
-                self.logger.info('Forwarding to %s (%s:%u/udp)',
-                        host, addr.toString(), port)
-                socket.writeDatagram(data, addr, port)
+        if not self.targets:
+            return
 
+        if self.format == 'envelope':
+            data = Envelope.encode(alarm)
+            kind = Spool.STREAM
+        elif alarm.source == 'pager':
+            data = alarm.pager.encode('utf-8')
+            kind = Spool.DATAGRAM
         elif alarm.source == 'xml':
             data = alarm.xml # bytes
-            socket = QtNetwork.QTcpSocket()
-
-            for host, addr, port in self.hosts:
-                self.logger.info('Forwarding to %s (%s:%u/tcp)',
-                        host, addr.toString(), port)
-                socket.connectToHost(addr, port)
-                if not socket.waitForConnected(5000):
-                    self.logger.error('Connection failed.')
-                    continue
-                socket.writeData(data)
-                if not socket.waitForBytesWritten(5000):
-                    self.logger.error('Writing to socket failed.')
-                socket.close()
+            kind = Spool.STREAM
+        else:
+            return
+
+        self.schedule(kind, data)
+
+    def publish(self, data):
+        """Sends an artifact envelope to all targets."""
+        if not self.targets:
+            return
+
+        self.schedule(Spool.STREAM, data)
+
+    def schedule(self, kind, data):
+        with self.lock:
+            if self.loop:
+                self.loop.call_soon_threadsafe(self.send, kind, data)
+                return
+            # not running (yet); the targets send the spool when started
+            self.logger.info('Forwarder not running; spooling.')
+            self.send(kind, data)
+
+    def send(self, kind, data):
+        for target in self.targets:
+            target.send(kind, data)
+
+#-----------------------------------------------------------------------------
+
+class ForwardTarget:
+    """Delivers spooled alarms to a forward target.
+
+    Alarms are taken from the target's spool and removed only after the
+    target's TCP stack acknowledged them, so they are sent again after a
+    connection loss or a restart (at least once).
+
+    Envelopes are sent via a persistent TCP connection, that is
+    re-established in the background. Keepalive frames keep the connection
+    from hitting the target's idle timeout.
+
+    Raw XML documents are sent via one TCP connection per document, that is
+    closed after the document was acknowledged, as receivers of plain XML
+    expect.
+
+    Raw pager alarms are sent via UDP right away, independent of the TCP
+    connections, and are not spooled. This is best-effort: a datagram lost
+    on the way is not sent again. Use the envelope format for at-least-once
+    delivery of pager alarms.
+    """
+
+    # Reconnect backoff [s]
+    reconnectMin = 0.5
+    reconnectMax = 30.0
+
+    # Interval for checking the acknowledged bytes [s]
+    ackInterval = 0.05
+
+    # Interval for keepalive frames, below the receivers' idle timeout [s]
+    keepaliveInterval = 10.0
+
+    def __init__(self, host, port, timeout, maxAge, spool, dns, logger,
+            persistent = False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout # [s]
+        self.maxAge = maxAge # [s]
+        self.spool = spool
+        self.dns = dns
+        self.logger = logger
+        self.persistent = persistent # keep the connection open (envelopes)
+        self.address = None
+        self.udpTransport = None
+        self.writer = None
+        self.pending = None # set, when records are waiting (raw format)
+        self.datagrams = collections.deque() # (stamp, data) without address
+        self.resetConnectionState()
+
+    def __str__(self):
+        return '%s:%u' % (self.host, self.port)
+
+    def resetConnectionState(self):
+        self.sent = 0 # number of spool records sent on this connection
+        self.written = 0 # bytes written to this connection
+        self.marks = collections.deque() # written bytes for each record
+        self.progress = 0.0 # time of the last acknowledgement
+        self.ackHandle = None
+        self.keepaliveHandle = None
+
+    async def run(self, udpTransport):
+        self.udpTransport = udpTransport
+        if self.persistent:
+            await self.runConnection()
+        else:
+            await self.runDocuments()
+
+    async def resolve(self):
+        # the cache is refreshed in the background; only wait for the first
+        # lookup
+        self.address = self.dns.lookup(self.host)
+        if not self.address:
+            self.address = await self.dns.resolve(self.host)
+        return self.address
+
+    async def runConnection(self):
+        delay = self.reconnectMin
+
+        while True:
+            if not await self.resolve():
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnectMax)
+                continue
+
+            try:
+                reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.address, self.port),
+                        self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.warning('Connection to %s failed: %s', self,
+                        e or 'timeout')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnectMax)
+                continue
+
+            self.logger.info('Connected to %s (%s).', self, self.address)
+            delay = self.reconnectMin
+            self.writer = writer
+            self.pump()
+            self.keepaliveHandle = asyncio.get_running_loop().call_later(
+                    self.keepaliveInterval, self.keepalive)
+
+            try:
+                # targets do not send anything; wait for the connection to
+                # be closed, e. g. by the target's idle timeout
+                while await reader.read(4096):
+                    pass
+            except OSError:
+                pass
+
+            if self.ackHandle:
+                self.ackHandle.cancel()
+            self.keepaliveHandle.cancel()
+            self.writer = None
+            writer.close()
+            if self.sent:
+                self.logger.warning('Connection to %s closed with %u '
+                        'unacknowledged record(s).', self, self.sent)
+            else:
+                self.logger.info('Connection to %s closed.', self)
+            self.resetConnectionState()
+            await asyncio.sleep(self.reconnectMin)
+
+    def keepalive(self):
+        if not self.writer:
+            return
+        self.writer.write(Envelope.KEEPALIVE)
+        self.written += len(Envelope.KEEPALIVE)
+        self.keepaliveHandle = asyncio.get_running_loop().call_later(
+                self.keepaliveInterval, self.keepalive)
+
+    async def runDocuments(self):
+        delay = self.reconnectMin
+        self.pending = asyncio.Event()
+        records = self.spool.records
+
+        while True:
+            self.expire()
+            if not records and not self.datagrams:
+                self.pending.clear()
+                await self.pending.wait()
+                continue
+
+            if not await self.resolve():
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnectMax)
+                continue
+
+            self.sendDatagrams()
+            if not records:
+                continue
+
+            record = records[0]
+            if record.kind == Spool.DATAGRAM:
+                # spooled by a former version
+                self.sendDatagram(record.data)
+                self.spool.pop()
+                continue
+
+            if not await self.sendDocument(record.data):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnectMax)
+                continue
+
+            self.spool.pop()
+            delay = self.reconnectMin
+
+    async def sendDocument(self, data):
+        """Sends a document via a new connection and closes it, once the
+        target acknowledged the document.
+        """
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.address, self.port),
+                    self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.warning('Connection to %s failed: %s', self,
+                    e or 'timeout')
+            return False
+
+        self.logger.info('Forwarding to %s (%s:%u/tcp)', self.host,
+                self.address, self.port)
+        writer.write(data)
+        sock = writer.get_extra_info('socket')
+        start = time.monotonic()
+        while writer.transport.get_write_buffer_size() or \
+                unacknowledgedBytes(sock):
+            if writer.transport.is_closing() or \
+                    time.monotonic() - start > self.timeout:
+                self.logger.error('Target %s did not acknowledge data within '
+                        '%.1f s.', self, self.timeout)
+                writer.transport.abort()
+                return False
+            await asyncio.sleep(self.ackInterval)
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    def sendDatagram(self, data):
+        self.logger.info('Forwarding to %s (%s:%u/udp)', self.host,
+                self.address, self.port)
+        self.udpTransport.sendto(data, (self.address, self.port))
+
+    def sendDatagrams(self):
+        if not self.address or not self.udpTransport:
+            # sent by runDocuments() once the address is known
+            if self.pending:
+                self.pending.set()
+            return
+
+        now = time.time()
+        while self.datagrams:
+            stamp, data = self.datagrams.popleft()
+            if now - stamp > self.maxAge:
+                self.logger.error('Dropping alarm for %s: not sent within '
+                        '%u s.', self, self.maxAge)
+                continue
+            self.sendDatagram(data)
+
+    def send(self, kind, data):
+        if kind == Spool.DATAGRAM and not self.persistent:
+            # best-effort; not held back by documents waiting for delivery
+            self.datagrams.append((time.time(), data))
+            self.sendDatagrams()
+            return
+
+        self.spool.append(kind, data)
+        if not self.persistent:
+            if self.pending:
+                self.pending.set()
+        elif self.writer:
+            self.pump()
+        else:
+            self.logger.info('Not connected to %s; spooling.', self)
+
+    def expire(self):
+        records = self.spool.records
+        now = time.time()
+        while not self.sent and records and \
+                now - records[0].stamp > self.maxAge:
+            self.spool.pop()
+            self.logger.error('Dropping alarm for %s: not delivered within '
+                    '%u s.', self, self.maxAge)
+
+    def pump(self):
+        records = self.spool.records
+        self.expire()
+
+        if self.sent == len(records):
+            return
+
+        while self.sent < len(records):
+            record = records[self.sent]
+            if record.kind == Spool.DATAGRAM:
+                self.sendDatagram(record.data)
+            else:
+                self.logger.info('Forwarding to %s (%s:%u/tcp)', self.host,
+                        self.address, self.port)
+                self.writer.write(record.data)
+                self.written += len(record.data)
+            self.marks.append(self.written)
+            self.sent += 1
+
+        if not self.ackHandle:
+            self.progress = time.monotonic()
+            self.checkAcks()
+
+    def checkAcks(self):
+        self.ackHandle = None
+        if not self.writer:
+            return
+
+        transport = self.writer.transport
+        pending = transport.get_write_buffer_size() + \
+            unacknowledgedBytes(self.writer.get_extra_info('socket'))
+        acked = self.written - pending
+
+        now = time.monotonic()
+        while self.marks and self.marks[0] <= acked:
+            self.marks.popleft()
+            self.spool.pop()
+            self.sent -= 1
+            self.progress = now
+
+        if not self.marks:
+            return
+
+        if now - self.progress > self.timeout:
+            self.logger.error('Target %s did not acknowledge data within '
+                    '%.1f s; reconnecting.', self, self.timeout)
+            transport.abort()
+            return
+
+        self.ackHandle = asyncio.get_running_loop().call_later(
+                self.ackInterval, self.checkAcks)
+
+#-----------------------------------------------------------------------------
+
+def unacknowledgedBytes(sock):
+    """Returns the number of bytes in the socket's send queue, that were not
+    acknowledged by the peer yet (Linux SIOCOUTQ).
+    """
+
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ,
+                struct.pack('i', 0))
+    except (OSError, AttributeError):
+        return 0 # assume delivered once passed to the kernel
+    return struct.unpack('i', buf)[0]
 
 #-----------------------------------------------------------------------------
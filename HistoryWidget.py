@@ -33,7 +33,7 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 
 from MapWidget import MapWidget
-from Alarm import Alarm
+from Alarm import Alarm, AlarmContext
 from helpers import *
 
 #-----------------------------------------------------------------------------
@@ -162,14 +162,15 @@ class HistoryWidget(QWidget):
         paths = sorted(paths, reverse = True)
 
         self.alarms = []
+        context = AlarmContext(self.config)
         index = 0
         while index < self.historySize and len(paths) > 0:
             path = paths[0]
             paths = paths[1:]
 
-            alarm = Alarm(self.config)
+            alarm = Alarm(self.config, context = context)
             try:
-                alarm.load(path)
+                alarm.load(path, keepPayload = False)
             except Exception as e:
                 self.logger.error('History failed to load %s: %s', path, e)
                 continue
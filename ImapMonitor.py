@@ -23,9 +23,14 @@
 #
 #-----------------------------------------------------------------------------
 
+import os
 import time
+import socket
+import threading
+import json
+import base64
+import quopri
 from imapclient import IMAPClient
-import email
 
 from PyQt5 import QtCore
 
@@ -42,6 +47,21 @@ class ImapMonitor(QtCore.QObject):
         super(ImapMonitor, self).__init__()
         self.logger = logger
         self.run = True
+        self.stopEvent = threading.Event()
+        self.imap = None # current connection
+        self.exists = 0
+
+        # Re-enter IDLE before the server's 29 minute limit [s]
+        self.idleRenew = config.getint('email', 'idle_renew',
+                fallback = 25 * 60)
+        # Probe the connection with NOOP, if nothing was received [s]
+        self.keepalive = config.getint('email', 'keepalive', fallback = 120)
+        self.socketTimeout = 30
+
+        # Reconnect delay [s]
+        self.retryMin = 2
+        self.retryMax = 60
+        self.retryDelay = self.retryMin
 
         self.imapHost = config.get('email', 'imap_host', fallback = None)
         self.imapUser = config.get('email', 'imap_user', fallback = None)
@@ -63,6 +83,13 @@ class ImapMonitor(QtCore.QObject):
         if not self.imapHost or not self.imapUser or not self.imapPass:
             self.run = False
 
+        # Checkpoint of the last processed message
+        self.checkpointPath = config.get('email', 'checkpoint',
+                fallback = None)
+        self.uidValidity = None
+        self.lastUid = None
+        self.loadCheckpoint()
+
 #-----------------------------------------------------------------------------
 
     def start(self):
@@ -72,62 +99,181 @@ class ImapMonitor(QtCore.QObject):
             try:
                 self.imapCycle()
             except OSError as e:
-                self.logger.error('IMAP cycle failed: %s', e)
+                if self.run:
+                    self.logger.error('IMAP cycle failed: %s', e)
             except:
-                self.logger.error('IMAP cycle failed:', exc_info = True)
+                if self.run:
+                    self.logger.error('IMAP cycle failed:', exc_info = True)
             if self.run:
-                time.sleep(60)
+                self.logger.info('Reconnecting in %u s.', self.retryDelay)
+                self.stopEvent.wait(self.retryDelay)
+                self.retryDelay = min(self.retryDelay * 2, self.retryMax)
 
         self.logger.info(u'IMAP monitor finished.')
         self.finished.emit()
 
+    def stop(self):
+        """Stops the monitor. May be called from any thread. Interrupts
+        waiting for the server by shutting down the connection.
+        """
+        self.run = False
+        self.stopEvent.set()
+        imap = self.imap
+        if imap:
+            try:
+                imap.socket().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
 #-----------------------------------------------------------------------------
 
     def imapCycle(self):
         self.logger.info('Connecting to %s...', repr(self.imapHost))
-        imap = IMAPClient(self.imapHost)
-
+        imap = IMAPClient(self.imapHost, timeout = self.socketTimeout)
+        self.imap = imap
+        try:
+            if self.run: # not stopped while connecting
+                self.session(imap)
+        finally:
+            self.imap = None
+
+    def session(self, imap):
         self.logger.info('Logging in...')
         imap.login(self.imapUser, self.imapPass)
 
         self.logger.info('Selecting INBOX...')
         ret = imap.select_folder("INBOX")
-        num = ret[b'EXISTS']
-        self.logger.info(u'Selected mailbox with %s messages.', num)
+        self.exists = ret[b'EXISTS']
+        self.logger.info(u'Selected mailbox with %s messages.', self.exists)
+        self.retryDelay = self.retryMin
+
+        uidValidity = ret.get(b'UIDVALIDITY')
+        if self.lastUid is not None and uidValidity != self.uidValidity:
+            self.logger.warning('UIDVALIDITY changed from %s to %s; '
+                    'discarding checkpoint.', self.uidValidity, uidValidity)
+            self.lastUid = None
+        self.uidValidity = uidValidity
+
+        # Catch up with messages received while disconnected
+        self.fetchNewMails(imap)
 
         self.logger.info(u'Starting IMAP idle mode.')
+        try:
+            self.idleLoop(imap)
+        except:
+            imap.shutdown()
+            raise
+
+        imap.close()
+        imap.logout()
+
+    def idleLoop(self, imap):
         imap.idle()
+        idleStart = time.monotonic()
+        lastResponse = idleStart
 
         while self.run:
-            try:
-                # Wait for an IDLE response
-                imap.idle_check(timeout = 60 * 5)
-                # TODO: process response and stay in idle mode
-            except:
-                self.logger.error('IMAP error:', exc_info = True)
-                break
+            now = time.monotonic()
+            renewAt = idleStart + self.idleRenew
+            probeAt = lastResponse + self.keepalive
+            deadline = min(renewAt, probeAt)
+
+            responses = imap.idle_check(timeout = max(deadline - now, 0))
+            now = time.monotonic()
+            if responses:
+                lastResponse = now
+
+            if self.newMessages(responses):
+                text, responses = imap.idle_done()
+                self.newMessages(responses)
+                self.fetchNewMails(imap)
+            elif now >= renewAt:
+                # RFC 2177: servers may drop clients idling for 30 minutes
+                self.logger.debug('Renewing IMAP idle mode.')
+                text, responses = imap.idle_done()
+                if self.newMessages(responses):
+                    self.fetchNewMails(imap)
+            elif now >= probeAt or (not responses and now < deadline):
+                # nothing heard for a while, or woken up without a
+                # response (connection closed by peer): probe connection
+                self.logger.debug('Probing IMAP connection.')
+                text, responses = imap.idle_done()
+                text, noopResponses = imap.noop()
+                if self.newMessages(responses + noopResponses):
+                    self.fetchNewMails(imap)
+            else:
+                continue
 
-            imap.idle_done()
-            self.fetchNewMails(imap)
             imap.idle()
-
-        imap.close()
-        imap.logout()
+            idleStart = time.monotonic()
+            lastResponse = idleStart
+
+        imap.idle_done()
+
+    def newMessages(self, responses):
+        """Processes untagged responses. Returns True, if new messages
+        were announced.
+        """
+
+        announced = False
+        for response in responses:
+            if len(response) < 2 or not isinstance(response[0], int):
+                continue
+            if response[1] == b'EXISTS':
+                if response[0] > self.exists:
+                    announced = True
+                self.exists = response[0]
+            elif response[1] == b'EXPUNGE':
+                self.exists -= 1
+            elif response[1] == b'RECENT' and response[0] > 0:
+                announced = True
+        if announced:
+            self.logger.info('New message(s) announced.')
+        return announced
 
 #-----------------------------------------------------------------------------
 
     def fetchNewMails(self, imap):
-        messageIds = imap.search('UNSEEN')
+        if self.lastUid is None:
+            messageIds = imap.search('UNSEEN')
+        else:
+            messageIds = imap.search(['UID', '%u:*' % (self.lastUid + 1)])
+            # n:* always matches the last message, even if UID < n
+            messageIds = [uid for uid in messageIds if uid > self.lastUid]
 
         if len(messageIds) == 0:
             return
 
-        self.logger.info(u'Fetching messages %s...', messageIds)
-        messages = imap.fetch(messageIds, 'RFC822')
+        self.logger.info(u'Fetching structure of messages %s...',
+                messageIds)
+        messages = imap.fetch(messageIds, ['BODYSTRUCTURE', 'ENVELOPE'])
 
-        for messageId in messageIds:
+        for messageId in sorted(messageIds):
+            if messageId not in messages:
+                continue
             imapMessage = messages[messageId]
 
+            envelope = imapMessage.get(b'ENVELOPE')
+            if envelope:
+                if envelope.from_:
+                    self.logger.info(u'From: %s', envelope.from_[0])
+                if envelope.subject:
+                    self.logger.info(u'Subject: %s',
+                            envelope.subject.decode('utf-8', 'replace'))
+
+            parts = xmlParts(imapMessage[b'BODYSTRUCTURE'])
+            if parts:
+                self.logger.info(u'Fetching XML attachment part(s) %s...',
+                        ', '.join(section for section, encoding in parts))
+                keys = ['BODY.PEEK[%s]' % (section) \
+                        for section, encoding in parts]
+                bodies = imap.fetch([messageId], keys)[messageId]
+
+                for section, encoding in parts:
+                    key = ('BODY[%s]' % (section)).encode()
+                    xmlContent = decodePart(bodies[key], encoding)
+                    self.receivedAlarm.emit(xmlContent)
+
             try:
                 imap.set_flags(messageId, '\\Seen')
                 self.logger.info(u'Marked message as seen.')
@@ -135,28 +281,88 @@ class ImapMonitor(QtCore.QObject):
                 self.logger.error(u'Failed to mark message as seen:',
                         exc_info = True)
 
-            content = imapMessage[b'RFC822']
-
-            msg = email.message_from_bytes(content)
+            self.lastUid = messageId
+            self.saveCheckpoint()
 
-            if 'From' in msg:
-                self.logger.info(u'From: %s', msg['From'])
-
-            if 'subject' in msg:
-                self.logger.info(u'Subject: %s', msg['subject'])
+#-----------------------------------------------------------------------------
 
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                if part.get('Content-Disposition') is None:
-                    continue
+    def loadCheckpoint(self):
+        if not self.checkpointPath or not os.path.exists(self.checkpointPath):
+            return
+        try:
+            f = open(self.checkpointPath, 'r')
+            checkpoint = json.load(f)
+            f.close()
+            self.uidValidity = checkpoint['uidvalidity']
+            self.lastUid = checkpoint['last_uid']
+        except:
+            self.logger.error('Failed to load IMAP checkpoint:',
+                    exc_info = True)
+            return
+        self.logger.info('Continuing after UID %s.', self.lastUid)
 
-                fileName = part.get_filename()
+    def saveCheckpoint(self):
+        if not self.checkpointPath:
+            return
+        checkpoint = {
+                'uidvalidity': self.uidValidity,
+                'last_uid': self.lastUid,
+                }
+        tmpPath = self.checkpointPath + '.tmp'
+        try:
+            f = open(tmpPath, 'w')
+            json.dump(checkpoint, f)
+            f.close()
+            os.replace(tmpPath, self.checkpointPath)
+        except:
+            self.logger.error('Failed to save IMAP checkpoint:',
+                    exc_info = True)
 
-                if fileName is None or not fileName.endswith('xml'):
-                    continue
+#-----------------------------------------------------------------------------
 
-                xmlContent = part.get_payload(decode = True)
-                self.receivedAlarm.emit(xmlContent)
+def xmlParts(structure, section = ''):
+    """Returns (section, encoding) tuples of all XML attachments in a
+    BODYSTRUCTURE response.
+    """
+
+    if not structure.is_multipart:
+        if partFileName(structure).lower().endswith('xml'):
+            return [(section or '1', structure[5])]
+        return []
+
+    parts = []
+    for index, part in enumerate(structure[0], 1):
+        if section:
+            child = '%s.%u' % (section, index)
+        else:
+            child = str(index)
+        parts.extend(xmlParts(part, child))
+    return parts
+
+def partFileName(part):
+    # The disposition follows the extension data, its position depends on
+    # the media type. Only attachments with a disposition are considered.
+    for field in part[7:]:
+        if isinstance(field, tuple) and len(field) == 2 and \
+                isinstance(field[1], tuple):
+            fileName = paramValue(field[1], b'FILENAME')
+            if not fileName and isinstance(part[2], tuple):
+                fileName = paramValue(part[2], b'NAME')
+            return fileName
+    return ''
+
+def paramValue(params, name):
+    for key, value in zip(params[::2], params[1::2]):
+        if key.upper() == name and value:
+            return value.decode('utf-8', 'replace')
+    return ''
+
+def decodePart(data, encoding):
+    encoding = (encoding or b'').upper()
+    if encoding == b'BASE64':
+        return base64.b64decode(data)
+    if encoding == b'QUOTED-PRINTABLE':
+        return quopri.decodestring(data)
+    return data
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Ingestion core
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import asyncio
+import collections
+
+from PyQt5 import QtCore
+
+from AlarmReceiver import AlarmReceiver
+from WebsocketReceiver import WebsocketReceiver
+from SocketListener import SocketListener
+from DuplicateFilter import DuplicateFilter
+from Latency import LatencyTrace
+
+#-----------------------------------------------------------------------------
+
+class IngestCore(QtCore.QObject):
+    """Hosts all alarm sources on a single asyncio event loop.
+
+    The core is moved to its own QThread and runs the loop there. The
+    sources are connected directly, so that their payloads are filtered in
+    the core thread (the IMAP monitor's worker thread hands them over to the
+    loop). They are passed to the GUI thread via the received signal,
+    together with a LatencyTrace started at receipt:
+
+    - 'pager': (pager string, device or None)
+    - 'xml': (XML document as bytes, 'imap' or None for the socket)
+    - 'envelope': parsed alarm forwarded by another display (see Envelope)
+    - 'websocket': (frame as bytes, alarm dictionary)
+    - 'status': status dictionary
+    """
+
+    received = QtCore.pyqtSignal(str, object, object) # kind, payload, trace
+    errorMessage = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, config, logger, monitor = None):
+        super(IngestCore, self).__init__()
+        self.logger = logger
+        self.loop = None
+        self.stopped = None
+        self.services = []
+
+        # Payloads delivered per kind and time of the last delivery
+        self.counts = collections.Counter()
+        self.lastReceived = {}
+
+        # The same alarm often arrives via several sources (e. g. serial
+        # pager and a forwarded copy). Identical payloads are dropped before
+        # they are parsed.
+        self.duplicateFilter = DuplicateFilter(config.getfloat('ingest',
+            'duplicate_window', fallback = 60.0))
+
+        # Without a direct connection, the slots would be invoked in the
+        # thread the core was created in.
+        direct = QtCore.Qt.DirectConnection
+
+        self.alarmReceiver = AlarmReceiver(config, logger, monitor)
+        self.alarmReceiver.receivedAlarm.connect(self.pagerAlarm, direct)
+        self.alarmReceiver.errorMessage.connect(self.errorMessage)
+
+        self.socketListener = SocketListener(config, logger)
+        self.socketListener.pagerAlarm.connect(
+                lambda pagerStr: self.deliver('pager', (pagerStr, None)),
+                direct)
+        self.socketListener.xmlAlarm.connect(
+                lambda data: self.deliver('xml', (data, None)), direct)
+        self.socketListener.envelope.connect(
+                lambda data: self.deliver('envelope', data), direct)
+
+        self.websocketReceiver = WebsocketReceiver(config, logger)
+        self.websocketReceiver.receivedAlarm.connect(
+                lambda frame, data: self.deliver('websocket', (frame, data)),
+                direct)
+        self.websocketReceiver.receivedStatus.connect(
+                lambda data: self.deliver('status', data), direct)
+
+        self.imapMonitor = None
+        if config.has_section('email') and \
+                config.get("email", "imap_host", fallback = ''):
+            from ImapMonitor import ImapMonitor
+            self.imapMonitor = ImapMonitor(config, logger)
+            self.imapMonitor.receivedAlarm.connect(
+                    lambda data: self.loop.call_soon_threadsafe(
+                        self.deliver, 'xml', (data, 'imap')), direct)
+
+    def addService(self, coroutineFunction):
+        """Runs a coroutine function on the core's event loop, e. g. for
+        outgoing connections. Must be called before the core is started.
+        """
+        self.services.append(coroutineFunction)
+
+    def pagerAlarm(self, pagerStr, device):
+        self.deliver('pager', (pagerStr, device))
+
+    def deliver(self, kind, payload):
+        trace = LatencyTrace()
+        raw = rawPayload(kind, payload)
+        if raw is not None and self.duplicateFilter.isDuplicate(raw):
+            self.logger.info('Dropping duplicate %s payload.', kind)
+            self.counts['duplicate'] += 1
+            return
+        self.counts[kind] += 1
+        self.lastReceived[kind] = trace.wallTime
+        self.received.emit(kind, payload, trace)
+
+    def metrics(self):
+        return dict(self.counts)
+
+    def start(self):
+        self.logger.info('Ingestion core started.')
+        asyncio.run(self.run())
+        self.logger.info('Ingestion core finished.')
+        self.finished.emit()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        await self.socketListener.start()
+
+        tasks = [
+            asyncio.ensure_future(self.alarmReceiver.run()),
+            asyncio.ensure_future(self.websocketReceiver.run()),
+            ]
+        for service in self.services:
+            tasks.append(asyncio.ensure_future(service()))
+        if self.imapMonitor:
+            # imapclient is blocking, so the monitor keeps a worker thread
+            tasks.append(self.loop.run_in_executor(None,
+                self.imapMonitor.start))
+
+        await self.stopped.wait()
+
+        self.socketListener.close()
+        if self.imapMonitor:
+            self.imapMonitor.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+    def stop(self):
+        """Stops the event loop. May be called from any thread."""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+#-----------------------------------------------------------------------------
+
+def rawPayload(kind, payload):
+    """Returns the bytes to detect duplicates by, or None for payloads that
+    shall never be dropped.
+    """
+
+    if kind == 'pager':
+        return payload[0].encode('utf-8') # same for serial and UDP
+    if kind in ('xml', 'websocket'):
+        return payload[0] # same for socket and IMAP, frame
+    if kind == 'envelope':
+        return payload
+    return None # status updates may repeat
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# JSON codec
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import json
+
+try:
+    import orjson # optional, faster
+except ImportError:
+    orjson = None
+
+#-----------------------------------------------------------------------------
+
+def loads(data):
+    """Decodes JSON from bytes or str."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(value):
+    """Encodes a value as UTF-8 JSON bytes."""
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value).encode('utf-8')
+
+#-----------------------------------------------------------------------------
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Alarm latency statistics
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import time
+import collections
+
+#-----------------------------------------------------------------------------
+
+# Processing stages of an alarm in chronological order
+STAGES = ('receipt', 'parse', 'merge', 'paint', 'route', 'tts', 'report',
+        'print')
+
+#-----------------------------------------------------------------------------
+
+class LatencyTrace:
+    """Monotonic time stamps of the processing stages of a received alarm.
+    """
+
+    def __init__(self):
+        self.wallTime = time.time() # time of receipt
+        self.marks = {'receipt': time.monotonic()}
+
+    def mark(self, stage):
+        # a stage may be passed several times; only the first one counts
+        self.marks.setdefault(stage, time.monotonic())
+
+    def elapsed(self, stage):
+        """Returns the time from receipt to the given stage [s] or None."""
+        if stage not in self.marks:
+            return None
+        return self.marks[stage] - self.marks['receipt']
+
+    def __str__(self):
+        return ', '.join('%s %.1f' % (stage, self.elapsed(stage) * 1e3)
+                for stage in STAGES[1:] if stage in self.marks)
+
+#-----------------------------------------------------------------------------
+
+class LatencyStats:
+    """Ring buffer of the traces of the last alarms."""
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, size = 256):
+        self.traces = collections.deque(maxlen = size)
+
+    def add(self, trace):
+        self.traces.append(trace)
+
+    def summary(self):
+        """Returns the percentiles of the latency from receipt for every
+        stage as dictionary: stage -> (count, p50, p90, p99, max) [s]
+        """
+        ret = {}
+        for stage in STAGES[1:]:
+            values = sorted(v for v in (t.elapsed(stage) \
+                    for t in self.traces) if v is not None)
+            if not values:
+                continue
+            row = [len(values)]
+            for p in self.percentiles:
+                index = min(int(len(values) * p / 100), len(values) - 1)
+                row.append(values[index])
+            row.append(values[-1])
+            ret[stage] = tuple(row)
+        return ret
+
+    def log(self, logger, number, trace):
+        logger.info('Latency of alarm %s [ms]: %s', number, trace)
+
+    def logSummary(self, logger):
+        for stage, row in self.summary().items():
+            logger.info('Latency %-6s [ms] n=%u p50 %.1f p90 %.1f p99 %.1f '
+                    'max %.1f', stage, row[0], *(v * 1e3 for v in row[1:]))
+
+#-----------------------------------------------------------------------------
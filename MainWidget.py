@@ -36,13 +36,14 @@ from PyQt5.QtCore import *
 from IdleWidget import IdleWidget
 from AlarmWidget import AlarmWidget
 from Map import getRoute
-from AlarmReceiver import AlarmReceiver
-from WebsocketReceiver import WebsocketReceiver
-from SocketListener import SocketListener
+from IngestCore import IngestCore
 from AlarmReport import AlarmReport
 from CecCommand import CecCommand
-from Alarm import Alarm, EinsatzMittel
+from Alarm import Alarm, AlarmContext, EinsatzMittel
 from Forwarder import Forwarder
+from DuplicateFilter import DuplicateFilter
+import Envelope
+from Latency import LatencyStats
 from Notifier import Notifier
 from Sound import Sound
 from GpioControl import GpioControl
@@ -69,12 +70,32 @@ class MainWidget(QWidget):
         self.seenJson = False
         self.reportDone = False
         self.alarmDateTime = None
+        self.alarmContext = AlarmContext(config)
         self.forwarder = Forwarder(config, logger)
+        # Alarms replayed by forwarders are processed only once
+        self.replayFilter = DuplicateFilter(config.getfloat("socket",
+            "replay_window", fallback = 3600.0))
         self.notifier = Notifier(config, logger)
         self.sound = Sound(config, logger)
         self.gpioControl = GpioControl(config, logger)
         self.tts = TextToSpeech(config, logger)
 
+        # Master displays share routes and speech with slave displays
+        self.role = self.config.get("cluster", "role",
+                fallback = "standalone")
+        if self.role not in ('standalone', 'master', 'slave'):
+            self.logger.error('Unknown cluster role %s.', repr(self.role))
+            self.role = 'standalone'
+        self.speechReceived = False
+        self.latency = LatencyStats()
+
+        self.artifactTimer = QTimer(self)
+        self.artifactTimer.setInterval( \
+            self.config.getint("cluster", "artifact_timeout",
+                fallback = 10) * 1000)
+        self.artifactTimer.setSingleShot(True)
+        self.artifactTimer.timeout.connect(self.artifactTimeout)
+
         self.reportTimer = QTimer(self)
         self.reportTimer.setInterval( \
             self.config.getint("report", "timeout", fallback = 60) * 1000)
@@ -238,46 +259,21 @@ class MainWidget(QWidget):
 
         # Threads ------------------------------------------------------------
 
-        self.receiverThread = QThread()
-        self.alarmReceiver = AlarmReceiver(self.config, self.logger)
-        self.alarmReceiver.receivedAlarm.connect(self.receivedPagerAlarm)
-        self.alarmReceiver.finished.connect(self.receiverThread.quit)
-        self.alarmReceiver.errorMessage.connect(self.receiverError)
-        self.alarmReceiver.moveToThread(self.receiverThread)
-        self.receiverThread.started.connect(self.alarmReceiver.receive)
-        self.receiverThread.start()
-
-        self.websocketReceiverThread = QThread()
-        self.websocketReceiver = WebsocketReceiver(self.config, self.logger)
-        self.websocketReceiver.receivedAlarm.connect( \
-                self.receivedWebsocketAlarm)
-        self.websocketReceiver.finished.connect( \
-                self.websocketReceiverThread.quit)
-        self.websocketReceiver.moveToThread(self.websocketReceiverThread)
-        self.websocketReceiverThread.started.connect( \
-                self.websocketReceiver.receive)
-        self.websocketReceiverThread.start()
-
-        if self.websocketReceiver.status:
+        self.ingestThread = QThread()
+        self.ingestCore = IngestCore(self.config, self.logger)
+        self.ingestCore.received.connect(self.receivedPayload)
+        self.ingestCore.errorMessage.connect(self.receiverError)
+        self.ingestCore.finished.connect(self.ingestThread.quit)
+        self.ingestCore.addService(self.forwarder.run)
+        self.ingestCore.moveToThread(self.ingestThread)
+        self.ingestThread.started.connect(self.ingestCore.start)
+
+        self.statusWidget = None
+        if self.ingestCore.websocketReceiver.status:
             self.statusWidget = StatusWidget(self)
             layout.addWidget(self.statusWidget)
-            self.websocketReceiver.receivedStatus.connect( \
-                    self.statusWidget.setStatus)
-
-        if self.config.has_section('email') and \
-                self.config.get("email", "imap_host", fallback = ''):
-            from ImapMonitor import ImapMonitor
-            self.imapThread = QThread()
-            self.imapMonitor = ImapMonitor(self.config, self.logger)
-            self.imapMonitor.receivedAlarm.connect(self.receivedXmlAlarm)
-            self.imapMonitor.moveToThread(self.imapThread)
-            self.imapMonitor.finished.connect(self.imapThread.quit)
-            self.imapThread.started.connect(self.imapMonitor.start)
-            self.imapThread.start()
-
-        self.socketListener = SocketListener(self.logger)
-        self.socketListener.pagerAlarm.connect(self.receivedPagerAlarm)
-        self.socketListener.xmlAlarm.connect(self.receivedXmlAlarm)
+
+        self.ingestThread.start()
 
         self.cecThread = QThread()
         self.cecThread.start()
@@ -359,18 +355,44 @@ class MainWidget(QWidget):
 
     #-------------------------------------------------------------------------
 
-    def receivedPagerAlarm(self, pagerStr):
-        self.logger.info('Received pager alarm: %s', repr(pagerStr))
+    def receivedPayload(self, kind, payload, trace = None):
+        if kind == 'pager':
+            pagerStr, device = payload
+            self.receivedPagerAlarm(pagerStr, device, trace)
+        elif kind == 'xml':
+            xmlContent, origin = payload
+            self.receivedXmlAlarm(xmlContent, origin, trace)
+        elif kind == 'websocket':
+            self.receivedWebsocketAlarm(payload, trace)
+        elif kind == 'envelope':
+            self.receivedEnvelope(payload, trace)
+        elif kind == 'status':
+            if self.statusWidget: # no status addresses configured
+                self.statusWidget.setStatus(payload)
+        else:
+            self.logger.error('Unknown payload kind %s.', repr(kind))
+
+    #-------------------------------------------------------------------------
+
+    def receivedPagerAlarm(self, pagerStr, device = None, trace = None):
+        if device:
+            self.logger.info('Received pager alarm from %s: %s', device,
+                    repr(pagerStr))
+        else:
+            self.logger.info('Received pager alarm: %s', repr(pagerStr))
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, trace = trace,
+                context = self.alarmContext)
         alarm.fromPager(pagerStr, self.logger)
+        alarm.mark('parse')
 
         try:
             self.notifier.pager(pagerStr)
         except:
             self.logger.error('Pager notification failed:', exc_info = True)
 
-        self.processAlarm(alarm)
+        # UDP datagrams may be copies replayed by a forwarding display
+        self.processAlarm(alarm, forwarded = device is None)
 
     #-------------------------------------------------------------------------
 
@@ -379,10 +401,12 @@ class MainWidget(QWidget):
 
     #-------------------------------------------------------------------------
 
-    def receivedWebsocketAlarm(self, data):
+    def receivedWebsocketAlarm(self, payload, trace = None):
+        frame, data = payload # the frame is only used to detect duplicates
         self.logger.info('Received websocket alarm: %s', repr(data))
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, trace = trace,
+                context = self.alarmContext)
 
         try:
             alarm.fromAlamos(data, self.logger)
@@ -390,27 +414,108 @@ class MainWidget(QWidget):
             self.logger.error('Failed to process websocket alarm:',
                     exc_info = True)
             return
+        alarm.mark('parse')
 
         self.processAlarm(alarm)
 
     #-------------------------------------------------------------------------
 
-    def receivedXmlAlarm(self, xmlContent):
-        self.logger.info('Received XML alarm.')
+    def receivedXmlAlarm(self, xmlContent, origin = None, trace = None):
+        if origin:
+            self.logger.info('Received XML alarm via %s.', origin)
+        else:
+            self.logger.info('Received XML alarm.')
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, trace = trace,
+                context = self.alarmContext)
 
         try:
             alarm.fromXml(xmlContent, self.logger)
         except:
             self.logger.error('Failed to parse XML:', exc_info = True)
             return
+        alarm.mark('parse')
 
-        self.processAlarm(alarm)
+        # documents from TCP clients may be copies replayed by a forwarding
+        # display
+        self.processAlarm(alarm, forwarded = origin is None)
 
     #-------------------------------------------------------------------------
 
-    def processAlarm(self, newAlarm):
+    def receivedEnvelope(self, data, trace = None):
+        if Envelope.isArtifact(data):
+            self.receivedArtifact(data)
+            return
+
+        self.logger.info('Received forwarded alarm.')
+
+        alarm = Alarm(self.config, trace = trace,
+                context = self.alarmContext)
+
+        try:
+            Envelope.decode(data, alarm)
+        except Envelope.EnvelopeError as e:
+            self.logger.error('Failed to decode envelope: %s', e)
+            return
+        alarm.mark('parse')
+
+        self.processAlarm(alarm, forwarded = True)
+
+    #-------------------------------------------------------------------------
+
+    def receivedArtifact(self, data):
+        try:
+            artifact = Envelope.decodeArtifact(data)
+        except Envelope.EnvelopeError as e:
+            self.logger.error('Failed to decode artifact: %s', e)
+            return
+
+        number = artifact.get('number')
+        name = artifact.get('name')
+        if not self.alarm or not self.alarm.matchesNumber(number):
+            self.logger.info('Ignoring %s artifact for alarm %s.', name,
+                    number)
+            return
+
+        self.logger.info('Received %s artifact from master.', name)
+        if name == 'route':
+            self.route = (artifact.get('route', []),
+                    artifact.get('distance'), artifact.get('duration'))
+            self.alarmWidget.setRoute(self.route)
+            self.alarm.mark('route')
+        elif name == 'speech':
+            if self.tts.setAudio(artifact['audio'],
+                    artifact.get('suffix', '.mp3')):
+                self.speechReceived = True
+                self.alarm.mark('tts')
+
+        routeDone = self.route[0] or not (self.alarm.lat and self.alarm.lon)
+        if routeDone and self.speechReceived:
+            self.artifactTimer.stop() # nothing left to compute locally
+
+    def artifactTimeout(self):
+        if not self.alarm:
+            return
+        self.logger.warning('Master did not deliver artifacts in time; '
+                'computing locally.')
+        self.alarmWidget.setHourGlass(True)
+        if not self.route[0]:
+            self.queryRoute()
+        if self.updateSpeech():
+            self.alarm.mark('tts')
+        self.alarmWidget.setHourGlass(False)
+
+    #-------------------------------------------------------------------------
+
+    def processAlarm(self, newAlarm, forwarded = False):
+
+        if forwarded:
+            key = (newAlarm.number or '').encode('utf-8') + b'\0' + \
+                    newAlarm.payload()
+            if self.replayFilter.isDuplicate(key):
+                self.logger.info('Ignoring alarm %s received before.',
+                        newAlarm.number)
+                return
 
         self.alarmWidget.setHourGlass(True)
 
@@ -424,6 +529,7 @@ class MainWidget(QWidget):
         except:
             self.logger.error('Failed to forward alarm:', exc_info = True)
 
+        changes = None # everything is new
         if not self.alarm or not self.alarm.matches(newAlarm):
             self.logger.info("Processing new alarm.")
             self.startTimer()
@@ -433,14 +539,22 @@ class MainWidget(QWidget):
             self.seenXml = False
             self.seenJson = False
             self.reportDone = False
-            self.reportTimer.start()
+            self.speechReceived = False
+            if self.role == 'slave':
+                self.artifactTimer.start()
+            else:
+                self.reportTimer.start()
             self.sound.start()
             self.tts.clear()
             self.tts.start()
             self.gpioControl.trigger()
-            self.report.wakeupPrinter()
+            if self.role != 'slave':
+                self.report.wakeupPrinter()
         else:
-            self.alarm.merge(newAlarm, self.logger)
+            changes = self.alarm.merge(newAlarm, self.logger)
+            if changes.coordinates:
+                self.route = ([], None, None) # leads to the old destination
+        newAlarm.mark('merge')
 
         if newAlarm.source == 'pager':
             self.seenPager = True
@@ -452,21 +566,24 @@ class MainWidget(QWidget):
 
         self.idleWidget.stop()
         self.stackedWidget.setCurrentWidget(self.alarmWidget)
-        self.alarmWidget.processAlarm(self.alarm)
+        self.alarmWidget.processAlarm(self.alarm, newAlarm.trace, changes)
 
         QApplication.processEvents()
 
-        self.alarmWidget.setRoute(self.route)
-
-        if not self.route[0]:
-            QApplication.processEvents()
-            self.logger.info('Route query...')
-            self.route = getRoute(self.alarm.lat, self.alarm.lon, self.config,
-                    self.logger)
+        if changes is None or changes.coordinates:
             self.alarmWidget.setRoute(self.route)
-            self.logger.info('Route ready.')
 
-        self.tts.setText(self.alarm.spoken())
+        if not self.route[0] and self.alarm.lat and self.alarm.lon:
+            if self.artifactTimer.isActive():
+                self.logger.info('Waiting for route from master.')
+            else:
+                QApplication.processEvents()
+                self.queryRoute()
+                newAlarm.mark('route')
+
+        if changes is None or changes.touches(Alarm.spokenFields):
+            if self.updateSpeech():
+                newAlarm.mark('tts')
 
         if (self.seenJson or (self.seenPager and self.seenXml)) \
                 and not self.reportDone:
@@ -476,11 +593,53 @@ class MainWidget(QWidget):
 
         self.alarmWidget.setHourGlass(False)
 
+        if newAlarm.trace:
+            self.latency.add(newAlarm.trace)
+            self.latency.log(self.logger, newAlarm.number, newAlarm.trace)
+
+    def queryRoute(self):
+        self.logger.info('Route query...')
+        self.route = getRoute(self.alarm.lat, self.alarm.lon, self.config,
+                self.logger)
+        self.alarmWidget.setRoute(self.route)
+        self.logger.info('Route ready.')
+
+        if self.role == 'master' and self.route[0]:
+            route, distance, duration = self.route
+            self.forwarder.publish(Envelope.encodeArtifact(self.alarm.number,
+                'route', route = route, distance = distance,
+                duration = duration))
+
+    def updateSpeech(self):
+        """Generates the speech for the current alarm. Returns True, if audio
+        was generated.
+        """
+        if self.role == 'slave' and \
+                (self.artifactTimer.isActive() or self.speechReceived):
+            return False # speech is generated by the master
+
+        text = self.alarm.spoken()
+        generated = self.tts.setText(text)
+
+        # on failure, the audio file may still hold a former text
+        if generated and self.role == 'master':
+            audio = self.tts.audio()
+            if audio:
+                self.forwarder.publish(Envelope.encodeArtifact(
+                    self.alarm.number, 'speech', text = text,
+                    audio = audio[0], suffix = audio[1]))
+
+        return generated
+
     def generateReport(self):
         if self.reportDone:
             self.logger.info('Report already done.')
             return
 
+        if self.role == 'slave':
+            self.logger.info('Report is generated by the master display.')
+            return
+
         self.reportDone = True
         self.alarmWidget.setHourGlass(True)
 
@@ -491,6 +650,10 @@ class MainWidget(QWidget):
             self.logger.error('Report failed:', exc_info = True)
             self.reportDone = False
 
+        if self.alarm.trace:
+            self.latency.log(self.logger, self.alarm.number, self.alarm.trace)
+        self.latency.logSummary(self.logger)
+
         self.logger.info('Finished.')
         self.alarmWidget.setHourGlass(False)
 
@@ -517,7 +680,7 @@ class MainWidget(QWidget):
     #-------------------------------------------------------------------------
 
     def exampleJugend(self):
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.source = 'xml'
         alarm.sources.add(alarm.source)
         alarm.number = '40001'
@@ -539,7 +702,7 @@ class MainWidget(QWidget):
         self.processAlarm(alarm)
 
     def exampleEngels(self):
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.source = 'xml'
         alarm.sources.add(alarm.source)
         alarm.number = '40002'
@@ -564,7 +727,7 @@ class MainWidget(QWidget):
     def exampleSack(self):
         self.logger.info('Example Sackstrasse')
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.source = 'xml'
         alarm.sources.add(alarm.source)
         alarm.number = '40003'
@@ -589,14 +752,14 @@ class MainWidget(QWidget):
             ' #K01;N5175638E0611815; *40004*B2 Kaminbrand**Kleve*' + \
             'Reichswalde*Wolfsgraben*11**'
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.fromPager(pagerStr, self.logger)
 
         self.processAlarm(alarm)
 
     def exampleWolfsgrabenMail(self):
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.source = 'xml'
         alarm.sources.add(alarm.source)
         now = datetime.datetime.now()
@@ -629,7 +792,7 @@ class MainWidget(QWidget):
             'Eichhörnchen auf Baum*Kleve*Reichswalde*' + \
             'Grunewaldstrasse***Waldweg C'
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.fromPager(pagerStr, self.logger)
 
         self.processAlarm(alarm)
@@ -640,7 +803,7 @@ class MainWidget(QWidget):
             ' #K01;N5179473E0613985; *40006*B3 Brand Bürogebäude*' + \
             'Stadtwerke Kleve GmbH*Kleve*Kleve*Flutstraße*36**'
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.fromPager(pagerStr, self.logger)
 
         self.processAlarm(alarm)
@@ -652,7 +815,7 @@ class MainWidget(QWidget):
             ' **Kleve*Materborn*Dorfstrasse*27*KLV 02/103' + \
             '*Materborner Allee - Saalstrasse'
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
         alarm.fromPager(pagerStr, self.logger)
 
         self.processAlarm(alarm)
@@ -663,7 +826,7 @@ class MainWidget(QWidget):
         xmlContent = f.read()
         f.close()
 
-        alarm = Alarm(self.config)
+        alarm = Alarm(self.config, context = self.alarmContext)
 
         try:
             alarm.fromXml(xmlContent, self.logger)
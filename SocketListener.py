@@ -23,8 +23,13 @@
 #
 #-----------------------------------------------------------------------------
 
+import asyncio
+import xml.parsers.expat
+
 from PyQt5 import QtCore
-from PyQt5 import QtNetwork
+
+from DuplicateFilter import DuplicateFilter
+import Envelope
 
 #-----------------------------------------------------------------------------
 
@@ -32,51 +37,252 @@ class SocketListener(QtCore.QObject):
 
     pagerAlarm = QtCore.pyqtSignal(str)
     xmlAlarm = QtCore.pyqtSignal(bytes)
+    envelope = QtCore.pyqtSignal(bytes)
 
-    def __init__(self, logger):
+    def __init__(self, config, logger):
         super(SocketListener, self).__init__()
         self.logger = logger
 
-        self.udpSocket = QtNetwork.QUdpSocket(self)
-        self.udpSocket.bind(QtNetwork.QHostAddress.Any, 11211)
-        self.udpSocket.readyRead.connect(self.readUdpSocket)
+        self.maxPayload = config.getint("socket", "max_payload",
+                fallback = 1024) * 1024
+        self.idleTimeout = config.getint("socket", "idle_timeout",
+                fallback = 30)
+        self.udpFilter = DuplicateFilter(config.getfloat("socket",
+            "duplicate_window", fallback = 2.0))
+
+        self.port = config.getint("socket", "port", fallback = 11211)
+
+        self.udpTransport = None
+        self.tcpServer = None
+        self.tcpClients = set()
+        self.datagrams = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
 
-        self.tcpServer = QtNetwork.QTcpServer(self)
-        self.tcpServer.listen(QtNetwork.QHostAddress.Any, 11211)
-        self.tcpServer.newConnection.connect(self.tcpConnection)
+        try:
+            self.udpTransport, protocol = \
+                    await loop.create_datagram_endpoint(
+                            lambda: UdpProtocol(self),
+                            local_addr = ('0.0.0.0', self.port))
+        except OSError as e:
+            self.logger.error('Failed to bind UDP port %u: %s', self.port, e)
 
-        self.tcpConnection = None
-        self.tcpData = b''
+        try:
+            self.tcpServer = await loop.create_server(
+                    lambda: TcpClient(self), port = self.port,
+                    reuse_address = True)
+        except OSError as e:
+            self.logger.error('Failed to listen on TCP port %u: %s',
+                    self.port, e)
 
-    def readUdpSocket(self):
-        self.logger.info('Datagram received.')
-        while self.udpSocket.hasPendingDatagrams():
-            size = self.udpSocket.pendingDatagramSize()
-            (data, host, port) = self.udpSocket.readDatagram(size)
-            self.logger.info("Received from %s:%i", host.toString(), port)
-            pagerStr = data.decode('utf-8')
+    def close(self):
+        if self.udpTransport:
+            self.udpTransport.close()
+            self.udpTransport = None
+        if self.tcpServer:
+            self.tcpServer.close()
+            self.tcpServer = None
+        for client in list(self.tcpClients):
+            client.transport.abort()
+
+    def datagramReceived(self, data, addr):
+        # process all datagrams read in this loop iteration at once
+        if not self.datagrams:
+            asyncio.get_running_loop().call_soon(self.readDatagrams)
+        self.datagrams.append((data, addr))
+
+    def readDatagrams(self):
+        datagrams = self.datagrams
+        self.datagrams = []
+
+        self.logger.info('%u datagram(s) received.', len(datagrams))
+
+        duplicates = 0
+        for data, addr in datagrams:
+            if self.udpFilter.isDuplicate(data):
+                duplicates += 1
+                continue
+            self.logger.info("Received from %s:%i", addr[0], addr[1])
+            try:
+                pagerStr = data.decode('utf-8')
+            except UnicodeDecodeError as e:
+                self.logger.error('Invalid datagram from %s:%i: %s',
+                        addr[0], addr[1], e)
+                continue
             self.pagerAlarm.emit(pagerStr)
 
-    def tcpConnection(self):
-        self.logger.info('New connection from TCP client.')
-        if self.tcpConnection:
-            self.tcpConnection.disconnectFromHost()
-        self.tcpConnection = self.tcpServer.nextPendingConnection()
-        self.tcpConnection.readyRead.connect(self.tcpReadyRead)
-        self.tcpConnection.disconnected.connect(self.tcpDisconnected)
-        self.tcpConnection.error.connect(self.tcpError)
-        self.tcpData = b''
-
-    def tcpReadyRead(self):
-        self.tcpData += self.tcpConnection.readAll().data()
-
-    def tcpDisconnected(self):
-        self.xmlAlarm.emit(self.tcpData)
-        self.logger.info('Closing connection to TCP client.')
-        self.tcpConnection = None
-        self.tcpData = b''
-
-    def tcpError(self):
-        self.tcpConnection.close()
+        if duplicates:
+            self.logger.info('Suppressed %u duplicate datagram(s) '
+                    '(%u in total).', duplicates, self.udpFilter.suppressed)
+
+    def tcpConnection(self, client):
+        self.tcpClients.add(client)
+        self.logger.info('New connection from TCP client %s (%u open).',
+                client.peer, len(self.tcpClients))
+
+    def tcpClientFinished(self, client):
+        self.tcpClients.discard(client)
+
+#-----------------------------------------------------------------------------
+
+class UdpProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.datagramReceived(data, addr)
+
+    def error_received(self, exc):
+        self.listener.logger.error('UDP socket error: %s', exc)
+
+#-----------------------------------------------------------------------------
+
+class TcpClient(asyncio.Protocol):
+    """Connection to a single TCP client with its own receive buffer."""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.logger = listener.logger
+        self.maxPayload = listener.maxPayload
+        self.idleTimeout = listener.idleTimeout
+        self.transport = None
+        self.peer = None
+        self.stream = None # chosen by the first received bytes
+        self.overflow = False
+        self.idleHandle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info('peername')
+        self.peer = '%s:%u' % (peer[0], peer[1])
+        self.restartIdleTimer()
+        self.listener.tcpConnection(self)
+
+    def restartIdleTimer(self):
+        if self.idleTimeout <= 0:
+            return
+        if self.idleHandle:
+            self.idleHandle.cancel()
+        self.idleHandle = asyncio.get_running_loop().call_later(
+                self.idleTimeout, self.idle)
+
+    def data_received(self, data):
+        self.restartIdleTimer()
+        if self.overflow:
+            return
+        if not self.stream:
+            # forwarders may send keepalive frames before the first alarm
+            while data.startswith(Envelope.KEEPALIVE):
+                data = data[len(Envelope.KEEPALIVE):]
+            if not data:
+                return
+            if data.startswith(Envelope.MAGIC[:1]):
+                self.stream = Envelope.EnvelopeStream()
+            else:
+                self.stream = XmlStream()
+        elif isinstance(self.stream, XmlStream):
+            # XML never contains ESC, so keepalive frames can be removed
+            data = data.replace(Envelope.KEEPALIVE, b'')
+        failed = self.stream.failed
+        for document in self.stream.feed(data):
+            if isinstance(self.stream, Envelope.EnvelopeStream):
+                self.logger.info('Received envelope from TCP client %s.',
+                        self.peer)
+                self.listener.envelope.emit(document)
+                continue
+            self.logger.info('Received XML document from TCP client %s.',
+                    self.peer)
+            self.listener.xmlAlarm.emit(document)
+        if self.stream.failed and not failed:
+            self.logger.warning('TCP client %s sent invalid data (%s); '
+                    'waiting for disconnect.', self.peer, self.stream.failed)
+        if len(self.stream.data) > self.maxPayload:
+            self.logger.error('TCP client %s exceeded %u bytes; '
+                    'dropping connection.', self.peer, self.maxPayload)
+            self.overflow = True
+            self.stream = None
+            self.transport.abort()
+
+    def idle(self):
+        self.logger.warning('TCP client %s idle; closing connection.',
+                self.peer)
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.idleHandle:
+            self.idleHandle.cancel()
+        if exc and not self.overflow:
+            self.logger.error('TCP client %s: %s', self.peer, exc)
+        if isinstance(self.stream, XmlStream) and self.stream.data.strip():
+            # incomplete or invalid document: let the parser report it
+            self.listener.xmlAlarm.emit(bytes(self.stream.data))
+        elif self.stream and self.stream.data:
+            self.logger.error('TCP client %s sent an incomplete envelope.',
+                    self.peer)
+        self.stream = None
+        self.logger.info('Closing connection to TCP client %s.', self.peer)
+        self.listener.tcpClientFinished(self)
+
+#-----------------------------------------------------------------------------
+
+class DocumentComplete(Exception):
+
+    def __init__(self, index):
+        super(DocumentComplete, self).__init__()
+        self.index = index
+
+#-----------------------------------------------------------------------------
+
+class XmlStream:
+    """Incremental parser cutting complete XML documents out of a byte
+    stream.
+
+    A document is returned as soon as its root element is closed. Further
+    documents may follow on the same stream.
+    """
+
+    def __init__(self):
+        self.data = bytearray() # bytes of the current document
+        self.failed = None
+        self.reset()
+
+    def reset(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.depth = 0
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+
+    def endElement(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            raise DocumentComplete(self.parser.CurrentByteIndex)
+
+    def feed(self, data):
+        self.data += data
+        documents = []
+        if self.failed:
+            return documents
+        while data:
+            try:
+                self.parser.Parse(data, False)
+                break
+            except DocumentComplete as e:
+                if self.data.startswith(b'</', e.index):
+                    end = self.data.index(b'>', e.index) + 1
+                else:
+                    end = e.index # empty root element: index is behind it
+                documents.append(bytes(self.data[:end]))
+                self.data = self.data[end:].lstrip()
+                self.reset()
+                data = bytes(self.data)
+            except xml.parsers.expat.ExpatError as e:
+                self.failed = str(e)
+                break
+        return documents
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Forward spool
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+
+import os
+import time
+import json
+import struct
+import asyncio
+import collections
+
+#-----------------------------------------------------------------------------
+
+SpoolRecord = collections.namedtuple('SpoolRecord',
+        ['stamp', 'kind', 'data', 'segment', 'end'])
+
+#-----------------------------------------------------------------------------
+
+class Spool:
+    """Append-only on-disk queue of records to be sent to a forward target.
+
+    Records are appended to numbered segment files. The position behind the
+    last acknowledged record is stored in a cursor file, fully acknowledged
+    segments are deleted. Appending and acknowledging only write to the
+    files, a single fsync per sync delay makes a batch of changes durable.
+
+    Without a directory, records are kept in memory only.
+    """
+
+    STREAM = 0
+    DATAGRAM = 1
+
+    recordHeader = struct.Struct('!dBI') # time stamp, kind, length
+
+    def __init__(self, directory, logger, segmentSize = 1024 * 1024,
+            syncDelay = 0.05):
+        self.directory = directory
+        self.logger = logger
+        self.segmentSize = segmentSize
+        self.syncDelay = syncDelay # [s]
+        self.records = collections.deque() # unacknowledged SpoolRecords
+        self.segment = 0
+        self.file = None
+        self.size = 0
+        self.cursor = (0, 0) # segment, offset
+        self.syncHandle = None
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok = True)
+            self.load()
+
+    def __len__(self):
+        return len(self.records)
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, '%08u.seg' % (segment))
+
+    def cursorPath(self):
+        return os.path.join(self.directory, 'cursor')
+
+    def segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg') and name[:-4].isdigit():
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    def load(self):
+        try:
+            f = open(self.cursorPath(), 'r')
+            data = json.load(f)
+            f.close()
+            self.cursor = (data['segment'], data['offset'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error('Failed to read spool cursor: %s', e)
+
+        for segment in self.segments():
+            path = self.segmentPath(segment)
+            if segment < self.cursor[0]:
+                os.unlink(path)
+                continue
+            self.segment = segment
+            offset = self.cursor[1] if segment == self.cursor[0] else 0
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+            end = self.parse(data, offset, segment)
+            self.size = end
+            if end < len(data):
+                # record interrupted by a crash or power loss
+                self.logger.warning('Truncating spool segment %s at %u.',
+                        path, end)
+                os.truncate(path, end)
+
+        if not self.records:
+            # continue behind the cursor
+            self.segment = max(self.segment, self.cursor[0]) + 1
+            self.size = 0
+        else:
+            self.logger.info('Loaded %u unsent record(s) from %s.',
+                    len(self.records), self.directory)
+
+    def parse(self, data, offset, segment):
+        header = self.recordHeader
+        while offset + header.size <= len(data):
+            stamp, kind, length = header.unpack_from(data, offset)
+            end = offset + header.size + length
+            if end > len(data):
+                break
+            payload = data[offset + header.size:end]
+            self.records.append(SpoolRecord(stamp, kind, payload, segment,
+                end))
+            offset = end
+        return offset
+
+    def append(self, kind, data, stamp = None):
+        if stamp is None:
+            stamp = time.time()
+
+        if self.directory:
+            if self.file and self.size >= self.segmentSize:
+                self.sync()
+                self.file.close()
+                self.file = None
+                self.segment += 1
+                self.size = 0
+            if not self.file:
+                self.file = open(self.segmentPath(self.segment), 'ab')
+            self.file.write(self.recordHeader.pack(stamp, kind, len(data)))
+            self.file.write(data)
+            self.file.flush()
+            self.size += self.recordHeader.size + len(data)
+            self.scheduleSync()
+
+        record = SpoolRecord(stamp, kind, data, self.segment, self.size)
+        self.records.append(record)
+        return record
+
+    def pop(self):
+        """Removes the first record after it was acknowledged (or dropped).
+        """
+        record = self.records.popleft()
+        self.cursor = (record.segment, record.end)
+        if self.directory:
+            self.scheduleSync()
+        return record
+
+    def scheduleSync(self):
+        if self.syncHandle:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.sync()
+            return
+        self.syncHandle = loop.call_later(self.syncDelay, self.sync)
+
+    def sync(self):
+        if self.syncHandle:
+            self.syncHandle.cancel()
+            self.syncHandle = None
+        if not self.directory:
+            return
+
+        if self.file:
+            os.fsync(self.file.fileno())
+
+        path = self.cursorPath()
+        f = open(path + '.tmp', 'w')
+        json.dump({'segment': self.cursor[0], 'offset': self.cursor[1]}, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(path + '.tmp', path)
+
+        for segment in self.segments():
+            if segment >= self.cursor[0]:
+                break
+            os.unlink(self.segmentPath(segment))
+
+    def close(self):
+        self.sync()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+#-----------------------------------------------------------------------------
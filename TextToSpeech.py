@@ -60,18 +60,20 @@ class TextToSpeech(QObject):
         self.file = None
 
     def setText(self, text):
+        """Generates the audio for the given text. Returns True on success.
+        """
         self.logger.info('Generating TTS for %s', text)
         try:
             new_file = tempfile.NamedTemporaryFile(suffix = '.mp3')
         except:
             self.logger.error('Failed to generate temporary file for TTS.')
-            return
+            return False
         try:
             tts = gTTS(text = text, lang = 'de')
             tts.save(new_file.name)
         except:
             self.logger.error('TTS failed.')
-            return
+            return False
         self.file = new_file
         if self.padFile:
             try:
@@ -79,7 +81,7 @@ class TextToSpeech(QObject):
             except:
                 self.logger.error( \
                         'Failed to generate temporary file for padding.')
-                return
+                return True
             cmd = 'sox ' + self.padFile + ' ' + new_file.name + ' ' \
                 + self.padFile + ' ' + pad_file.name
             self.logger.info('Executing %s', cmd)
@@ -87,9 +89,36 @@ class TextToSpeech(QObject):
                 ret = os.system(cmd)
             except Exception as e:
                 self.logger.error('Padding failed: %s', e)
-                return
+                return True
             if ret == 0:
                 self.file = pad_file
+        return True
+
+    def audio(self):
+        """Returns the contents and the suffix of the current audio file or
+        None.
+        """
+        if not self.file:
+            return None
+        f = open(self.file.name, 'rb')
+        data = f.read()
+        f.close()
+        return data, os.path.splitext(self.file.name)[1]
+
+    def setAudio(self, data, suffix = '.mp3'):
+        """Uses audio generated elsewhere, e. g. by a master display.
+        Returns True on success.
+        """
+        self.logger.info('Using received TTS audio.')
+        try:
+            new_file = tempfile.NamedTemporaryFile(suffix = suffix)
+            new_file.write(data)
+            new_file.flush()
+        except:
+            self.logger.error('Failed to write TTS audio file.')
+            return False
+        self.file = new_file
+        return True
 
     def start(self):
         self.repetition = 0
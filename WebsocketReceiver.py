@@ -23,62 +23,26 @@
 #
 #-----------------------------------------------------------------------------
 
-import websocket
-import time
+import asyncio
+import websockets
 import json
+import random
 import socket
 import re
-import os
 
 from PyQt5 import QtCore
 
-#-----------------------------------------------------------------------------
-
-def on_message(ws, message):
-    ws.receiver.logger.info('Websocket received %s.', repr(message))
-    try:
-        msg_dict = json.loads(message)
-    except:
-        ws.receiver.logger.err('No valid json received.')
-        return
-    if 'auth' in msg_dict:
-        ws.receiver.logger.info('Websocket authentication: %s.',
-                msg_dict['auth'])
-    if 'alarm' in msg_dict:
-        ws.receiver.logger.info('Websocket received alarm.')
-        ws.receiver.receivedAlarm.emit(msg_dict['alarm'])
-    if 'status' in msg_dict:
-        ws.receiver.logger.info('Websocket received status.')
-        ws.receiver.receivedStatus.emit(msg_dict['status'])
-    if 'command' in msg_dict:
-        ws.receiver.logger.info('Websocket received command.')
-        os.system(msg_dict['command'])
-
-def on_error(ws, error):
-    ws.receiver.logger.info('Websocket error.')
-
-def on_close(ws):
-    ws.receiver.logger.info('Websocket closed.')
-
-def on_open(ws):
-    ws.receiver.logger.info('Websocket connected. Authenticating.')
-    addresses = []
-    for address in ws.receiver.status:
-        addresses.append(address)
-    msg = {
-            'host': ws.receiver.user,
-            'auth_token': ws.receiver.auth_token,
-            'register_status': addresses,
-            }
-    ws.send(json.dumps(msg))
+import JsonCodec
 
 #-----------------------------------------------------------------------------
 
 class WebsocketReceiver(QtCore.QObject):
 
-    receivedAlarm = QtCore.pyqtSignal(dict)
+    receivedAlarm = QtCore.pyqtSignal(bytes, dict) # frame, alarm
     receivedStatus = QtCore.pyqtSignal(dict)
-    finished = QtCore.pyqtSignal()
+
+    # Reconnect backoff [s]
+    reconnectMin = 1.0
 
     def __init__(self, config, logger):
         super(WebsocketReceiver, self).__init__()
@@ -87,8 +51,16 @@ class WebsocketReceiver(QtCore.QObject):
         self.user = config.get("websocket", "user",
                 fallback = socket.gethostname())
         self.auth_token = config.get("websocket", "auth_token", fallback = "")
+        self.pingInterval = config.getfloat("websocket", "ping_interval",
+                fallback = 20.0)
+        self.pingTimeout = config.getfloat("websocket", "ping_timeout",
+                fallback = 10.0)
+        self.reconnectMax = config.getfloat("websocket", "reconnect_max",
+                fallback = 60.0)
+        self.reconnectDelay = self.reconnectMin
 
         self.status = []
+        self.commands = set() # running command tasks
 
         if config.has_section('status'):
             addressRe = re.compile('address([0-9]+)')
@@ -102,29 +74,88 @@ class WebsocketReceiver(QtCore.QObject):
                         key, address)
                 self.status.append(address)
 
-    def receive(self):
-
+    async def run(self):
         if not self.url:
-            self.finished.emit()
             return
 
-        self.logger.info('Websocket receiver thread started.')
+        self.reconnectDelay = self.reconnectMin
 
-        reconnectTimeout = 30
-
-        ws = websocket.WebSocketApp(self.url,
-                on_open = on_open,
-                on_message = on_message,
-                on_error = on_error,
-                on_close = on_close)
-        ws.receiver = self
         while True:
             self.logger.info('Connecting to %s...', self.url)
-            ws.run_forever()
-            self.logger.error('Websocket closed. Waiting to reconnect...')
-            time.sleep(reconnectTimeout)
-
-        self.logger.info('Receiver thread finished.')
-        self.finished.emit()
+            try:
+                async with websockets.connect(self.url,
+                        ping_interval = self.pingInterval or None,
+                        ping_timeout = self.pingTimeout or None,
+                        open_timeout = 10,
+                        close_timeout = 5) as ws:
+                    await self.session(ws)
+                self.logger.error('Websocket closed.')
+            except (OSError, asyncio.TimeoutError,
+                    websockets.exceptions.WebSocketException) as e:
+                # a missing pong closes the connection with code 1011
+                self.logger.error('Websocket failed: %s', e)
+
+            # jitter avoids all displays reconnecting at the same time
+            wait = random.uniform(self.reconnectDelay / 2,
+                    self.reconnectDelay)
+            self.logger.info('Reconnecting in %.1f s...', wait)
+            await asyncio.sleep(wait)
+            self.reconnectDelay = min(self.reconnectDelay * 2,
+                    self.reconnectMax)
+
+    async def session(self, ws):
+        self.logger.info('Websocket connected. Authenticating.')
+        # Sent on every (re-)connect to resume status subscriptions
+        msg = {
+                'host': self.user,
+                'auth_token': self.auth_token,
+                'register_status': list(self.status),
+                }
+        await ws.send(json.dumps(msg))
+
+        async for message in ws:
+            # the server answered, so the next failure starts a new backoff
+            self.reconnectDelay = self.reconnectMin
+            self.handleMessage(message)
+
+    def handleMessage(self, message):
+        self.logger.info('Websocket received %s.', repr(message))
+        try:
+            msg_dict = JsonCodec.loads(message)
+        except:
+            self.logger.error('No valid json received.')
+            return
+        if 'auth' in msg_dict:
+            self.logger.info('Websocket authentication: %s.',
+                    msg_dict['auth'])
+        if 'alarm' in msg_dict:
+            self.logger.info('Websocket received alarm.')
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            # the frame is kept for detecting duplicates; only the alarm is
+            # saved and forwarded
+            self.receivedAlarm.emit(message, msg_dict['alarm'])
+        if 'status' in msg_dict:
+            self.logger.info('Websocket received status.')
+            self.receivedStatus.emit(msg_dict['status'])
+        if 'command' in msg_dict:
+            self.logger.info('Websocket received command.')
+            # the event loop is shared with the other sources, so the
+            # command must not block it
+            task = asyncio.ensure_future(
+                    self.runCommand(msg_dict['command']))
+            self.commands.add(task)
+            task.add_done_callback(self.commands.discard)
+
+    async def runCommand(self, command):
+        try:
+            process = await asyncio.create_subprocess_shell(command)
+            returnCode = await process.wait()
+        except OSError as e:
+            self.logger.error('Failed to run command %s: %s',
+                    repr(command), e)
+            return
+        self.logger.info('Command %s exited with %i.', repr(command),
+                returnCode)
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,495 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Benchmarks
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+#-----------------------------------------------------------------------------
+
+import sys
+import os
+import re
+import glob
+import json
+import time
+import argparse
+import threading
+import statistics
+import tracemalloc
+
+#-----------------------------------------------------------------------------
+
+def report(name, count, duration, latencies):
+    print('%-10s %6u frames in %7.3f s: %10.1f frames/s' % (name, count,
+        duration, count / duration))
+    if latencies:
+        lat = sorted(latencies)
+        print('%-10s latency [ms]: median %.3f, p90 %.3f, max %.3f' % ('',
+            statistics.median(lat) * 1e3, lat[int(len(lat) * 0.9)] * 1e3,
+            lat[-1] * 1e3))
+
+#-----------------------------------------------------------------------------
+# Pager framing
+#-----------------------------------------------------------------------------
+
+def loadPagerFrames(paths):
+    frames = []
+    for path in paths:
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        # archived pager alarms are stored as UTF-8, the DME sends latin1
+        data = data.decode('utf-8').encode('latin1', errors = 'replace')
+        frames.extend(frame for frame in data.split(b'\x00') if frame)
+    return frames
+
+def readBytewise(ser, count, onFrame):
+    # Receive loop as used before the FrameReader was introduced.
+    from AlarmReceiver import AlarmReceiver
+    data = b''
+    received = 0
+    while received < count:
+        c = ser.read()
+        if c == b'\x00':
+            AlarmReceiver.decode(data.decode('latin1'))
+            onFrame()
+            received += 1
+            data = b''
+        else:
+            data += c
+
+def readChunked(ser, count, onFrame):
+    from AlarmReceiver import AlarmReceiver, FrameReader
+    reader = FrameReader()
+    received = 0
+    while received < count:
+        data = ser.read(ser.in_waiting or 1)
+        for frame in reader.feed(data):
+            AlarmReceiver.decode(frame.decode('latin1'))
+            onFrame()
+            received += 1
+
+def replayPty(frames, count, interval, readFunc):
+    import serial
+
+    master, slave = os.openpty()
+    ser = serial.Serial(os.ttyname(slave), baudrate = 9600, timeout = 10.0)
+    os.close(slave)
+
+    sendTimes = []
+    latencies = []
+
+    def write():
+        for i in range(count):
+            sendTimes.append(time.perf_counter())
+            os.write(master, frames[i % len(frames)] + b'\x00')
+            if interval:
+                time.sleep(interval)
+
+    def onFrame():
+        latencies.append(time.perf_counter() - sendTimes[len(latencies)])
+
+    writer = threading.Thread(target = write)
+    start = time.perf_counter()
+    writer.start()
+    readFunc(ser, count, onFrame)
+    duration = time.perf_counter() - start
+    writer.join()
+
+    ser.close()
+    os.close(master)
+    return duration, latencies
+
+def pagerFraming(args):
+    paths = args.files or sorted(glob.glob('test_data/*.dme'))
+    frames = loadPagerFrames(paths)
+    if not frames:
+        print('No pager frames found.')
+        return 1
+    if args.pad:
+        frames = [frame + b' ' * args.pad for frame in frames]
+
+    print('Replaying %u frames (%u captured, mean length %u bytes)' % (
+        args.count, len(frames),
+        sum(len(f) for f in frames) / len(frames)))
+
+    for name, func in (('bytewise', readBytewise), ('chunked', readChunked)):
+        duration, latencies = replayPty(frames, args.count, args.interval,
+                func)
+        report(name, args.count, duration, latencies)
+
+    return 0
+
+
+#-----------------------------------------------------------------------------
+# Pager parsing
+#-----------------------------------------------------------------------------
+
+# Pattern used by Alarm.fromPager before the tokenizer was introduced.
+legacyAlarmRe = re.compile( \
+        '.*(\d\d-\d+-\d+ \d+:\d+:\d+)\s+' \
+        '(.*?)\s*?\*' \
+        '(.*?)\*' \
+        '(..)\s+' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*?)\*' \
+        '(.*)')
+legacyCoordRe = re.compile('#K01;N(\d+)E(\d+);')
+
+# (name, repeated pattern, suffix)
+adversarialPatterns = (
+    ('stamps', '16-12-17 18:55:10 *', ''),
+    ('no-art', '16-12-17 18:55:10 *B2*', ''),
+    ('stars', '*', ''),
+    ('digits', '1-', ''),
+    ('coords', '#K01;N', 'E1;'),
+)
+
+def timeParse(func, text, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(text)
+    return (time.perf_counter() - start) / repeat
+
+def pagerParse(args):
+    from Alarm import Alarm
+
+    paths = args.files or sorted(glob.glob('test_data/*.dme'))
+    texts = []
+    for path in paths:
+        f = open(path, 'r', encoding = 'utf-8')
+        texts.append(f.read())
+        f.close()
+    if not texts:
+        print('No pager texts found.')
+        return 1
+
+    def legacy(text):
+        ma = legacyCoordRe.search(text)
+        if ma:
+            text = text[:ma.start()] + text[ma.end():]
+        return legacyAlarmRe.match(text)
+
+    def tokenize(text):
+        coord = Alarm.findCoordinates(text)
+        if coord:
+            text = text[:coord[2]] + text[coord[3]:]
+        return Alarm.splitPager(text)
+
+    print('Valid texts (%u):' % len(texts))
+    for name, func in (('legacy', legacy),
+            ('tokenizer', tokenize)):
+        duration = sum(timeParse(func, text, args.count) for text in texts)
+        print('%-10s %8.2f us/text' % (name, duration / len(texts) * 1e6))
+
+    print('Adversarial texts (time per text, per kB for the tokenizer):')
+    for name, pattern, suffix in adversarialPatterns:
+        runLegacy = True
+        for size in args.sizes:
+            text = pattern * (size // len(pattern)) + suffix
+            if runLegacy:
+                duration = timeParse(legacy, text, 1)
+                legacyStr = '%10.3f ms' % (duration * 1e3)
+                # the legacy pattern is at least quadratic: do not wait
+                runLegacy = duration < args.limit
+            else:
+                legacyStr = '%13s' % 'skipped'
+            duration = timeParse(tokenize, text, args.count)
+            print('%-8s %7u bytes: legacy %s, tokenizer %8.2f us '
+                '(%6.2f us/kB)' % (name, len(text), legacyStr,
+                duration * 1e6, duration * 1e6 * 1024 / len(text)))
+
+    return 0
+
+#-----------------------------------------------------------------------------
+# XML parsing
+#-----------------------------------------------------------------------------
+
+def minidomParse(data):
+    # DOM walk as done by Alarm.fromXml before the XmlParser was introduced.
+    import xml.dom.minidom
+    doc = xml.dom.minidom.parseString(data)
+    values = {}
+
+    def walk(elem, path):
+        for child in elem.childNodes:
+            if child.nodeType != child.ELEMENT_NODE:
+                continue
+            childPath = path + '/' + child.localName
+            if all(c.nodeType == c.TEXT_NODE for c in child.childNodes):
+                values[childPath] = ''.join(
+                        c.data for c in child.childNodes).strip()
+            else:
+                walk(child, childPath)
+    walk(doc.firstChild, '')
+    return values
+
+def xmlParse(args):
+    import configparser
+    from Alarm import Alarm
+
+    paths = []
+    for path in args.files or ['test_data']:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, '*.xml'))))
+        else:
+            paths.append(path)
+    documents = []
+    for path in paths:
+        f = open(path, 'rb')
+        documents.append(f.read())
+        f.close()
+    if not documents:
+        print('No XML documents found.')
+        return 1
+
+    config = configparser.ConfigParser()
+
+    def streaming(data):
+        Alarm(config).fromXml(data)
+
+    print('%u document(s), mean size %u bytes' % (len(documents),
+        sum(len(d) for d in documents) / len(documents)))
+    for name, func in (('minidom', minidomParse), ('streaming', streaming)):
+        start = time.perf_counter()
+        for i in range(args.count):
+            for data in documents:
+                func(data)
+        duration = (time.perf_counter() - start) / args.count
+
+        peaks = []
+        for data in documents:
+            tracemalloc.start()
+            func(data)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        print('%-10s %8.1f us/document, peak memory %7.1f kB '
+            '(max %.1f kB)' % (name, duration / len(documents) * 1e6,
+            statistics.mean(peaks) / 1024, max(peaks) / 1024))
+
+    return 0
+
+#-----------------------------------------------------------------------------
+# Alarm parsing
+#-----------------------------------------------------------------------------
+
+def alarmParse(args):
+    import configparser
+    from Alarm import Alarm, AlarmContext
+
+    config = configparser.ConfigParser()
+    config['display'] = {'home_town': 'Kleve'}
+
+    paths = args.files or sorted(glob.glob('test_data/*.*'))
+    for path in paths:
+        f = open(path, 'r', encoding = 'utf-8')
+        contents = f.read()
+        f.close()
+        if path.endswith('.dme'):
+            def parse(alarm):
+                alarm.fromPager(contents)
+        elif path.endswith('.xml'):
+            def parse(alarm):
+                alarm.fromXml(contents)
+        elif path.endswith('.json'):
+            data = json.loads(contents)
+
+            def parse(alarm):
+                alarm.fromAlamos(data, None)
+        else:
+            continue
+
+        # 'per alarm' resolves the configuration for every alarm, as before
+        # the AlarmContext was introduced.
+        for name, context in (('per alarm', None),
+                ('cached', AlarmContext(config))):
+            start = time.perf_counter()
+            for i in range(args.count):
+                alarm = Alarm(config, context = context)
+                parse(alarm)
+                alarm.address()
+                alarm.dateString()
+            duration = (time.perf_counter() - start) / args.count
+            print('%-24s %-10s %8.1f us/alarm' % (os.path.basename(path),
+                name, duration * 1e6))
+
+    return 0
+
+#-----------------------------------------------------------------------------
+# Alarm memory
+#-----------------------------------------------------------------------------
+
+def syntheticArchive(count):
+    """Yields (extension, contents) of count alarms derived from the test
+    data with distinct numbers.
+    """
+    import configparser
+    from Alarm import Alarm
+
+    templates = []
+    for path in sorted(glob.glob('test_data/*.*')):
+        alarm = Alarm(configparser.ConfigParser())
+        alarm.load(path)
+        f = open(path, 'r', encoding = 'utf-8')
+        templates.append((os.path.splitext(path)[1], f.read(), alarm.number))
+        f.close()
+
+    for i in range(count):
+        ext, contents, number = templates[i % len(templates)]
+        yield ext, contents.replace(number, '%s%05u' % (number[:-5],
+            i // len(templates) % 100000))
+
+def legacyRecords():
+    """Returns a function converting an alarm into a record with an instance
+    dictionary, payloads and per-alarm resources, as before the slotted
+    record and the pool were introduced.
+    """
+    from collections import namedtuple
+    from Alarm import EinsatzMittel
+
+    class LegacyEinsatzMittel(namedtuple('LegacyEinsatzMittel',
+            EinsatzMittel._fields)):
+        pass
+
+    class LegacyAlarm:
+        pass
+
+    def convert(alarm):
+        record = LegacyAlarm()
+        for name in alarm.__slots__ + ('pager', 'xml', 'json'):
+            setattr(record, name, getattr(alarm, name))
+        record.einsatzmittel = set(LegacyEinsatzMittel(*(''.join(list(f))
+            for f in em)) for em in alarm.einsatzmittel)
+        return record
+
+    return convert
+
+def alarmMemory(args):
+    import configparser
+    from Alarm import Alarm, EinsatzMittel
+
+    config = configparser.ConfigParser()
+    archive = list(syntheticArchive(args.count))
+    print('Loading %u synthetic alarms' % len(archive))
+
+    variants = (
+        ('legacy', True, legacyRecords()),
+        ('slotted', True, None),
+        ('history', False, None), # without raw payloads
+    )
+    for name, keepPayload, convert in variants:
+        EinsatzMittel.pool.clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        alarms = []
+        for ext, contents in archive:
+            alarm = Alarm(config)
+            if ext == '.dme':
+                alarm.fromPager(contents)
+            elif ext == '.xml':
+                alarm.fromXml(contents)
+            else:
+                alarm.fromAlamos(json.loads(contents), None)
+            if not keepPayload:
+                alarm.raw = None
+            if convert:
+                alarm = convert(alarm)
+            alarms.append(alarm)
+        duration = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        resources = len(set(id(em) for alarm in alarms
+            for em in alarm.einsatzmittel))
+        print('%-8s %8.1f MiB, %6u bytes/alarm, %6u resource objects, '
+            '%6.2f s' % (name, size / 1024 / 1024, size / len(alarms),
+            resources, duration))
+        del alarms
+
+    return 0
+
+#-----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Alarm Display benchmarks')
+    sub = parser.add_subparsers(dest = 'benchmark')
+    sub.required = True
+
+    p = sub.add_parser('pager-framing',
+            help = 'replay captured DME byte streams through a pty')
+    p.add_argument('files', nargs = '*',
+            help = 'captured .dme files (default: test_data/*.dme)')
+    p.add_argument('-n', '--count', type = int, default = 2000,
+            help = 'number of frames to replay')
+    p.add_argument('-i', '--interval', type = float, default = 0.0,
+            help = 'pause between frames [s] for latency measurement')
+    p.add_argument('--pad', type = int, default = 0,
+            help = 'append the given number of bytes to each frame')
+    p.set_defaults(func = pagerFraming)
+
+    p = sub.add_parser('pager-parse',
+            help = 'parse valid and adversarial pager texts')
+    p.add_argument('files', nargs = '*',
+            help = 'pager texts (default: test_data/*.dme)')
+    p.add_argument('-n', '--count', type = int, default = 1000,
+            help = 'repetitions per text')
+    p.add_argument('--sizes', type = int, nargs = '+',
+            default = [1000, 2000, 4000, 8000, 64000, 512000],
+            help = 'lengths of the adversarial texts [bytes]')
+    p.add_argument('--limit', type = float, default = 1.0,
+            help = 'skip larger texts with the legacy pattern, as soon as '
+            'a text took longer [s]')
+    p.set_defaults(func = pagerParse)
+
+    p = sub.add_parser('xml-parse',
+            help = 'parse XML alarms with minidom and the streaming parser')
+    p.add_argument('files', nargs = '*',
+            help = 'XML files or directories, e. g. the [db] path '
+            '(default: test_data)')
+    p.add_argument('-n', '--count', type = int, default = 1000,
+            help = 'repetitions per document')
+    p.set_defaults(func = xmlParse)
+
+    p = sub.add_parser('alarm-parse',
+            help = 'per-alarm cost of parsing and rendering')
+    p.add_argument('files', nargs = '*',
+            help = 'alarm files (default: test_data/*.*)')
+    p.add_argument('-n', '--count', type = int, default = 2000,
+            help = 'repetitions per file')
+    p.set_defaults(func = alarmParse)
+
+    p = sub.add_parser('alarm-memory',
+            help = 'memory of a synthetic alarm archive')
+    p.add_argument('-n', '--count', type = int, default = 50000,
+            help = 'number of alarms')
+    p.set_defaults(func = alarmMemory)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+#-----------------------------------------------------------------------------
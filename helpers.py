@@ -34,7 +34,7 @@ def pixmapFromSvg(path, width):
     renderer = QSvgRenderer(path)
 
     svgSize = renderer.defaultSize()
-    height = svgSize.height() / svgSize.width() * width
+    height = round(svgSize.height() / svgSize.width() * width)
 
     pixmap = QPixmap(QSize(width, height))
     painter = QPainter()
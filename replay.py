@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#-----------------------------------------------------------------------------
+#
+# Alarm replay load generator
+#
+# Copyright (C) 2026 Alarm Display contributors
+#
+# This file is part of Alarm Display.
+#
+# Alarm Display is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Alarm Display is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Alarm Display. If not, see <http://www.gnu.org/licenses/>.
+#
+# Replays archived alarms ([db] path) against a running display:
+#
+# - .dme files as UDP datagrams and .xml files via TCP to the socket port,
+# - .json files via a local websocket server, the display connects to
+#   ([websocket] url = ws://<this host>:<websocket port>).
+#
+# End-to-end latency is measured with the copies forwarded by the display
+# ([forward] host0 = <this host>, port0 = <listen port>). Alarms that are not
+# forwarded back within the timeout count as dropped. Note that the display
+# suppresses identical payloads, so repetitions within its duplicate windows
+# count as dropped, too. Websocket (.json) alarms are only forwarded in
+# envelopes ([forward] format = envelope). With raw forwarding (see
+# --forward-format), they are not expected back and not counted as dropped.
+#
+#-----------------------------------------------------------------------------
+
+import sys
+import os
+import re
+import glob
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import datetime
+import statistics
+import configparser
+import collections
+
+#-----------------------------------------------------------------------------
+
+dateRe = re.compile(r'\d\d\d\d-\d\d-\d\d-\d\d-\d\d-\d\d')
+
+#-----------------------------------------------------------------------------
+
+def loadArchive(paths):
+    """Returns a list of (time stamp, kind, data) sorted by time."""
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for ext in ('dme', 'xml', 'json'):
+                files.extend(glob.glob(os.path.join(path, '*.' + ext)))
+        else:
+            files.append(path)
+
+    alarms = []
+    for path in files:
+        ma = dateRe.search(os.path.basename(path))
+        if ma:
+            dt = datetime.datetime.strptime(ma.group(), '%Y-%m-%d-%H-%M-%S')
+            stamp = dt.timestamp()
+        else:
+            stamp = os.path.getmtime(path)
+        kind = os.path.splitext(path)[1][1:]
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        alarms.append((stamp, kind, data))
+
+    alarms.sort(key = lambda alarm: alarm[0])
+    return alarms
+
+def matchKey(kind, data):
+    """Returns a key to identify an alarm and its forwarded copy."""
+    if kind == 'json':
+        # archived alarms may be plain dictionaries or websocket frames
+        alarm = json.loads(data.decode('utf-8'))
+        if isinstance(alarm.get('alarm'), dict):
+            alarm = alarm['alarm']
+        return json.dumps(alarm)
+    # the display cuts XML documents behind the root element
+    return data.strip()
+
+#-----------------------------------------------------------------------------
+
+class Replay:
+
+    def __init__(self, args, alarms, logger):
+        self.args = args
+        self.alarms = alarms
+        self.logger = logger
+        self.websocketClients = set()
+        self.sendTimes = collections.defaultdict(collections.deque)
+        self.sent = collections.Counter()
+        self.failed = collections.Counter()
+        self.latencies = []
+        self.received = 0
+        self.lastSend = None
+
+    async def run(self):
+        collector = None
+        if self.args.listen_port:
+            collector = await self.startCollector()
+
+        server = None
+        if self.args.websocket_port:
+            import websockets
+            server = await websockets.serve(self.websocketClient,
+                    self.args.bind, self.args.websocket_port)
+            if any(kind == 'json' for stamp, kind, data in self.alarms):
+                print('Waiting %.1f s for websocket clients...' % (
+                    self.args.connect_wait))
+                await asyncio.sleep(self.args.connect_wait)
+
+        start = time.monotonic()
+        await self.replay()
+        duration = time.monotonic() - start
+
+        if collector:
+            await self.waitForCopies()
+            collector.close()
+        if server:
+            server.close()
+            await server.wait_closed()
+
+        self.report(duration)
+
+    async def startCollector(self):
+        from SocketListener import SocketListener
+        import Envelope
+        from Alarm import Alarm, AlarmContext
+
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': str(self.args.listen_port),
+                'duplicate_window': '0', 'idle_timeout': '0'}
+        collector = SocketListener(config, self.logger)
+        context = AlarmContext(config)
+
+        def envelope(data):
+            if Envelope.isArtifact(data):
+                return
+            alarm = Alarm(config, context = context)
+            Envelope.decode(data, alarm)
+            self.copyReceived(alarm.source, alarm.payload())
+
+        collector.pagerAlarm.connect(lambda pagerStr: \
+                self.copyReceived('dme', pagerStr.encode('utf-8')))
+        collector.xmlAlarm.connect(lambda data: \
+                self.copyReceived('xml', data))
+        collector.envelope.connect(envelope)
+        await collector.start()
+        return collector
+
+    def copyReceived(self, kind, data):
+        now = time.monotonic()
+        key = matchKey(kind, data)
+        sendTimes = self.sendTimes.get(key)
+        if not sendTimes:
+            self.logger.debug('Unknown copy received.')
+            return
+        self.latencies.append(now - sendTimes.popleft())
+        self.received += 1
+
+    def expectedCopies(self):
+        """Number of sent alarms, that the display forwards back."""
+        expected = sum(self.sent.values())
+        if self.args.forward_format != 'envelope':
+            expected -= self.sent['json'] # only forwarded in envelopes
+        return expected
+
+    async def waitForCopies(self):
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline and \
+                self.received < self.expectedCopies():
+            await asyncio.sleep(0.01)
+
+    async def websocketClient(self, ws):
+        self.websocketClients.add(ws)
+        print('Websocket client connected.')
+        try:
+            async for message in ws:
+                pass # registration
+        except Exception:
+            pass
+        finally:
+            self.websocketClients.discard(ws)
+
+    def schedule(self):
+        """Yields (delay, alarm) for the alarms to send."""
+        count = self.args.count or len(self.alarms)
+        for i in range(count):
+            alarm = self.alarms[i % len(self.alarms)]
+            if self.args.original_timing:
+                if i % len(self.alarms) == 0:
+                    delay = 0.0
+                else:
+                    previous = self.alarms[i % len(self.alarms) - 1]
+                    delay = (alarm[0] - previous[0]) / self.args.speed
+            elif i % self.args.burst:
+                delay = 0.0
+            else:
+                delay = self.args.burst / self.args.rate if i else 0.0
+            yield delay, alarm
+
+    async def replay(self):
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        nextSend = time.monotonic()
+        for delay, (stamp, kind, data) in self.schedule():
+            nextSend += delay
+            wait = nextSend - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await self.send(udp, kind, data)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.error('Sending %s failed: %s', kind, e)
+                self.failed[kind] += 1
+        udp.close()
+
+    def expect(self, kind, data):
+        """Starts waiting for the forwarded copy of a sent alarm."""
+        key = matchKey(kind, data)
+        self.sendTimes[key].append(time.monotonic())
+        return key
+
+    async def send(self, udp, kind, data):
+        key = self.expect(kind, data)
+        if kind == 'dme':
+            udp.sendto(data, (self.args.host, self.args.port))
+        elif kind == 'xml':
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                self.args.host, self.args.port), 5.0)
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+        elif kind == 'json':
+            if not self.websocketClients:
+                self.sendTimes[key].pop()
+                raise OSError('no websocket client connected')
+            message = json.loads(data.decode('utf-8'))
+            if not isinstance(message.get('alarm'), dict):
+                message = {'alarm': message}
+            message = json.dumps(message)
+            for ws in list(self.websocketClients):
+                await ws.send(message)
+        self.sent[kind] += 1
+
+    def report(self, duration):
+        total = sum(self.sent.values())
+        print('Sent %u alarm(s) in %.3f s: %.1f alarms/s (%s)' % (total,
+            duration, total / duration if duration else 0.0,
+            ', '.join('%s %u' % item for item in sorted(self.sent.items()))))
+        if self.failed:
+            print('Failed to send %u alarm(s) (%s)' % (
+                sum(self.failed.values()), ', '.join('%s %u' % item \
+                        for item in sorted(self.failed.items()))))
+        if not self.args.listen_port:
+            return
+        print('Received %u forwarded copies, %u alarm(s) dropped' % (
+            self.received, self.expectedCopies() - self.received))
+        if self.latencies:
+            lat = sorted(self.latencies)
+            values = (statistics.median(lat), lat[int(len(lat) * 0.9)],
+                    lat[int(len(lat) * 0.99)], lat[-1])
+            print('End-to-end latency [ms]: median %.1f, p90 %.1f, '
+                'p99 %.1f, max %.1f' % tuple(v * 1e3 for v in values))
+
+#-----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            description = 'Replay archived alarms against a display')
+    parser.add_argument('paths', nargs = '*',
+            help = 'alarm files or directories (default: [db] path)')
+    parser.add_argument('-c', '--config', action = 'append', default = [],
+            help = 'configuration file to read [db] path from')
+    parser.add_argument('--host', default = '127.0.0.1',
+            help = 'display to send pager and XML alarms to')
+    parser.add_argument('--port', type = int, default = 11211,
+            help = 'socket port of the display')
+    parser.add_argument('--bind', default = '0.0.0.0',
+            help = 'address for the websocket server')
+    parser.add_argument('--websocket-port', type = int, default = 8765,
+            help = 'port of the local websocket server (0: disabled)')
+    parser.add_argument('--connect-wait', type = float, default = 5.0,
+            help = 'time to wait for websocket clients [s]')
+    parser.add_argument('--listen-port', type = int, default = 0,
+            help = 'port to receive forwarded copies on (0: disabled)')
+    parser.add_argument('--forward-format', choices = ('raw', 'envelope'),
+            default = 'raw',
+            help = 'format the display forwards copies in ([forward] format)')
+    parser.add_argument('-n', '--count', type = int, default = 0,
+            help = 'number of alarms to send (default: all once)')
+    parser.add_argument('-r', '--rate', type = float, default = 1.0,
+            help = 'alarms (bursts) per second')
+    parser.add_argument('-b', '--burst', type = int, default = 1,
+            help = 'alarms sent back-to-back per burst')
+    parser.add_argument('--original-timing', action = 'store_true',
+            help = 'replay with the original intervals between alarms')
+    parser.add_argument('--speed', type = float, default = 1.0,
+            help = 'speed-up factor for --original-timing')
+    parser.add_argument('-t', '--timeout', type = float, default = 10.0,
+            help = 'time to wait for forwarded copies [s]')
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('replay')
+    logging.basicConfig(format = '%(asctime)s %(message)s',
+            level = logging.DEBUG if args.verbose else logging.WARNING)
+
+    paths = args.paths
+    if not paths:
+        config = configparser.ConfigParser()
+        config.read(args.config or ['/etc/alarmdisplay.conf',
+            os.path.expanduser('~/.alarmdisplay.conf'), 'alarmdisplay.conf'])
+        dbPath = config.get('db', 'path', fallback = None)
+        if not dbPath:
+            print('No alarm files given and no [db] path configured.')
+            sys.exit(1)
+        paths = [dbPath]
+
+    alarms = loadArchive(paths)
+    if not alarms:
+        print('No alarms found.')
+        sys.exit(1)
+    if args.rate <= 0 or args.burst < 1 or args.speed <= 0:
+        print('Invalid rate, burst or speed.')
+        sys.exit(1)
+
+    print('Replaying %u alarm(s) from %u file(s)' % (
+        args.count or len(alarms), len(alarms)))
+    sys.exit(asyncio.run(Replay(args, alarms, logger).run()))
+
+#-----------------------------------------------------------------------------
@@ -31,10 +31,38 @@ import logging
 import datetime
 from tzlocal import get_localzone
 import json
+import os
+import select
+import tempfile
+import shutil
+import socket
+import time
+import types
+import threading
+import collections
+import PyQt5.QtCore
 import PyQt5.QtWidgets
 from Map import getRoute
 from AlarmReport import AlarmReport
-from Alarm import Alarm, EinsatzMittel
+from MainWidget import MainWidget
+from Alarm import Alarm, AlarmContext, EinsatzMittel, schema
+from AlarmReceiver import AlarmReceiver, FrameReader
+from DeviceMonitor import InotifyMonitor, PollingMonitor
+from SocketListener import SocketListener
+from WebsocketReceiver import WebsocketReceiver
+from IngestCore import IngestCore
+from Forwarder import Forwarder
+from replay import Replay, loadArchive
+import Envelope
+import JsonCodec
+from Latency import LatencyTrace, LatencyStats
+from Spool import Spool
+from DnsCache import DnsCache
+from DuplicateFilter import DuplicateFilter
+from ImapMonitor import ImapMonitor, xmlParts, decodePart
+from imapclient.response_parser import parse_fetch_response
+import asyncio
+import websockets
 
 #-----------------------------------------------------------------------------
 
@@ -309,6 +337,62 @@ class alarmdisplayTests(unittest.TestCase):
 
         del app
 
+    def test_processAlarm(self):
+        tempDir = tempfile.TemporaryDirectory()
+        # an archived alarm for the idle screen's history
+        shutil.copy('test_data/test01-1.json', tempDir.name)
+        config = configparser.ConfigParser()
+        config['db'] = {'path': tempDir.name}
+        config['socket'] = {'port': '11292'}
+
+        app = PyQt5.QtWidgets.QApplication(sys.argv)
+        widget = MainWidget(config, logger)
+
+        # locally created XML alarm without payload
+        widget.exampleJugend()
+        self.assertEqual(widget.alarm.number, '40001')
+        self.assertEqual(widget.alarm.payload(), b'')
+
+        # repeated manual alarms are not filtered, forwarded copies are
+        widget.exampleJugend()
+        self.assertEqual(widget.replayFilter.suppressed, 0)
+        alarm = Alarm(config)
+        alarm.load('test_data/test01-3.xml', logger)
+        widget.processAlarm(alarm, forwarded = True)
+        self.assertIs(widget.alarm, alarm)
+        widget.processAlarm(alarm, forwarded = True)
+        self.assertEqual(widget.replayFilter.suppressed, 1)
+
+        # 'tts' is marked only if speech was generated
+        widget.tts.setText = lambda text: True
+        pagerStr = ('16-12-17 18:55:10 LG *40005*H1 Hilfeleistung*'
+                '*Kleve*Reichswalde*Grunewaldstrasse*1**')
+        first = Alarm(config, trace = LatencyTrace())
+        first.fromPager(pagerStr, logger)
+        widget.processAlarm(first)
+        self.assertIsNotNone(first.trace.elapsed('tts'))
+        second = Alarm(config, trace = LatencyTrace())
+        second.fromPager(pagerStr, logger)
+        widget.processAlarm(second)
+        self.assertIs(widget.alarm, first)
+        self.assertIsNone(second.trace.elapsed('tts'))
+
+        # a slave stops waiting, once all artifacts were received
+        widget.role = 'slave'
+        widget.artifactTimer.start()
+        widget.receivedArtifact(Envelope.encodeArtifact(first.number,
+            'speech', text = 'Hilfeleistung', audio = b'', suffix = '.mp3'))
+        self.assertTrue(widget.speechReceived)
+        self.assertFalse(widget.artifactTimer.isActive())
+
+        widget.ingestCore.stop()
+        for thread in (widget.ingestThread, widget.cecThread):
+            thread.quit()
+            thread.wait()
+        del widget
+        del app
+        tempDir.cleanup()
+
     def test_wolfsgraben(self):
         config = configparser.ConfigParser()
 
@@ -402,6 +486,737 @@ class alarmdisplayTests(unittest.TestCase):
             'FW KLV Gerätewarte, FW KLV Leiter, FW KLV01 DLK23 1, KLV 1, '
             'KLV 1 DLK23 1, KLV Leiter, KLV RTW 1'))
 
+    def test_pagerTokenizer(self):
+        config = configparser.ConfigParser()
+        alarm = Alarm(config)
+        alarm.fromPager('22-03-17 10:12:38 LG Reichswalde  Gebäudesteuerung'
+            ' #K01;N5177287E0611253;*40007*B2 Brandmeldeanlage 2'
+            ' **Kleve*Materborn*Dorfstrasse*27*KLV 02/103'
+            '*Materborner Allee - Saalstrasse', logger)
+        self.assertEqual((alarm.lat, alarm.lon), (51.77287, 6.11253))
+        self.assertEqual(alarm.datetime.strftime('%Y-%m-%d %H:%M:%S'),
+                '2017-03-22 10:12:38')
+        self.assertEqual((alarm.number, alarm.art, alarm.stichwort,
+            alarm.diagnose, alarm.besonderheit, alarm.ort, alarm.ortsteil,
+            alarm.strasse, alarm.hausnummer, alarm.objektnummer,
+            alarm.ortshinweis), ('40007', 'B', '2', 'Brandmeldeanlage 2', '',
+                'Kleve', 'Materborn', 'Dorfstrasse', '27', 'KLV 02/103',
+                'Materborner Allee - Saalstrasse'))
+        self.assertIsNone(alarm.fallbackStr)
+
+        # surplus separators end up in the number and the Ortshinweis
+        timeStamp, fields = Alarm.splitPager('16-12-17 18:55:10 LG *1*2*'
+                'H1 Hilfe*a*b*c*d*e*f*g*h')
+        self.assertEqual(timeStamp, '16-12-17 18:55:10')
+        self.assertEqual(fields, ['1*2', 'H1 Hilfe', 'a', 'b', 'c', 'd', 'e',
+            'f', 'g*h'])
+
+        self.assertIsNone(Alarm.splitPager('16-12-17 18:55:10 LG *1*H1*'))
+        self.assertIsNone(Alarm.splitPager('16-12-17 18:55:10\n *1*'
+                'H1 Hilfe\n*a*b*c*d*e*f*g'))
+        # forced heavy backtracking with the former regular expression
+        self.assertIsNone(Alarm.splitPager('16-12-17 18:55:10 *B2*' * 5000))
+        self.assertIsNone(Alarm.findCoordinates('#K01;N' * 5000 + 'E1;'))
+
+        # same tokens as with the former regular expression
+        self.assertEqual(Alarm.splitPager('16-12-17 18:55:10 LG *1*B2 \n'
+                'Kaminbrand*a*b*c*d*e*f*g'), ('16-12-17 18:55:10',
+                    ['1', 'B2 Kaminbrand', 'a', 'b', 'c', 'd', 'e', 'f', 'g']))
+        self.assertEqual(Alarm.splitPager('16-12-17 18:55:10 LG 1*2\n'
+                '*3*B2 Brand*a*b*c*d*e*f*g')[1][:2], ['3', 'B2 Brand'])
+        self.assertEqual(Alarm.splitPager('16-12-2017 18:55:10 LG *1*'
+                'B2 Brand*a*b*c*d*e*f*g')[0], '16-12-2017 18:55:10')
+        # the last time stamp is not followed by a complete alarm
+        self.assertEqual(Alarm.splitPager('16-12-17 18:55:10 LG *1*B2 '
+                '17-12-17 08:00:00 *a*b*c*d*e*f*g'), ('16-12-17 18:55:10',
+                    ['1', 'B2 17-12-17 08:00:00 ', 'a', 'b', 'c', 'd', 'e',
+                        'f', 'g']))
+
+        # whitespace as Einsatzart is stripped like the other fields
+        alarm = Alarm(config)
+        alarm.fromPager('16-12-17 18:55:10 LG *1* 2 Brand*a*b*c*d*e*f*g',
+                logger)
+        self.assertEqual((alarm.art, alarm.stichwort, alarm.diagnose),
+                ('', '2', 'Brand'))
+
+        alarm = Alarm(config)
+        alarm.fromPager('Einsatz #K01;N51E06x;', logger)
+        self.assertEqual((alarm.lat, alarm.lon), (0.0, 0.0))
+        self.assertEqual(alarm.fallbackStr, 'Einsatz #K01;N51E06x;')
+
+    def test_xmlParser(self):
+        config = configparser.ConfigParser()
+        alarm = Alarm(config)
+        alarm.fromXml(b"""<?xml version="1.0" encoding="UTF-8"?>
+            <daten><einsatz>
+            <einsatznummer> 4711 </einsatznummer>
+            <eskalation>-</eskalation>
+            <besonderheit><![CDATA[A & B]]> &amp; C</besonderheit>
+            <unbekannt><einsatznummer>1</einsatznummer></unbekannt>
+            </einsatz><einsatzort>
+            <koordinaten>POINT (6.16825119 51.80245845)</koordinaten>
+            <objekt><o_nummer>[Name] KLV 06/666</o_nummer></objekt>
+            </einsatzort><einsatzmittel><em>
+            <em_organisation>FW</em_organisation><em_ort>KLV</em_ort>
+            <em_typ>LF10</em_typ>
+            </em></einsatzmittel></daten>""", logger)
+        self.assertEqual(alarm.number, '4711')
+        self.assertEqual(alarm.eskalation, '')
+        self.assertEqual(alarm.besonderheit, 'A & B & C')
+        self.assertEqual((alarm.lat, alarm.lon), (51.80245845, 6.16825119))
+        self.assertEqual(alarm.objektnummer, 'KLV 06/666')
+        self.assertEqual(alarm.einsatzmittel,
+                set((EinsatzMittel('FW', 'KLV', '', 'LF10', '', ''),)))
+
+        alarm = Alarm(config)
+        with self.assertRaises(ValueError):
+            alarm.fromXml('<einsatz/>', logger)
+
+    def test_alarmSchema(self):
+        config = configparser.ConfigParser()
+        names = [field.name for field in schema]
+        self.assertEqual(len(set(names)), len(names))
+        ids = [field.envelope for field in schema if field.envelope]
+        self.assertEqual(len(set(ids)), len(ids))
+
+        alarm = Alarm(config)
+        self.assertEqual((alarm.number, alarm.lat, alarm.einsatzmittel),
+                (None, 0.0, set()))
+        self.assertIsNot(alarm.einsatzmittel, Alarm(config).einsatzmittel)
+
+        alarm.fromAlamos({'COBRA_name': '40007', 'timestamp': '0',
+            'einsatzmittel': 'FW KLV01 DLK23 1\n', 'city': 'Kleve',
+            'lat': '51.5', 'COBRA_ADDITIONAL_special_rights': 'Ja'}, logger)
+        self.assertEqual((alarm.number, alarm.ort, alarm.strasse,
+            alarm.lat, alarm.lon, alarm.sondersignal),
+            ('40007', 'Kleve', '', 51.5, 0.0, True))
+
+        other = Alarm(config)
+        other.number = '1170040007'
+        other.ort = 'Goch'
+        other.strasse = 'Kirchweg'
+        other.lat = 51.6
+        other.einsatzmittel.add(EinsatzMittel('FW', 'KLV', '05', 'LF10',
+            '1', ''))
+        alarm.merge(other, logger)
+        self.assertEqual((alarm.number, alarm.ort, alarm.strasse, alarm.lat),
+                ('1170040007', 'Kleve', 'Kirchweg', 51.5))
+        self.assertEqual(len(alarm.einsatzmittel), 2)
+
+    def test_alarmRecord(self):
+        config = configparser.ConfigParser()
+        alarm = Alarm(config)
+        with self.assertRaises(AttributeError):
+            alarm.unknown = 1
+        self.assertIsNone(alarm.raw)
+        alarm.load('test_data/test01-1.json', logger)
+        self.assertTrue(alarm.json)
+        self.assertEqual(alarm.payload(), alarm.raw.json)
+
+        other = Alarm(config)
+        other.load('test_data/test01-1.json', logger, keepPayload = False)
+        self.assertIsNone(other.raw)
+        self.assertIsNone(other.json)
+        self.assertEqual(other.number, alarm.number)
+        for em in other.einsatzmittel:
+            self.assertIn(em, alarm.einsatzmittel)
+            shared = [e for e in alarm.einsatzmittel if e == em][0]
+            self.assertIs(em, shared)
+        fields = ['FW', 'KLV', '05', 'LF10', '1', '']
+        em = EinsatzMittel.shared(*(''.join(list(f)) for f in fields))
+        self.assertIs(EinsatzMittel.shared(*fields), em)
+        self.assertIs(em.typ, sys.intern('LF10'))
+
+    def test_alarmContext(self):
+        config = configparser.ConfigParser()
+        config['display'] = {'home_town': 'Kleve'}
+        config['pager'] = {'time_zone': 'UTC'}
+        context = AlarmContext(config)
+        alarm = Alarm(config, context = context)
+        self.assertIs(alarm.context, context)
+        # changes of the configuration are seen by new contexts
+        config['display']['home_town'] = 'Goch'
+        self.assertEqual(Alarm(config).context.homeTown, 'Goch')
+        alarm.fromPager('16-12-17 18:55:10 LG *40005*H1 Hilfeleistung*'
+                '*Kleve*Reichswalde*Grunewaldstrasse*1**', logger)
+        self.assertEqual(alarm.datetime.isoformat(),
+                '2017-12-16T18:55:10+00:00')
+        self.assertEqual(alarm.address(), 'Grunewaldstrasse 1, Reichswalde')
+
+    def test_alarmMerge(self):
+        config = configparser.ConfigParser()
+        alarm = Alarm(config)
+        alarm.fromPager('16-12-17 18:55:10 LG *40005*H1 Hilfeleistung*'
+                '*Kleve*Reichswalde*Grunewaldstrasse*1**', logger)
+        alarm.lat, alarm.lon = 51.7563, 6.1181
+        other = Alarm(config)
+        other.source = 'xml'
+        other.sources.add(other.source)
+        other.number = '1170040005'
+        other.rufnummer = '0179 555 364532'
+        other.lat, other.lon = 51.75638, 6.11815
+        other.einsatzmittel.add(EinsatzMittel('FW', 'KLV', '05', 'LF10',
+            '1', ''))
+        changes = alarm.merge(other, logger)
+        self.assertEqual(set(changes.fields), set(('number', 'rufnummer')))
+        self.assertEqual(changes.sources, set(('xml',)))
+        self.assertEqual(len(changes.einsatzmittel), 1)
+        self.assertEqual(changes.coordinates,
+                ((51.7563, 6.1181), (51.75638, 6.11815)))
+        self.assertTrue(changes.touches(('meldender', 'rufnummer')))
+        self.assertTrue(changes.touches(Alarm.spokenFields + ('lat',)))
+        self.assertFalse(changes.touches(Alarm.spokenFields))
+
+        self.assertFalse(alarm.merge(other, logger))
+        other.lat, other.lon = 51.8, 6.2 # elsewhere, not a refinement
+        self.assertIsNone(alarm.merge(other, logger).coordinates)
+        self.assertEqual((alarm.lat, alarm.lon), (51.75638, 6.11815))
+
+    def test_websocketFrame(self):
+        tempDir = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['db'] = {'path': tempDir.name}
+        frame = b'{"status": {}, "alarm": {"timestamp": "1512497052000", ' \
+                b'"einsatzmittel": "", "COBRA_name": "4711"}}'
+        data = JsonCodec.loads(frame)['alarm']
+        alarm = Alarm(config)
+        alarm.fromAlamos(data, logger)
+        # only the alarm is saved and forwarded, not the whole frame
+        self.assertEqual(JsonCodec.loads(alarm.payload()), data)
+        alarm.save()
+        path = os.path.join(tempDir.name, alarm.dateString() + '.json')
+        f = open(path, 'rb')
+        self.assertEqual(JsonCodec.loads(f.read()), data)
+        f.close()
+        copy = Alarm(config)
+        copy.load(path, logger)
+        self.assertEqual((copy.number, copy.payload()),
+                ('4711', alarm.payload()))
+        # frames saved by a former version are still read
+        f = open(path, 'wb')
+        f.write(frame)
+        f.close()
+        copy = Alarm(config)
+        copy.load(path, logger)
+        self.assertEqual(copy.number, '4711')
+        self.assertEqual(JsonCodec.loads(copy.payload()), data)
+        tempDir.cleanup()
+
+    def test_envelope(self):
+        config = configparser.ConfigParser()
+        context = AlarmContext(config)
+        for path in ('test_data/test01-1.json', 'test_data/test01-2.dme',
+                'test_data/test01-3.xml'):
+            alarm = Alarm(config, receiveTimeStamp = 1700000000.5,
+                    context = context)
+            alarm.load(path, logger)
+            data = Envelope.encode(alarm)
+            stream = Envelope.EnvelopeStream()
+            self.assertEqual(stream.feed(data[:5]), [])
+            self.assertEqual(stream.feed(data[5:] + data), [data, data])
+            copy = Alarm(config, context = context)
+            Envelope.decode(data, copy)
+            self.assertEqual(copy.payload(), alarm.payload())
+            for key in Alarm.__slots__ + ('pager', 'json'):
+                if key != 'raw':
+                    self.assertEqual(getattr(copy, key),
+                            getattr(alarm, key), key)
+        with self.assertRaises(Envelope.EnvelopeError):
+            Envelope.decode(data[:-3], Alarm(config))
+        route = [[6.1, 51.7], [6.2, 51.8]]
+        data = Envelope.encodeArtifact('4711', 'route', route = route,
+                distance = 1234.5, duration = None)
+        self.assertTrue(Envelope.isArtifact(data))
+        self.assertEqual(Envelope.EnvelopeStream().feed(data), [data])
+        self.assertEqual(Envelope.decodeArtifact(data), {'number': '4711',
+            'name': 'route', 'route': route, 'distance': 1234.5,
+            'duration': None})
+
+    def test_latency(self):
+        stats = LatencyStats(size = 10)
+        for i in range(20):
+            trace = LatencyTrace()
+            trace.marks['receipt'] = 100.0
+            trace.marks['parse'] = 100.0 + i * 0.001
+            trace.mark('parse')
+            if i % 2:
+                trace.marks['route'] = 101.0
+            stats.add(trace)
+        self.assertAlmostEqual(trace.elapsed('parse'), 0.019)
+        self.assertIsNone(trace.elapsed('print'))
+        self.assertEqual(str(trace), 'parse 19.0, route 1000.0')
+        summary = stats.summary()
+        self.assertEqual(sorted(summary.keys()), ['parse', 'route'])
+        self.assertEqual(summary['parse'][0], 10)
+        self.assertAlmostEqual(summary['parse'][1], 0.015)
+        self.assertAlmostEqual(summary['parse'][4], 0.019)
+        self.assertEqual(summary['route'][0], 5)
+        with self.assertLogs(logger, logging.INFO) as cm:
+            stats.log(logger, '4711', trace)
+        self.assertEqual(len(cm.output), 1)
+        with self.assertLogs(logger, logging.INFO) as cm:
+            stats.logSummary(logger)
+        self.assertEqual(len(cm.output), 2)
+
+    def test_frameReader(self):
+        reader = FrameReader()
+        self.assertEqual(reader.feed(b'12-05-18 St}rzen'), [])
+        self.assertEqual(reader.feed(b'\x00\x0012-05'), [b'12-05-18 St}rzen',
+            b''])
+        self.assertEqual(reader.feed(b'-18 G|rre'), [])
+        self.assertEqual(reader.feed(b'strasse\x00'),
+                [b'12-05-18 G|rrestrasse'])
+        self.assertEqual(reader.buffer, b'')
+        self.assertEqual(AlarmReceiver.decode('G|rrestra~e'), 'Görrestraße')
+
+    def test_pagerPorts(self):
+        master1, slave1 = os.openpty()
+        master2, slave2 = os.openpty()
+        config = configparser.ConfigParser()
+        config['pager'] = {
+                'device': os.ttyname(slave1),
+                'device1': os.ttyname(slave2),
+                'decode1': 'none',
+                }
+        receiver = AlarmReceiver(config, logger)
+        self.assertEqual([p.device for p in receiver.ports],
+                [os.ttyname(slave1), os.ttyname(slave2)])
+        for port in receiver.ports:
+            port.open()
+        os.write(master1, b'Dorfstra~e\x00')
+        os.write(master2, b'Dorfstra~e\x00')
+        frames = []
+        for port in receiver.ports:
+            select.select([port.serial.fileno()], [], [], 1.0)
+            frames.extend(port.read())
+            port.close()
+        self.assertEqual(frames, ['Dorfstraße', 'Dorfstra~e'])
+        receiver.ports[1].connected = False
+        self.assertEqual(receiver.connectionMessage(),
+                'Keine Verbindung zum DME (%s)!' % (os.ttyname(slave2)))
+        for fd in (master1, slave1, master2, slave2):
+            os.close(fd)
+
+    def test_deviceMonitor(self):
+        tempDir = tempfile.TemporaryDirectory()
+        device = os.path.join(tempDir.name, 'serial', 'ttyUSB0')
+        for monitor in (PollingMonitor(), InotifyMonitor()):
+            monitor.watch(device)
+            self.assertEqual(monitor.changes(), set())
+            os.mkdir(os.path.dirname(device))
+            monitor.changes()
+            open(device, 'w').close()
+            if monitor.fileno() is not None:
+                ready = select.select([monitor.fileno()], [], [], 1.0)[0]
+                self.assertTrue(ready)
+            self.assertEqual(monitor.changes(), set((device,)))
+            self.assertEqual(monitor.changes(), set())
+            monitor.close()
+            os.unlink(device)
+            os.rmdir(os.path.dirname(device))
+        tempDir.cleanup()
+
+    def test_duplicateFilter(self):
+        dupFilter = DuplicateFilter(2.0, maxEntries = 2)
+        self.assertFalse(dupFilter.isDuplicate(b'a', now = 10.0))
+        self.assertTrue(dupFilter.isDuplicate(b'a', now = 10.1))
+        self.assertFalse(dupFilter.isDuplicate(b'b', now = 10.2))
+        self.assertTrue(dupFilter.isDuplicate(b'a', now = 11.9))
+        self.assertFalse(dupFilter.isDuplicate(b'a', now = 12.0))
+        self.assertEqual(dupFilter.suppressed, 2)
+        self.assertFalse(dupFilter.isDuplicate(b'c', now = 12.1))
+        self.assertFalse(dupFilter.isDuplicate(b'd', now = 12.1))
+        self.assertEqual(len(dupFilter.seen), 2)
+
+    def test_imapXmlParts(self):
+        response = parse_fetch_response([b'1 (UID 5 BODYSTRUCTURE ('
+            b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL '
+            b'NIL NIL NIL)'
+            b'(("TEXT" "HTML" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+            b'("APPLICATION" "XML" ("NAME" "alarm.xml") NIL NIL "BASE64" 12 '
+            b'NIL ("ATTACHMENT" ("FILENAME" "alarm.xml")) NIL NIL) '
+            b'"MIXED" ("BOUNDARY" "y") NIL NIL NIL)'
+            b'("APPLICATION" "PDF" ("NAME" "plan.pdf") NIL NIL "BASE64" '
+            b'99999 NIL ("ATTACHMENT" ("FILENAME" "plan.pdf")) NIL NIL) '
+            b'"MIXED" ("BOUNDARY" "x") NIL NIL NIL))'])
+        parts = xmlParts(response[5][b'BODYSTRUCTURE'])
+        self.assertEqual(parts, [('2.2', b'BASE64')])
+        self.assertEqual(decodePart(b'PGRhdGVuLz4=', b'BASE64'),
+                b'<daten/>')
+
+    def test_imapIdleResponses(self):
+        monitor = ImapMonitor(configparser.ConfigParser(), logger)
+        monitor.exists = 3
+        self.assertFalse(monitor.newMessages([(b'OK', b'Still here'),
+            (2, b'FETCH', (b'FLAGS', (b'\\Seen',)))]))
+        self.assertFalse(monitor.newMessages([(3, b'EXPUNGE'),
+            (2, b'EXISTS')]))
+        self.assertTrue(monitor.newMessages([(3, b'EXISTS')]))
+        self.assertEqual(monitor.exists, 3)
+
+    def test_tcpClients(self):
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': '11299', 'max_payload': '1'}
+        listener = SocketListener(config, logger)
+        received = []
+        listener.xmlAlarm.connect(received.append)
+        envelopes = []
+        listener.envelope.connect(envelopes.append)
+        keepalive = Envelope.KEEPALIVE
+
+        async def run():
+            await listener.start()
+            first = (await asyncio.open_connection('127.0.0.1', 11299))[1]
+            second = (await asyncio.open_connection('127.0.0.1', 11299))[1]
+            large = (await asyncio.open_connection('127.0.0.1', 11299))[1]
+            first.write(keepalive + b'<?xml version="1.0"?>\n<daten>first')
+            second.write(b'<daten>second')
+            await asyncio.sleep(0.2)
+            self.assertEqual(len(listener.tcpClients), 3)
+            second.write(b'</daten>')
+            second.close()
+            large.write(b'<daten>' + b'x' * 2048)
+            await asyncio.sleep(0.2)
+            first.write(b'</daten>\n<daten>next</daten>\n' + keepalive)
+            first.write(b'<daten')
+            await asyncio.sleep(0.2)
+            self.assertEqual(received, [b'<daten>second</daten>',
+                b'<?xml version="1.0"?>\n<daten>first</daten>',
+                b'<daten>next</daten>'])
+            first.write(b'/>')
+            await asyncio.sleep(0.2)
+            first.close()
+            large.close()
+            await asyncio.sleep(0.2)
+            self.assertEqual(received[3:], [b'<daten/>'])
+            self.assertEqual(len(listener.tcpClients), 0)
+            alarm = Alarm(config)
+            alarm.fromPager('Einsatz', logger)
+            data = Envelope.encode(alarm)
+            forwarded = (await asyncio.open_connection('127.0.0.1',
+                11299))[1]
+            forwarded.write(keepalive + data[:3])
+            await asyncio.sleep(0.1)
+            forwarded.write(data[3:] + keepalive + data)
+            await asyncio.sleep(0.2)
+            forwarded.close()
+            self.assertEqual(envelopes, [data, data])
+            listener.close()
+
+        asyncio.run(run())
+
+    def test_invalidDatagram(self):
+        listener = SocketListener(configparser.ConfigParser(), logger)
+        received = []
+        listener.pagerAlarm.connect(received.append)
+        listener.datagrams = [(b'\xffEinsatz', ('127.0.0.1', 4711)),
+                (b'Einsatz', ('127.0.0.1', 4711))]
+        listener.readDatagrams()
+        self.assertEqual(received, ['Einsatz'])
+
+    def test_ingestCore(self):
+        master, slave = os.openpty()
+        config = configparser.ConfigParser()
+        config['pager'] = {'device': os.ttyname(slave)}
+        config['socket'] = {'port': '11297'}
+        core = IngestCore(config, logger, PollingMonitor())
+        received = []
+        core.received.connect(lambda kind, payload, trace: \
+                received.append((kind, payload)))
+
+        async def feed():
+            await asyncio.sleep(0.2)
+            os.write(master, b'Dorfstra~e\x00')
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.sendto(b'Einsatz', ('127.0.0.1', 11297))
+            udp.sendto(b'Einsatz', ('127.0.0.1', 11297))
+            await asyncio.sleep(0.05)
+            os.write(master, b'Einsatz\x00')
+            udp.close()
+            await asyncio.sleep(0.2)
+            core.stop()
+
+        async def run():
+            await asyncio.gather(core.run(), feed())
+
+        asyncio.run(asyncio.wait_for(run(), 5))
+        self.assertEqual(sorted(received), [
+            ('pager', ('Dorfstraße', os.ttyname(slave))),
+            ('pager', ('Einsatz', None))])
+        self.assertEqual(core.metrics(), {'pager': 2, 'duplicate': 1})
+        os.close(master)
+        os.close(slave)
+
+    def test_ingestThread(self):
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': '11293'}
+        core = IngestCore(config, logger, PollingMonitor())
+        threads = []
+        core.received.connect(lambda kind, payload, trace: \
+                threads.append(threading.get_ident()),
+                PyQt5.QtCore.Qt.DirectConnection)
+        thread = threading.Thread(target = core.start)
+        thread.start()
+        time.sleep(0.2)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.sendto(b'Einsatz', ('127.0.0.1', 11293))
+        udp.close()
+        time.sleep(0.2)
+        core.stop()
+        thread.join(5)
+        self.assertEqual(threads, [thread.ident])
+
+    def test_imapStop(self):
+        config = configparser.ConfigParser()
+        config['email'] = {'imap_host': '127.0.0.1', 'imap_user': 'user',
+                'imap_pass': 'secret'}
+        monitor = ImapMonitor(config, logger)
+        monitor.socketTimeout = 1
+        thread = threading.Thread(target = monitor.start)
+        thread.start()
+        time.sleep(0.2) # connection refused, waiting to reconnect
+        monitor.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_spool(self):
+        tempDir = tempfile.TemporaryDirectory()
+        spool = Spool(tempDir.name, logger, segmentSize = 20)
+        spool.append(Spool.STREAM, b'<daten>1</daten>', stamp = 1.0)
+        spool.append(Spool.DATAGRAM, b'Einsatz', stamp = 2.0)
+        spool.append(Spool.STREAM, b'<daten>3</daten>', stamp = 3.0)
+        self.assertEqual(spool.pop().data, b'<daten>1</daten>')
+        spool.close()
+        self.assertEqual(sorted(os.listdir(tempDir.name)), ['00000001.seg',
+            '00000002.seg', '00000003.seg', 'cursor'])
+        f = open(spool.segmentPath(3), 'ab')
+        f.write(Spool.recordHeader.pack(4.0, Spool.STREAM, 100) + b'<da')
+        f.close()
+        spool = Spool(tempDir.name, logger, segmentSize = 20)
+        self.assertEqual([(r.stamp, r.kind, r.data) for r in spool.records],
+                [(2.0, Spool.DATAGRAM, b'Einsatz'),
+                    (3.0, Spool.STREAM, b'<daten>3</daten>')])
+        spool.pop()
+        spool.pop()
+        spool.append(Spool.STREAM, b'<daten>5</daten>', stamp = 5.0)
+        spool.close()
+        spool = Spool(tempDir.name, logger)
+        self.assertEqual([r.data for r in spool.records],
+                [b'<daten>5</daten>'])
+        spool.close()
+        tempDir.cleanup()
+
+    def test_forwarder(self):
+        tempDir = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': '11295', 'idle_timeout': '1'}
+        config['forward'] = {'host0': '127.0.0.1', 'port0': '11295',
+                'host1': '127.0.0.1', 'port1': '11294', 'timeout1': '0.2',
+                'spool': tempDir.name}
+        listener = SocketListener(config, logger)
+        received = []
+        listener.xmlAlarm.connect(received.append)
+        listener.pagerAlarm.connect(received.append)
+        config['socket'] = {'port': '11294'}
+        lateListener = SocketListener(config, logger)
+        lateReceived = []
+        lateListener.xmlAlarm.connect(lateReceived.append)
+        lateListener.pagerAlarm.connect(lateReceived.append)
+        forwarder = Forwarder(config, logger)
+        self.assertEqual([t.timeout for t in forwarder.targets], [5.0, 0.2])
+        late = forwarder.targets[1]
+        late.reconnectMin = 0.05
+
+        async def run():
+            await listener.start()
+            task = asyncio.ensure_future(forwarder.run())
+            await asyncio.sleep(0.2)
+            start = time.monotonic()
+            forwarder.forward(types.SimpleNamespace(source = 'xml',
+                xml = b'<daten>1</daten>'))
+            forwarder.forward(types.SimpleNamespace(source = 'pager',
+                pager = 'Einsatz'))
+            self.assertLess(time.monotonic() - start, 0.05)
+            await asyncio.sleep(0.5)
+            # the pager alarm was sent via UDP without waiting for TCP
+            self.assertEqual(len(late.spool), 1)
+            await lateListener.start()
+            await asyncio.sleep(0.5)
+            self.assertEqual(len(late.spool), 0)
+            # raw documents are sent via one connection each
+            self.assertEqual(len(listener.tcpClients), 0)
+            self.assertEqual(len(lateListener.tcpClients), 0)
+            task.cancel()
+            listener.close()
+            lateListener.close()
+
+        asyncio.run(run())
+        self.assertCountEqual(received, [b'<daten>1</daten>', 'Einsatz'])
+        self.assertEqual(lateReceived, [b'<daten>1</daten>'])
+        self.assertEqual(Spool(late.spool.directory, logger).records,
+                collections.deque())
+        tempDir.cleanup()
+
+    def test_forwardKeepalive(self):
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': '11290', 'idle_timeout': '1'}
+        config['forward'] = {'host0': '127.0.0.1', 'port0': '11290',
+                'format': 'envelope'}
+        listener = SocketListener(config, logger)
+        envelopes = []
+        listener.envelope.connect(envelopes.append)
+        forwarder = Forwarder(config, logger)
+        target = forwarder.targets[0]
+        target.keepaliveInterval = 0.2
+
+        async def run():
+            await listener.start()
+            task = asyncio.ensure_future(forwarder.run())
+            await asyncio.sleep(0.2)
+            writer = target.writer
+            self.assertIsNotNone(writer)
+            await asyncio.sleep(1.2) # beyond the idle timeout
+            self.assertIs(target.writer, writer)
+            self.assertEqual(len(listener.tcpClients), 1)
+            task.cancel()
+            listener.close()
+
+        asyncio.run(run())
+        self.assertEqual(envelopes, [])
+
+    def test_forwardBeforeRun(self):
+        tempDir = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['socket'] = {'port': '11289'}
+        config['forward'] = {'host0': '127.0.0.1', 'port0': '11289',
+                'spool': tempDir.name, 'format': 'envelope'}
+        listener = SocketListener(config, logger)
+        envelopes = []
+        listener.envelope.connect(envelopes.append)
+        forwarder = Forwarder(config, logger)
+        target = forwarder.targets[0]
+        alarm = Alarm(config)
+        alarm.fromPager('Einsatz', logger)
+        forwarder.forward(alarm) # before the event loop runs
+        self.assertEqual(len(target.spool), 1)
+        self.assertEqual(len(Spool(target.spool.directory, logger)), 1)
+
+        async def run():
+            await listener.start()
+            task = asyncio.ensure_future(forwarder.run())
+            await asyncio.sleep(0.3)
+            self.assertEqual(len(target.spool), 0)
+            task.cancel()
+            listener.close()
+
+        asyncio.run(run())
+        self.assertEqual(len(envelopes), 1)
+        tempDir.cleanup()
+
+    def test_replay(self):
+        tempDir = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config['forward'] = {'host0': '127.0.0.1', 'port0': '11291',
+                'spool': tempDir.name, 'format': 'envelope'}
+        paths = ['test_data/test01-1.json', 'test_data/test01-2.dme']
+        args = types.SimpleNamespace(listen_port = 11291, timeout = 2.0,
+                forward_format = 'envelope')
+        replay = Replay(args, loadArchive(paths), logger)
+        forwarder = Forwarder(config, logger)
+
+        async def run():
+            collector = await replay.startCollector()
+            task = asyncio.ensure_future(forwarder.run())
+            await asyncio.sleep(0.1)
+            for stamp, kind, data in replay.alarms:
+                replay.expect(kind, data)
+                replay.sent[kind] += 1
+            for path in paths:
+                alarm = Alarm(config)
+                alarm.load(path, logger)
+                forwarder.forward(alarm) # spooled envelope
+            await replay.waitForCopies()
+            task.cancel()
+            collector.close()
+
+        asyncio.run(run())
+        self.assertEqual(replay.received, 2)
+        self.assertEqual(len(replay.latencies), 2)
+        args.forward_format = 'raw'
+        self.assertEqual(replay.expectedCopies(), 1)
+        tempDir.cleanup()
+
+    def test_dnsCache(self):
+        dns = DnsCache(logger, ttl = 0.1, retry = 0.1)
+        dns.add('localhost')
+        dns.add('invalid.invalid')
+
+        async def run():
+            task = asyncio.ensure_future(dns.run())
+            await asyncio.sleep(0.05)
+            self.assertEqual(dns.lookup('localhost'), '127.0.0.1')
+            self.assertIsNone(dns.lookup('invalid.invalid'))
+            dns.addresses['invalid.invalid'] = '192.0.2.1'
+            await asyncio.sleep(0.2)
+            self.assertEqual(dns.lookup('invalid.invalid'), '192.0.2.1')
+            task.cancel()
+
+        asyncio.run(run())
+
+    def test_websocketReconnect(self):
+        config = configparser.ConfigParser()
+        config['websocket'] = {'url': 'ws://127.0.0.1:11298',
+                'user': 'display', 'reconnect_max': '0.1'}
+        config['status'] = {'address1': '1234567'}
+        receiver = WebsocketReceiver(config, logger)
+        receiver.reconnectMin = 0.05
+        alarms = []
+        receiver.receivedAlarm.connect(
+                lambda frame, data: alarms.append((frame, data)))
+        registrations = []
+
+        async def handler(ws):
+            registrations.append(json.loads(await ws.recv()))
+            if len(registrations) == 1:
+                await ws.send(json.dumps({'alarm': {'number': '1'}}))
+                await ws.send('no json')
+
+        async def run():
+            async with websockets.serve(handler, '127.0.0.1', 11298):
+                task = asyncio.ensure_future(receiver.run())
+                while len(registrations) < 2:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+
+        asyncio.run(asyncio.wait_for(run(), 5))
+        self.assertEqual(alarms, [(b'{"alarm": {"number": "1"}}',
+            {'number': '1'})])
+        self.assertEqual(registrations, [{'host': 'display',
+            'auth_token': '', 'register_status': ['1234567']}] * 2)
+
+    def test_websocketBackoffReset(self):
+        config = configparser.ConfigParser()
+        config['websocket'] = {'url': 'ws://127.0.0.1:11297',
+                'reconnect_max': '60'}
+        receiver = WebsocketReceiver(config, logger)
+        receiver.reconnectMin = 0.05
+        registrations = []
+
+        async def handler(ws):
+            # answers, but drops every connection right away
+            registrations.append(await ws.recv())
+            await ws.send(json.dumps({'auth': 'ok'}))
+
+        async def run():
+            async with websockets.serve(handler, '127.0.0.1', 11297):
+                task = asyncio.ensure_future(receiver.run())
+                while len(registrations) < 8:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+
+        # without the reset, the seven delays would add up to > 3 s
+        asyncio.run(asyncio.wait_for(run(), 2))
+
 
 #-----------------------------------------------------------------------------
 